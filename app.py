@@ -1,15 +1,32 @@
 import os
 import logging
 import time
+import threading
 from datetime import datetime
-from fastapi import FastAPI, BackgroundTasks, Request
-from fastapi.responses import RedirectResponse, JSONResponse
-from fastapi.middleware.wsgi import WSGIMiddleware
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import RedirectResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse, FileResponse
+from fastapi.staticfiles import StaticFiles
+from starlette.middleware.sessions import SessionMiddleware
+from starlette.concurrency import run_in_threadpool
 from dotenv import load_dotenv
-from models import ApprovalDB
+from models import get_db, get_cost_ledger
+from utils import attribute_costs
 from services.shopify import ShopifyService
-from threading import Thread
-import requests
+from services.http_client import http_client
+from services.image_cache import image_cache
+from services.replicate import get_prediction_cache
+from services.output_store import get_output_store, parse_byte_range, iter_file_range, KEY_PATTERN, CONTENT_TYPES as OUTPUT_CONTENT_TYPES
+from processing.general import add_badges_batch
+from processing.apify_handler import split_apify_image
+from processing.clothing import generate_clothing_gallery
+from processing.executor import image_executor
+from processing.dedupe import get_perceptual_index
+from processing.thumbnails import get_thumbnail_cache
+from jobs import JobWorkerPool
+from pipeline import BatchPipeline, BatchRunManager, image_fingerprint
+from webhooks import WebhookCoalescer
+from publisher import Publisher
+from metrics import registry as metrics_registry
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -18,7 +35,7 @@ startup_time = time.time()
 
 load_dotenv()
 app = FastAPI()
-db = ApprovalDB()
+db = get_db()
 shopify = ShopifyService()
 
 def log_directory_structure():
@@ -74,18 +91,99 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    """Ultra-fast health check for Railway"""
+    """Ultra-fast health check for Railway - in-memory counters only, no SQLite or index loads"""
     return {
         "status": "ok",
         "timestamp": datetime.utcnow().isoformat(),
         "uptime": time.time() - startup_time,
         "memory": get_memory_usage(),
         "ready": is_app_ready(),
-        "shopify_status": "connected" if shopify.enabled else "disconnected"
+        "shopify_status": "connected" if shopify.enabled else "disconnected",
+        "jobs": job_pool.stats(queue=False),
+        "webhooks": webhooks.stats(),
+        "batch_run": batch_runs.snapshot(),
+        "http": http_client.stats(),
+        "output_store": get_output_store().stats()
     }
 
+def collect_stats():
+    """Queue depths, cache sizes and publish progress - these read SQLite"""
+    return {
+        "jobs": job_pool.stats(),
+        "image_cache": image_cache.stats(),
+        "prediction_cache": get_prediction_cache().stats(),
+        "perceptual_index": get_perceptual_index().stats(),
+        "thumbnails": get_thumbnail_cache().stats(),
+        "publishing": publisher.stats()
+    }
+
+@app.get("/stats")
+async def stats():
+    """Detailed component stats, gathered off the event loop"""
+    return await run_in_threadpool(collect_stats)
+
+# Plain def: the aggregates run in FastAPI's threadpool, off the event loop
+@app.get("/costs")
+def cost_report(day: str = None, days: int = 30):
+    """Replicate spend per model and per product (for `day`, default today) and per day"""
+    ledger = get_cost_ledger()
+    return {
+        "today": round(ledger.today_total(), 6),
+        "by_model": ledger.costs_by_model(day),
+        "by_product": ledger.costs_by_product(day),
+        "by_day": ledger.costs_by_day(days),
+    }
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus text exposition of stage latencies, cache, cost and queue metrics"""
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.api_route("/outputs/{key}", methods=["GET", "HEAD"])
+async def serve_output(request: Request, key: str):
+    """Processed images from the output store: immutable, with ETag/304 and byte ranges"""
+    store = get_output_store()
+    if not KEY_PATTERN.match(key):
+        raise HTTPException(status_code=404)
+    try:
+        path = store.path(key)
+        stat_result = os.stat(path)
+    except (AttributeError, OSError):
+        raise HTTPException(status_code=404)
+
+    # Keys are content hashes, so the file behind a URL never changes
+    etag = f'"{key.split(".")[0]}"'
+    media_type = OUTPUT_CONTENT_TYPES[key.rsplit('.', 1)[1]]
+    headers = {'ETag': etag, 'Cache-Control': 'public, max-age=31536000, immutable', 'Accept-Ranges': 'bytes'}
+    if_none_match = request.headers.get('if-none-match', '')
+    if etag in if_none_match or if_none_match.strip() == '*':
+        return Response(status_code=304, headers=headers)
+
+    accel_prefix = os.getenv('OUTPUT_ACCEL_REDIRECT')
+    if accel_prefix:
+        # A fronting nginx serves the file itself (sendfile, ranges) from its internal location
+        headers['X-Accel-Redirect'] = f"{accel_prefix.rstrip('/')}/{key[:2]}/{key}"
+        return Response(headers=headers, media_type=media_type)
+
+    size = stat_result.st_size
+    range_header = request.headers.get('range')
+    # If-Range: only honour the range if the client's copy is this one
+    if range_header and request.headers.get('if-range', etag) == etag:
+        span = parse_byte_range(range_header, size)
+        if span is None:
+            return Response(status_code=416, headers={**headers, 'Content-Range': f"bytes */{size}"})
+        if span:
+            start, end = span
+            headers.update({'Content-Range': f"bytes {start}-{end}/{size}", 'Content-Length': str(end - start + 1)})
+            if request.method == 'HEAD':
+                return Response(status_code=206, headers=headers, media_type=media_type)
+            return StreamingResponse(iter_file_range(path, start, end), status_code=206,
+                                     headers=headers, media_type=media_type)
+
+    return FileResponse(path, media_type=media_type, headers=headers, stat_result=stat_result, method=request.method)
+
 @app.post("/webhook/product_updated")
-async def handle_product_update(request: Request, background_tasks: BackgroundTasks):
+async def handle_product_update(request: Request):
     """Shopify webhook handler - processes product updates"""
     if not shopify.enabled:
         logger.warning("🚫 Ignoring webhook - Shopify service disabled")
@@ -103,28 +201,38 @@ async def handle_product_update(request: Request, background_tasks: BackgroundTa
         logger.info(f"✅ Webhook received for product: {product_id}")
         logger.info(f"🏷️ Product tags: {tags}")
         
-        # Add to background processing
-        background_tasks.add_task(process_product, product_id, tags)
-        return {"status": "processing_started", "product_id": product_id}
+        # Dedupe + debounce into the job queue - workers pick it up (and retry it) independently of this request.
+        # Its SQLite writes can wait on the write lock, so they run in the threadpool
+        return await run_in_threadpool(webhooks.submit, payload, webhook_id=request.headers.get('X-Shopify-Webhook-Id'))
     
     except Exception as e:
         logger.exception(f"🔥 Webhook processing failed: {str(e)}")
-        return {"status": "error", "message": str(e)}
+        # Non-2xx so Shopify redelivers it
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=500)
 
 @app.post("/fetch-all-products")
-async def fetch_all_products(background_tasks: BackgroundTasks):
-    """Manually trigger fetching of all products from Shopify"""
+async def fetch_all_products(mode: str = None, full: bool = False):
+    """Manually trigger fetching of all products from Shopify (?mode=bulk for a GraphQL bulk export,
+    ?full=true to ignore the sync watermark and re-walk the whole catalog)"""
     if not shopify.enabled:
         return {"status": "error", "message": "Shopify service disabled"}
     
-    background_tasks.add_task(process_all_products)
-    return {"status": "started", "message": "Batch processing started - check dashboard in 2-5 minutes"}
+    started, run = batch_runs.start(mode=mode, full=full)
+    if not started:
+        return {"status": "already_running", "run": run}
+    return {"status": "started", "job_id": run['job_id'], "message": "Batch processing started - progress is live on the dashboard"}
 
-def process_product(product_id, tags):
+def process_product(product_id, tags, images=None, updated_at=None):
     """Background task to process product images with real AI processing"""
+    # Every Replicate charge made while processing is attributed to this product
+    with attribute_costs(product_id):
+        _process_product(product_id, tags, images, updated_at)
+
+def _process_product(product_id, tags, images=None, updated_at=None):
     try:
-        # Get product images from Shopify
-        images = shopify.get_product_images(product_id)
+        # Webhook payloads already carry the images; only fetch when they don't
+        if images is None:
+            images = shopify.get_product_images(product_id)
         if not images:
             logger.warning(f"🖼️ No images found for product {product_id}")
             return
@@ -138,119 +246,69 @@ def process_product(product_id, tags):
         processed_images = []
         
         if "Supplier:apify" in tags:
-            logger.info(f"🔧 Processing as Apify multi-angle product")
+            product_type = 'apify'
+            logger.info("🔧 Processing as Apify multi-angle product")
             # Split composite image into multiple angles
             processed_images = split_apify_image(main_image)
         
         elif any(keyword in str(tags).lower() for keyword in ['clothing', 'shirt', 'dress', 'pants']):
-            logger.info(f"👗 Processing as clothing product")
+            product_type = 'clothing'
+            logger.info("👗 Processing as clothing product")
             # Generate lifestyle + swatch collage
             swatch_images = [img['src'] for img in images[1:]]
             processed_images = generate_clothing_gallery(main_image, swatch_images)
         
         else:
-            logger.info(f"📦 Processing as standard product")
-            # Add badges to each image
-            for img in images[:5]:
-                processed_img = add_badges(img['src'])
-                processed_images.append(processed_img)
+            product_type = 'standard'
+            logger.info("📦 Processing as standard product")
+            # Add badges to the first five images in one batch
+            processed_images = add_badges_batch([img['src'] for img in images[:5]])
         
         # Add to approval queue
         db.add_pending(
             product_id=str(product_id),
-            original_images=[img['src'] for img in images],
+            original_images=images,  # Shopify image dicts carry width/height
             processed_images=processed_images,
-            variant_id=','.join(tags) if isinstance(tags, list) else tags
+            variant_id=','.join(tags) if isinstance(tags, list) else tags,
+            product_type=product_type
         )
+        # Batch runs skip this product until its images change again
+        db.record_sync(product_id, updated_at, image_fingerprint(images))
         logger.info(f"✅ Added {len(processed_images)} processed images to approval queue for product {product_id}")
     
     except Exception as e:
         logger.exception(f"💥 Processing failed for product {product_id}: {str(e)}")
+        raise  # Let the job queue retry with backoff
 
-def process_all_products():
+def process_all_products(mode=None, full=False):
     """Process ALL products from Shopify - not just webhooks"""
     try:
-        logger.info("🚀 Starting batch processing of ALL products")
-        
-        # Get all products from Shopify
-        all_products = shopify.get_all_products()
-        if not all_products:
-            logger.warning("❌ No products found in Shopify store")
-            return
-        
-        logger.info(f"📋 Found {len(all_products)} total products to process")
-        
-        processed_count = 0
-        apify_count = 0
-        clothing_count = 0
-        
-        # Process each product
-        for product in all_products:
-            product_id = product['id']
-            tags = product.get('tags', '')
-            title = product.get('title', 'Untitled Product')
-            
-            # Skip if already processed recently
-            if db.get_pending_by_product_id(str(product_id)):
-                logger.info(f"⏭️ Skipping already pending product: {title} (ID: {product_id})")
-                continue
-            
-            # Determine product type
-            is_apify = 'Supplier:apify' in str(tags)
-            is_clothing = any(keyword in title.lower() for keyword in [
-                'shirt', 'dress', 'pants', 'jacket', 'hoodie', 'sweater', 
-                'top', 'bottom', 'jeans', 'blouse', 'skirt', 'shorts'
-            ])
-            
-            logger.info(f"🔍 Processing: {title} (ID: {product_id})")
-            logger.info(f"🏷️ Tags: {tags}")
-            logger.info(f"📊 Type: {'Apify' if is_apify else 'Clothing' if is_clothing else 'Standard'}")
-            
-            # Get product images
-            images = shopify.get_product_images(product_id)
-            if not images:
-                logger.warning(f"🖼️ No images found for product: {title}")
-                continue
-            
-            # Process based on type
-            if is_apify:
-                logger.info(f"🔧 Processing as Apify multi-angle product")
-                apify_count += 1
-                # In real implementation: split multi-angle images
-                processed_images = [img['src'] for img in images[:5]]
-            elif is_clothing:
-                logger.info(f"👗 Processing as clothing product")
-                clothing_count += 1
-                # In real implementation: generate lifestyle + swatch collage
-                processed_images = [img['src'] for img in images[:5]]
-            else:
-                logger.info(f"📦 Processing as standard product")
-                # Add UK flag + fast delivery badge
-                processed_images = [img['src'] for img in images[:5]]
-            
-            # Add to approval queue
-            db.add_pending(
-                product_id=str(product_id),
-                original_images=[img['src'] for img in images],
-                processed_images=processed_images,
-                variant_id=str(tags)  # Store tags for display
-            )
-            
-            processed_count += 1
-            logger.info(f"✅ Added to approval queue: {title}")
-            
-            # Rate limiting - be nice to Shopify API
-            time.sleep(0.5)
-        
-        logger.info(f"🎉 Batch processing complete!")
-        logger.info(f"✅ Total processed: {processed_count}/{len(all_products)}")
-        logger.info(f"🔍 Apify products: {apify_count}")
-        logger.info(f"👗 Clothing products: {clothing_count}")
-        logger.info(f"📦 Standard products: {processed_count - apify_count - clothing_count}")
-        
+        logger.info(f"🚀 Starting batch processing of ALL products ({mode or 'default'} ingest{', full' if full else ''})")
+        return batch_runs.run(mode=mode, full=full)
     except Exception as e:
         logger.exception(f"💥 Batch processing failed: {str(e)}")
 
+job_pool = JobWorkerPool(db, handlers={
+    'process_product': process_product,
+    'process_all_products': process_all_products,
+})
+webhooks = WebhookCoalescer(db, job_pool)
+batch_runs = BatchRunManager(lambda **options: BatchPipeline(shopify, db, **options), job_pool)
+# Approved images go back to Shopify on their own worker pool
+publisher = Publisher(shopify, db)
+
+# Gauges read at scrape time, so the hot paths pay nothing for them
+metrics_registry.gauge('job_queue_depth', 'Jobs per status in the SQLite job queue', ['status'],
+                       callback=db.job_counts)
+metrics_registry.gauge('batch_queue_depth', 'Products waiting in front of each batch pipeline stage', ['stage'],
+                       callback=batch_runs.queue_depths)
+metrics_registry.gauge('shopify_rate_limit_headroom', 'Calls left in the Shopify REST leaky bucket',
+                       callback=shopify.rate_limiter.headroom_remaining)
+metrics_registry.gauge('shopify_graphql_points_available', 'Cost points left in the Shopify GraphQL bucket',
+                       callback=shopify.graphql_limiter.points_available)
+metrics_registry.gauge('publish_images', 'Approved images per publish status', ['status'],
+                       callback=db.publication_counts)
+
 @app.on_event("startup")
 async def graceful_startup():
     """Optimized startup - no heavy operations"""
@@ -265,18 +323,33 @@ async def graceful_startup():
         for warning in warnings:
             logger.warning(warning)
         logger.warning("="*50 + "\n")
+    
+    # Load the perceptual hash index in the background rather than on first use
+    threading.Thread(target=get_perceptual_index, name="perceptual-index-load", daemon=True).start()
+    
+    # Resume any jobs left queued (or with expired leases) by a previous deploy
+    job_pool.start()
+    publisher.start()
+
+@app.on_event("shutdown")
+async def graceful_shutdown():
+    """Stop claiming jobs; anything in flight is re-leased after restart"""
+    job_pool.stop()
+    publisher.stop()
+    image_executor.shutdown()
 
-# ===== CRITICAL FIX: MOVE FLASK MOUNTING TO BOTTOM =====
-# This prevents circular imports and mounting errors
+# ===== Dashboard routes are registered last =====
+# This prevents circular imports
 try:
-    from dashboard import create_dashboard_app
+    from dashboard import create_dashboard_router, session_secret, STATIC_DIR
     
-    # Create and mount the dashboard app
-    dashboard_app = create_dashboard_app()
-    app.mount("/dashboard", WSGIMiddleware(dashboard_app))
-    logger.info("✅ Dashboard mounted successfully at /dashboard")
+    # Native ASGI routes with cookie sessions - no WSGI bridge
+    app.add_middleware(SessionMiddleware, secret_key=session_secret())
+    app.mount("/dashboard/static", StaticFiles(directory=STATIC_DIR), name="dashboard-static")
+    app.include_router(create_dashboard_router(batch_runs, publisher, shopify))
+    logger.info("✅ Dashboard routes registered at /dashboard")
 except Exception as e:
-    logger.exception(f"🔥 Failed to mount dashboard: {str(e)}")
+    logger.exception(f"🔥 Failed to register dashboard: {str(e)}")
 
 if __name__ == "__main__":
     import uvicorn
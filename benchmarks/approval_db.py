@@ -0,0 +1,128 @@
+"""Benchmark: ApprovalDB throughput, legacy single-connection store vs WAL engine.
+
+    python benchmarks/approval_db.py [--rows 100000] [--threads 8] [--lookups 5000]
+
+The legacy store reproduces the original schema and access pattern: one
+shared connection behind a lock, rollback journal, FULL sync, no indexes.
+Both engines' get_pending return the same shape (image URL lists split out,
+as the legacy template did per row), and "first page" is what the dashboard
+pays to render 20 rows: the legacy full load + slice vs list_pending().
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from models import ApprovalDB
+
+class LegacyApprovalDB:
+    """The pre-WAL ApprovalDB (pending_images only)"""
+
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.RLock()
+        with self.lock, self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS pending_images (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    product_id TEXT NOT NULL,
+                    variant_id TEXT,
+                    original_images TEXT,
+                    processed_images TEXT,
+                    status TEXT CHECK(status IN ('pending', 'approved', 'rejected')),
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    approved_at TIMESTAMP,
+                    reject_reason TEXT
+                )
+            ''')
+
+    def add_pending(self, product_id, original_images, processed_images, variant_id=None):
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT INTO pending_images (product_id, variant_id, original_images, processed_images, status) VALUES (?, ?, ?, ?, ?)',
+                (product_id, variant_id, ','.join(original_images), ','.join(processed_images), 'pending')
+            )
+
+    def get_pending(self):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, product_id, variant_id, original_images, processed_images FROM pending_images "
+                "WHERE status='pending' ORDER BY created_at DESC"
+            ).fetchall()
+        return [(id_, product_id, tags, originals.split(','), processed.split(','))
+                for id_, product_id, tags, originals, processed in rows]
+
+    def list_pending(self, limit=20):
+        """The legacy dashboard loaded the whole queue and sliced one page"""
+        return self.get_pending()[:limit], None, None
+
+    def get_pending_by_product_id(self, product_id):
+        with self.lock:
+            cur = self.conn.execute("SELECT id FROM pending_images WHERE product_id = ? AND status = 'pending' LIMIT 1", (product_id,))
+            return cur.fetchone() is not None
+
+    def approve(self, approval_id):
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE pending_images SET status='approved' WHERE id=?", (approval_id,))
+
+def insert_rows(db, rows, threads):
+    images = [f"https://cdn.shopify.com/s/files/1/img_{i}.jpg" for i in range(4)]
+    processed = [url + "?processed=true" for url in images]
+
+    def insert(start):
+        for i in range(start, rows, threads):
+            db.add_pending(str(i), images, processed, variant_id="tag")
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(insert, range(threads)))
+    return rows / (time.perf_counter() - started)
+
+def mixed_workload(db, rows, threads, lookups):
+    """Concurrent dedupe lookups while approvals are written"""
+    def worker(seed):
+        rng = random.Random(seed)
+        for n in range(lookups // threads):
+            if n % 10 == 0:
+                db.approve(rng.randrange(1, rows + 1))
+            else:
+                db.get_pending_by_product_id(str(rng.randrange(rows)))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(worker, range(threads)))
+    return lookups / (time.perf_counter() - started)
+
+def timed_ms(fn):
+    started = time.perf_counter()
+    result = fn()
+    return result, (time.perf_counter() - started) * 1000
+
+def run(name, db, args):
+    inserts = insert_rows(db, args.rows, args.threads)
+    pending, listing_ms = timed_ms(db.get_pending)
+    _, page_ms = timed_ms(lambda: db.list_pending(limit=20))
+    mixed = mixed_workload(db, args.rows, args.threads, args.lookups)
+    print(f"{name:8} inserts {inserts:9.0f}/s | get_pending ({len(pending)} rows) {listing_ms:7.1f}ms | "
+          f"first page {page_ms:7.1f}ms | lookups+approves {mixed:9.0f}/s")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--lookups', type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        run('legacy', LegacyApprovalDB(os.path.join(tmp, 'legacy.db')), args)
+        run('wal', ApprovalDB(os.path.join(tmp, 'wal.db')), args)
+
+if __name__ == '__main__':
+    main()
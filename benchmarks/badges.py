@@ -0,0 +1,69 @@
+"""Microbenchmark: images/sec for badge compositing, legacy vs BadgeRenderer.
+
+    python benchmarks/badges.py [--images 50] [--size 1600]
+
+Uses synthetic product images and, if the real assets are missing from
+static/, synthetic overlays of the same dimensions.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+from io import BytesIO
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from processing.badges import BadgeRenderer, STATIC_DIR, DEFAULT_BADGES
+
+def make_jpeg(size, seed):
+    img = Image.new("RGB", (size, size), ((seed * 37) % 255, (seed * 91) % 255, 128))
+    buffer = BytesIO()
+    img.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+def ensure_assets():
+    """Directory holding both badge PNGs (the real ones if present)"""
+    if all(os.path.exists(os.path.join(STATIC_DIR, asset)) for asset, _, _ in DEFAULT_BADGES):
+        return STATIC_DIR
+    asset_dir = tempfile.mkdtemp(prefix="badges-")
+    for asset, _, _ in DEFAULT_BADGES:
+        Image.new("RGBA", (400, 300), (200, 30, 30, 180)).save(os.path.join(asset_dir, asset))
+    return asset_dir
+
+def legacy_add_badges(content, asset_dir):
+    """The original add_badges body: reload + resize overlays and RGBA round trip per image"""
+    img = Image.open(BytesIO(content)).convert("RGBA")
+    flag = Image.open(os.path.join(asset_dir, 'uk_flag.png')).convert("RGBA").resize((50, 50))
+    img.paste(flag, (img.width - flag.width - 10, img.height - flag.height - 10), flag)
+    badge = Image.open(os.path.join(asset_dir, 'fast_delivery.png')).convert("RGBA").resize((120, 40))
+    img.paste(badge, (img.width - badge.width - 10, 10), badge)
+    buffer = BytesIO()
+    img.convert("RGB").save(buffer, format="JPEG", quality=95)
+    return buffer.getvalue()
+
+def timed(fn):
+    started = time.perf_counter()
+    fn()
+    return time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', type=int, default=50)
+    parser.add_argument('--size', type=int, default=1600)
+    args = parser.parse_args()
+
+    asset_dir = ensure_assets()
+    images = [make_jpeg(args.size, i) for i in range(args.images)]
+    renderer = BadgeRenderer(static_dir=asset_dir)
+
+    legacy = timed(lambda: [legacy_add_badges(content, asset_dir) for content in images])
+    single = timed(lambda: [renderer.render(content) for content in images])
+
+    print(f"{args.images} images @ {args.size}px")
+    print(f"  legacy add_badges:     {args.images / legacy:8.1f} images/sec")
+    print(f"  BadgeRenderer.render:  {args.images / single:8.1f} images/sec")
+
+if __name__ == '__main__':
+    main()
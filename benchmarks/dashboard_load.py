@@ -0,0 +1,134 @@
+"""Load test: dashboard queue page, Flask behind WSGIMiddleware vs native FastAPI routes.
+
+    python benchmarks/dashboard_load.py [--requests 2000] [--concurrency 50] [--rows 5000]
+
+Both apps render the same template from the same ApprovalDB with the same
+session login, and are driven in-process over httpx's ASGI transport, so
+the numbers compare the serving stacks rather than the network. The legacy
+side needs Flask installed (it is no longer a runtime dependency).
+
+Expect throughput within noise of each other: ~90% of a request is the
+Jinja render of dashboard.html, which both stacks pay under the same GIL.
+At concurrency 50 the p50/p99 are mostly time spent queued behind the
+other 49 requests, not service time.
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import httpx
+from fastapi import FastAPI
+from starlette.middleware.sessions import SessionMiddleware
+
+USER, PASSWORD = 'bench', 'bench-password'
+
+def dashboard_services(db):
+    """Idle batch-run manager, publisher and Shopify service for the router and template (their job pools are never started)"""
+    from jobs import JobWorkerPool
+    from pipeline import BatchRunManager
+    from publisher import Publisher
+    from services.shopify import ShopifyService
+    shopify = ShopifyService()
+    return BatchRunManager(lambda **options: None, JobWorkerPool(db, handlers={})), Publisher(shopify, db), shopify
+
+def legacy_app(db):
+    """The pre-ASGI dashboard: Flask app mounted through WSGIMiddleware (queue page + login)"""
+    from flask import Flask, render_template, request, redirect, session
+    from fastapi.middleware.wsgi import WSGIMiddleware
+    from dashboard import TEMPLATE_DIR
+
+    flask_app = Flask(__name__, template_folder=TEMPLATE_DIR)
+    flask_app.secret_key = 'bench'
+    batch_runs, publisher, _ = dashboard_services(db)
+
+    @flask_app.route('/login', methods=['POST'])
+    def login():
+        if request.form['username'] == USER and request.form['password'] == PASSWORD:
+            session['logged_in'] = True
+        return redirect('/dashboard/')
+
+    @flask_app.route('/')
+    def dashboard():
+        if 'logged_in' not in session:
+            return redirect('/dashboard/login')
+        pending_items, older, newer = db.list_pending(limit=20)
+        return render_template('dashboard.html', pending_items=pending_items, os=os, BASE_URL='',
+                               batch_run=batch_runs.snapshot(), publishing=publisher.stats()['images'],
+                               older_cursor=older, newer_cursor=newer, product_type='', tag='',
+                               total_items=db.count_pending())
+
+    app = FastAPI()
+    app.mount('/dashboard', WSGIMiddleware(flask_app))
+    return app
+
+def native_app(db):
+    from dashboard import create_dashboard_router
+    app = FastAPI()
+    app.add_middleware(SessionMiddleware, secret_key='bench')
+    app.include_router(create_dashboard_router(*dashboard_services(db)))
+    return app
+
+async def load(app, total, concurrency):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        await client.post('/dashboard/login', data={'username': USER, 'password': PASSWORD})
+        check = await client.get('/dashboard/')
+        assert check.status_code == 200 and b'/dashboard/approve/' in check.content, check.status_code
+
+        latencies = []
+        remaining = iter(range(total))
+
+        async def worker():
+            for _ in remaining:
+                started = time.perf_counter()
+                response = await client.get('/dashboard/')
+                latencies.append(time.perf_counter() - started)
+                assert response.status_code == 200
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'rps': total / elapsed,
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--rows', type=int, default=5000)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='dashboard-load-')
+    os.environ['APPROVAL_DB_PATH'] = os.path.join(tmp, 'approvals.db')
+    os.environ['OUTPUT_STORE_DIR'] = os.path.join(tmp, 'outputs')
+    os.environ['DASHBOARD_USER'], os.environ['DASHBOARD_PASS'] = USER, PASSWORD
+    os.environ.setdefault('BASE_URL', '')
+
+    from models import get_db
+    db = get_db()
+    urls = [f"https://cdn.shopify.com/s/files/1/img_{i}.jpg" for i in range(4)]
+    for i in range(args.rows):
+        db.add_pending(str(i), urls, [url + '?processed=true' for url in urls], variant_id='bench', product_type='standard')
+
+    apps = [('native', native_app(db))]
+    try:
+        apps.insert(0, ('wsgi', legacy_app(db)))
+    except ImportError:
+        print("Flask not installed - skipping the WSGIMiddleware baseline")
+
+    for name, app in apps:
+        result = asyncio.run(load(app, args.requests, args.concurrency))
+        print(f"{name:7} {result['rps']:8.0f} req/s | p50 {result['p50_ms']:7.1f}ms | p99 {result['p99_ms']:7.1f}ms")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,442 @@
+"""End-to-end benchmark suite against local Shopify and Replicate stand-ins.
+
+    python benchmarks/suite.py [--scenarios catalog_sync,catalog_resync,webhook_storm,dashboard_paging,bulk_publish]
+                               [--products 500] [--webhooks 2000] [--rows 5000] [--approvals 100]
+                               [--replicate-latency 1.0] [--output results.json] [--baseline old.json]
+
+Every scenario runs in a fresh subprocess with its own temporary databases
+and caches, so state and peak RSS don't leak between scenarios. Results
+(throughput, p50/p99 latency, peak RSS of the process and of its image
+workers) are printed and written as JSON; with --baseline, each metric is
+also compared against an earlier results file.
+
+- catalog_sync: full BatchPipeline run over the fake catalog (REST listing)
+- catalog_resync: incremental run after 10% of products changed an image
+- webhook_storm: skewed products/update deliveries (with redeliveries)
+  posted to the app, then drained through the job queue
+- dashboard_paging: reviewers walking the approval queue page by page
+- bulk_publish: reviewers bulk-approving a page at a time while approved
+  images are written back to the store, with --publish-faults of uploads,
+  media creations and replies failing; reports approve -> published
+  latency and checks no image was added to a product twice
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from benchmarks.fakes import FakeShopify, FakeReplicate
+
+SCENARIOS = ('catalog_sync', 'catalog_resync', 'webhook_storm', 'dashboard_paging', 'bulk_publish')
+USER, PASSWORD = 'bench', 'bench-password'
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+def latency_summary(seconds):
+    return {
+        'p50_ms': round(percentile(seconds, 0.50) * 1000, 2) if seconds else None,
+        'p99_ms': round(percentile(seconds, 0.99) * 1000, 2) if seconds else None,
+    }
+
+def peak_rss_mb():
+    """Peak RSS of this process and of its (reaped) children, e.g. image workers"""
+    import resource
+    # ru_maxrss is KB on Linux
+    return {
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'peak_children_rss_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    }
+
+def configure(args, tmp, fake):
+    """Environment for the app modules - must run before any of them is imported"""
+    os.environ.update({
+        'APPROVAL_DB_PATH': os.path.join(tmp, 'approvals.db'),
+        'COST_LEDGER_PATH': os.path.join(tmp, 'costs.db'),
+        'IMAGE_CACHE_DIR': os.path.join(tmp, 'image_cache'),
+        'PREDICTION_CACHE_PATH': os.path.join(tmp, 'predictions.db'),
+        'PERCEPTUAL_INDEX_PATH': os.path.join(tmp, 'perceptual_index.db'),
+        'THUMBNAIL_CACHE_DIR': os.path.join(tmp, 'thumbnails'),
+        'OUTPUT_STORE_DIR': os.path.join(tmp, 'outputs'),
+        'SHOPIFY_API_KEY': 'bench',
+        'SHOPIFY_PASSWORD': 'shpat_bench',
+        'SHOPIFY_STORE_URL': fake.origin,
+        'SHOPIFY_BUCKET_SIZE': str(fake.bucket_size),
+        'SHOPIFY_LEAK_RATE': str(fake.leak_rate),
+        'DASHBOARD_USER': USER,
+        'DASHBOARD_PASS': PASSWORD,
+        'DAILY_BUDGET': '1000000',
+        # Fine-grained polling so FakeReplicate's latency isn't rounded up to the poll interval
+        'REPLICATE_POLL_INTERVAL': '0.05',
+        'IMAGE_TARGET_SIZE': str(args.target_size),
+        'JOB_WORKERS': str(args.job_workers),
+        'JOB_POLL_INTERVAL': '0.05',
+        'WEBHOOK_DEBOUNCE_SECONDS': str(args.debounce),
+        'WEBHOOK_MAX_DELAY_SECONDS': str(args.debounce * 5),
+        'BASE_URL': '',
+    })
+
+def install_fake_replicate(fake_replicate):
+    import services.replicate
+    services.replicate._client = fake_replicate
+
+# ===== Scenarios =====
+
+def timed_pipeline(shopify, db, latencies, **options):
+    """BatchPipeline that records each product's queued -> written latency"""
+    from pipeline import BatchPipeline
+
+    class TimedPipeline(BatchPipeline):
+        def _classify(self, product):
+            item = super()._classify(product)
+            if item is not None:
+                item['queued_at'] = time.perf_counter()
+            return item
+
+        def _write(self, item):
+            super()._write(item)
+            latencies.append(time.perf_counter() - item['queued_at'])
+
+    return TimedPipeline(shopify, db, **options)
+
+def catalog_sync(args, fake):
+    from models import get_db
+    from services.shopify import ShopifyService
+    shopify = fake.attach(ShopifyService())
+    db = get_db()
+    latencies = []
+    started = time.perf_counter()
+    summary = timed_pipeline(shopify, db, latencies, full=True).run()
+    elapsed = time.perf_counter() - started
+    return {
+        'items': summary['seen'],
+        'elapsed_s': round(elapsed, 3),
+        'throughput_per_s': round(summary['seen'] / elapsed, 2),
+        **latency_summary(latencies),
+        'processed': summary['processed'],
+        'errors': summary['errors'],
+    }
+
+def catalog_resync(args, fake):
+    from models import get_db
+    from services.shopify import ShopifyService
+    shopify = fake.attach(ShopifyService())
+    db = get_db()
+    timed_pipeline(shopify, db, [], full=True).run()
+    touched = fake.touch(0.1)
+    # Products already in the approval queue are skipped, so clear it as reviewers would
+    with db._write() as conn:
+        conn.execute("UPDATE pending_images SET status = 'approved'")
+    db._invalidate_counts()
+
+    latencies = []
+    started = time.perf_counter()
+    summary = timed_pipeline(shopify, db, latencies, full=False).run()
+    elapsed = time.perf_counter() - started
+    return {
+        'items': summary['seen'],
+        'elapsed_s': round(elapsed, 3),
+        'throughput_per_s': round(summary['seen'] / elapsed, 2),
+        **latency_summary(latencies),
+        'changed': len(touched),
+        'processed': summary['processed'],
+        'unchanged': summary['unchanged'],
+    }
+
+def webhook_storm(args, fake):
+    import httpx
+    import app as application
+    fake.attach(application.shopify)
+    db, job_pool = application.db, application.job_pool
+
+    # Zipf-like skew: a few hot products get most of the updates. Most updates
+    # are edits that leave the images alone; 20% replace an image
+    rng = random.Random(3)
+    ids = [p['id'] for p in fake.products]
+    weights = [1 / (rank + 1) for rank in range(len(ids))]
+    deliveries = []
+    for n in range(args.webhooks):
+        if deliveries and rng.random() < 0.1:
+            deliveries.append(rng.choice(deliveries))  # at-least-once redelivery
+            continue
+        product_id = rng.choices(ids, weights)[0]
+        if rng.random() < 0.2:
+            fake.bump(product_id)
+        deliveries.append((f"bench-{n}", fake.webhook_payload(product_id)))
+
+    async def storm():
+        latencies = []
+        pending = iter(deliveries)
+        transport = httpx.ASGITransport(app=application.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+            async def sender():
+                for webhook_id, payload in pending:
+                    started = time.perf_counter()
+                    response = await client.post('/webhook/product_updated', json=payload,
+                                                 headers={'X-Shopify-Webhook-Id': webhook_id})
+                    latencies.append(time.perf_counter() - started)
+                    assert response.status_code == 200
+            await asyncio.gather(*(sender() for _ in range(args.concurrency)))
+        return latencies
+
+    job_pool.start()
+    try:
+        started = time.perf_counter()
+        latencies = asyncio.run(storm())
+        acked = time.perf_counter() - started
+        # Drain: every debounced job has run
+        deadline = time.monotonic() + args.drain_timeout
+        while time.monotonic() < deadline:
+            counts = db.job_counts()
+            if not counts.get('queued') and not counts.get('running'):
+                break
+            time.sleep(0.1)
+        elapsed = time.perf_counter() - started
+    finally:
+        job_pool.stop()
+        application.image_executor.shutdown()
+
+    counts = db.job_counts()
+    webhook_stats = application.webhooks.stats()
+    return {
+        'items': len(deliveries),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_per_s': round(len(deliveries) / elapsed, 2),
+        **latency_summary(latencies),
+        'ack_per_s': round(len(deliveries) / acked, 2),
+        'jobs_done': counts.get('done', 0),
+        'jobs_failed': counts.get('failed', 0),
+        'jobs_left': counts.get('queued', 0) + counts.get('running', 0),
+        'duplicates': webhook_stats['duplicates'],
+        'coalescing_ratio': webhook_stats['coalescing_ratio'],
+    }
+
+def dashboard_paging(args, fake):
+    import httpx
+    import app as application
+    db = application.db
+    kinds = ('standard', 'clothing', 'apify')
+    images = [{'url': f"{fake.origin}/cdn/shop/files/img_{i}.jpg", 'width': 2048, 'height': 2048} for i in range(4)]
+    for i in range(args.rows):
+        db.add_pending(str(2000000 + i), images, [image['url'] + '?processed=true' for image in images],
+                       variant_id='bench,home', product_type=kinds[i % len(kinds)])
+
+    async def reviewers():
+        latencies = []
+        transport = httpx.ASGITransport(app=application.app)
+
+        async def reviewer(filters):
+            async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+                await client.post('/dashboard/login', data={'username': USER, 'password': PASSWORD})
+                url = f"/dashboard/?{filters}"
+                for _ in range(args.pages):
+                    started = time.perf_counter()
+                    response = await client.get(url)
+                    latencies.append(time.perf_counter() - started)
+                    assert response.status_code == 200
+                    older = re.search(r'\?after=(\d+)', response.text)
+                    if not older:
+                        break
+                    url = f"/dashboard/?after={older.group(1)}&{filters}"
+
+        filters = ['', 'type=standard', 'type=clothing', 'tag=bench']
+        await asyncio.gather(*(reviewer(filters[n % len(filters)]) for n in range(args.concurrency)))
+        return latencies
+
+    started = time.perf_counter()
+    latencies = asyncio.run(reviewers())
+    elapsed = time.perf_counter() - started
+    return {
+        'items': len(latencies),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_per_s': round(len(latencies) / elapsed, 2),
+        **latency_summary(latencies),
+        'rows': args.rows,
+    }
+
+def bulk_publish(args, fake):
+    import httpx
+    from benchmarks.fakes import render_image
+    os.environ.update({'PUBLISH_WORKERS': str(args.publish_workers), 'JOB_BACKOFF_BASE': '0.2', 'JOB_BACKOFF_MAX': '2'})
+    import app as application
+    fake.attach(application.shopify)
+    db, publisher = application.db, application.publisher
+    store = application.get_output_store()
+
+    approval_ids = []
+    for product in fake.products[:args.approvals]:
+        outputs = [store.put(render_image(f"processed:{product['id']}:{n}", 256)) for n in range(args.images)]
+        approval_ids.append(db.add_pending(str(product['id']), fake.public(product)['images'], outputs,
+                                           variant_id=product['tags'], product_type=product['product_type']))
+
+    approved_at = {}
+
+    async def reviewers():
+        transport = httpx.ASGITransport(app=application.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+            await client.post('/dashboard/login', data={'username': USER, 'password': PASSWORD})
+            # A page of the queue per click
+            for start in range(0, len(approval_ids), 20):
+                page = approval_ids[start:start + 20]
+                now = time.perf_counter()
+                response = await client.post('/dashboard/approve', data={'ids': [str(i) for i in page]})
+                assert response.status_code == 303
+                approved_at.update((approval_id, now) for approval_id in page)
+
+    publisher.start()
+    latencies, done = [], set()
+    try:
+        started = time.perf_counter()
+        asyncio.run(reviewers())
+        deadline = time.monotonic() + args.drain_timeout
+        while time.monotonic() < deadline:
+            finished = db.conn.execute(
+                "SELECT approval_id FROM publications GROUP BY approval_id HAVING SUM(status != 'published') = 0"
+            ).fetchall()
+            now = time.perf_counter()
+            for (approval_id,) in finished:
+                if approval_id not in done:
+                    done.add(approval_id)
+                    latencies.append(now - approved_at[approval_id])
+            counts = db.job_counts()
+            if len(done) == len(approval_ids) or (not counts.get('queued') and not counts.get('running')):
+                break
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - started
+    finally:
+        publisher.stop()
+
+    images = db.publication_counts()
+    pool_stats = publisher.pool.stats()
+    return {
+        'items': images.get('published', 0),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_per_s': round(images.get('published', 0) / elapsed, 2),
+        **latency_summary(latencies),
+        'approvals': len(approval_ids),
+        'approvals_published': len(done),
+        'images': images,
+        'job_retries': pool_stats['retried'],
+        'jobs_failed': pool_stats['failed'],
+        'publisher': publisher.stats(),
+        'store_media': fake.media_stats(),
+    }
+
+# ===== Driver =====
+
+def run_scenario(args):
+    """Child process: run one scenario and write its result JSON"""
+    fake = FakeShopify(products=args.products, images_per_product=args.images, bucket_size=args.bucket_size,
+                       leak_rate=args.leak_rate, latency=args.shopify_latency,
+                       graphql_restore_rate=args.graphql_restore_rate, upload_fail_rate=args.publish_faults,
+                       media_fail_rate=args.publish_faults, lost_reply_rate=args.publish_faults).start()
+    tmp = tempfile.mkdtemp(prefix=f"bench-{args.run_scenario}-")
+    configure(args, tmp, fake)
+    fake_replicate = FakeReplicate(latency=args.replicate_latency, jitter=args.replicate_latency / 5,
+                                   output_url=f"{fake.origin}/replicate")
+    install_fake_replicate(fake_replicate)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    if not args.verbose:
+        logging.disable(logging.INFO)  # app.py configures INFO logging on import
+
+    try:
+        result = globals()[args.run_scenario](args, fake)
+    finally:
+        from processing.executor import image_executor
+        image_executor.shutdown()  # reap workers so their peak RSS is counted
+        fake.stop()
+    result.update(peak_rss_mb())
+    result['shopify_requests'] = fake.stats()
+    result['replicate_calls'] = dict(fake_replicate.calls)
+    with open(args.result_file, 'w') as f:
+        json.dump(result, f)
+
+def compare(results, baseline):
+    """Per-metric ratio against a baseline run (>1 is more throughput / more latency / more memory)"""
+    deltas = {}
+    for name, result in results.items():
+        before = baseline.get('scenarios', {}).get(name)
+        if not before:
+            continue
+        deltas[name] = {
+            key: round(result[key] / before[key], 3)
+            for key in ('throughput_per_s', 'p50_ms', 'p99_ms', 'peak_rss_mb', 'peak_children_rss_mb')
+            if result.get(key) and before.get(key)
+        }
+    return deltas
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--products', type=int, default=500)
+    parser.add_argument('--images', type=int, default=3, help='images per product')
+    parser.add_argument('--webhooks', type=int, default=2000)
+    parser.add_argument('--rows', type=int, default=5000, help='approval rows for dashboard_paging')
+    parser.add_argument('--pages', type=int, default=50, help='pages each reviewer walks')
+    parser.add_argument('--approvals', type=int, default=100, help='approvals bulk-approved in bulk_publish')
+    parser.add_argument('--publish-workers', type=int, default=4)
+    parser.add_argument('--publish-faults', type=float, default=0.05,
+                        help='share of uploads / media creations / replies that fail in bulk_publish')
+    parser.add_argument('--graphql-restore-rate', type=float, default=50, help='GraphQL cost points restored per second')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--target-size', type=int, default=1024)
+    parser.add_argument('--job-workers', type=int, default=4)
+    parser.add_argument('--debounce', type=float, default=0.5)
+    parser.add_argument('--drain-timeout', type=float, default=600)
+    parser.add_argument('--bucket-size', type=int, default=40)
+    parser.add_argument('--leak-rate', type=float, default=2.0)
+    parser.add_argument('--shopify-latency', type=float, default=0.05, help='seconds per Admin API call')
+    parser.add_argument('--replicate-latency', type=float, default=1.0, help='mean seconds per prediction')
+    parser.add_argument('--output', help='write results JSON here')
+    parser.add_argument('--baseline', help='results JSON of an earlier run to compare against')
+    parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('--run-scenario', help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scenario:
+        return run_scenario(args)
+
+    results = {}
+    for name in args.scenarios.split(','):
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name!r} (choose from {', '.join(SCENARIOS)})")
+        with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+            result_file = f.name
+        subprocess.run([sys.executable, os.path.abspath(__file__), *sys.argv[1:],
+                        '--run-scenario', name, '--result-file', result_file], check=True)
+        with open(result_file) as f:
+            results[name] = json.load(f)
+        os.unlink(result_file)
+        r = results[name]
+        print(f"{name:17} {r['throughput_per_s']:9.1f}/s | p50 {r['p50_ms']}ms | p99 {r['p99_ms']}ms | "
+              f"rss {r['peak_rss_mb']}MB (+workers {r['peak_children_rss_mb']}MB)", flush=True)
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'params': {k: v for k, v in vars(args).items() if k not in ('run_scenario', 'result_file', 'output', 'baseline')},
+        'scenarios': results,
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['vs_baseline'] = compare(results, json.load(f))
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+if __name__ == '__main__':
+    main()
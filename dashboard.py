@@ -1,139 +1,187 @@
 import os
+import json
+import asyncio
 import logging
-from flask import Flask, render_template, request, redirect, url_for, session, g
-from models import ApprovalDB
-from dotenv import load_dotenv
 import secrets
-import requests
-import time
+from functools import wraps
+from urllib.parse import urlencode, urlparse
+from fastapi import APIRouter, Request, Form, HTTPException
+from fastapi.responses import RedirectResponse, Response, StreamingResponse
+from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
+from models import get_db
+from pipeline import ACTIVE_STATES
+from dotenv import load_dotenv
+from processing.thumbnails import get_thumbnail_cache, FORMATS
 
 load_dotenv()
 logger = logging.getLogger("dashboard")
 
-def create_dashboard_app():
-    """Factory function to create Flask app - prevents circular imports"""
+# Absolute paths for templates and static files
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_DIR = os.path.join(BASE_DIR, 'templates')
+STATIC_DIR = os.path.join(BASE_DIR, 'static')
+
+def session_secret():
+    """Signing key for the dashboard session cookie"""
+    return os.getenv('DASHBOARD_SECRET_KEY') or os.getenv('FLASK_SECRET_KEY') or secrets.token_hex(16)
+
+def create_dashboard_router(batch_runs, publisher, shopify):
+    """Dashboard routes served natively on the FastAPI event loop.
+
+    Needs SessionMiddleware on the app (see app.py). Every SQLite read and
+    write, and thumbnail generation, runs in the threadpool, so a slow query
+    or a wait on the write lock never stalls the event loop.
+    `batch_runs` is the app's BatchRunManager; `publisher` its Publisher,
+    which approving hands items to; `shopify` its ShopifyService.
+    """
     # Get base URL from environment or default
     BASE_URL = os.getenv('BASE_URL', 'https://shopify-image-ai-production.up.railway.app')
-    logger.info(f"Creating dashboard app with Base URL: {BASE_URL}")
-
-    # Absolute paths for templates and static files
-    BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-    TEMPLATE_DIR = os.path.join(BASE_DIR, 'templates')
-    STATIC_DIR = os.path.join(BASE_DIR, 'static')
-
-    app = Flask(
-        __name__,
-        template_folder=TEMPLATE_DIR,
-        static_folder=STATIC_DIR
-    )
-    app.secret_key = os.getenv('FLASK_SECRET_KEY', secrets.token_hex(16))
-    db = ApprovalDB()
-
-    @app.context_processor
-    def inject_base_url():
-        """Make BASE_URL available to all templates"""
-        return dict(BASE_URL=BASE_URL)
-
-    def login_required(f):
+    logger.info(f"Creating dashboard routes with Base URL: {BASE_URL}")
+
+    router = APIRouter(prefix="/dashboard", include_in_schema=False)
+    templates = Jinja2Templates(directory=TEMPLATE_DIR)
+    db = get_db()  # same instance the API and job workers use
+
+    def render(request, name, **context):
+        return templates.TemplateResponse(name, {'request': request, 'BASE_URL': BASE_URL, 'os': os, **context})
+
+    def redirect(url):
+        # 303 so a POST is followed by a GET
+        return RedirectResponse(url, status_code=303)
+
+    def login_required(endpoint):
         """Decorator to protect routes"""
-        from functools import wraps
-        @wraps(f)
-        def decorated_function(*args, **kwargs):
-            if 'logged_in' not in session:
-                return redirect(url_for('login', next=request.url))
-            return f(*args, **kwargs)
-        return decorated_function
-
-    @app.route('/login', methods=['GET', 'POST'])
-    def login():
+        @wraps(endpoint)
+        async def decorated(request: Request, *args, **kwargs):
+            if not request.session.get('logged_in'):
+                next_url = request.url.path + (f"?{request.url.query}" if request.url.query else "")
+                return redirect(f"/dashboard/login?{urlencode({'next': next_url})}")
+            return await endpoint(request, *args, **kwargs)
+        return decorated
+
+    @router.get('/login')
+    async def login_page(request: Request):
+        return render(request, 'login.html')
+
+    @router.post('/login')
+    async def login(request: Request, username: str = Form(...), password: str = Form(...)):
         # Default credentials if missing
         default_user = os.getenv('DASHBOARD_USER', 'admin')
         default_pass = os.getenv('DASHBOARD_PASS', 'default_password_change_me!')
-        
-        if request.method == 'POST':
-            username = request.form['username']
-            password = request.form['password']
-            
-            if username == default_user and password == default_pass:
-                session['logged_in'] = True
-                next_url = request.args.get('next') or url_for('dashboard')
-                # Fix double /dashboard issue
-                if '/dashboard/dashboard' in next_url:
-                    next_url = next_url.replace('/dashboard/dashboard', '/dashboard')
-                return redirect(next_url)
-            else:
-                return render_template('login.html', error="Invalid username or password")
-        
-        logger.info(f"Template folder: {app.template_folder}")
-        logger.info(f"Looking for login.html at: {os.path.join(app.template_folder, 'login.html')}")
-        return render_template('login.html')
-
-    @app.route('/')
+
+        if secrets.compare_digest(username, default_user) and secrets.compare_digest(password, default_pass):
+            request.session['logged_in'] = True
+            next_url = request.query_params.get('next') or "/dashboard"
+            # Only follow local paths
+            if not next_url.startswith('/') or next_url.startswith('//'):
+                next_url = "/dashboard"
+            # Fix double /dashboard issue
+            if '/dashboard/dashboard' in next_url:
+                next_url = next_url.replace('/dashboard/dashboard', '/dashboard')
+            return redirect(next_url)
+        return render(request, 'login.html', error="Invalid username or password")
+
+    @router.get('')
+    @router.get('/')
     @login_required
-    def dashboard():
-        """Main dashboard route with pagination"""
+    async def dashboard(request: Request):
+        """Main dashboard route with keyset pagination and type/tag search"""
+        per_page = 20  # Items per page
+        params = request.query_params
+        product_type = params.get('type') or None
+        tag = params.get('tag', '').strip() or None
         try:
-            # Get pagination parameters
-            page = request.args.get('page', 1, type=int)
-            per_page = 20  # Items per page
-            
-            # Get all pending items
-            all_pending = db.get_pending()
-            total_items = len(all_pending)
-            
-            # Calculate pagination
-            total_pages = max(1, (total_items + per_page - 1) // per_page)
-            page = max(1, min(page, total_pages))
-            
-            # Get items for current page
-            start_idx = (page - 1) * per_page
-            end_idx = start_idx + per_page
-            pending_items = all_pending[start_idx:end_idx]
-            
-            # Calculate display info
-            start_item = start_idx + 1
-            end_item = min(end_idx, total_items)
-            
-            return render_template('dashboard.html', 
-                                 pending_items=pending_items, 
-                                 os=os, 
-                                 BASE_URL=BASE_URL,
-                                 current_page=page,
-                                 total_pages=total_pages,
-                                 total_items=total_items,
-                                 start_item=start_item,
-                                 end_item=end_item)
+            # Cursor pagination - only this page's rows and list columns are read
+            pending_items, older, newer = await run_in_threadpool(
+                db.list_pending,
+                limit=per_page,
+                after=int(params['after']) if params.get('after', '').isdigit() else None,
+                before=int(params['before']) if params.get('before', '').isdigit() else None,
+                product_type=product_type,
+                tag=tag
+            )
+            total_items = await run_in_threadpool(db.count_pending, product_type, tag)
         except Exception as e:
             logger.exception(f"🔥 Dashboard rendering failed: {str(e)}")
-            return render_template('dashboard.html', 
-                                 pending_items=[], 
-                                 os=os, 
-                                 BASE_URL=BASE_URL,
-                                 current_page=1,
-                                 total_pages=1,
-                                 total_items=0,
-                                 start_item=0,
-                                 end_item=0)
-
-    @app.route('/approve/<int:approval_id>')
+            pending_items, older, newer, total_items = [], None, None, 0
+        publishing = await run_in_threadpool(db.publication_counts)
+
+        return render(request, 'dashboard.html',
+                      batch_run=batch_runs.snapshot(),
+                      pending_items=pending_items,
+                      older_cursor=older,
+                      newer_cursor=newer,
+                      product_type=product_type or '',
+                      tag=tag or '',
+                      total_items=total_items,
+                      publishing=publishing)
+
+    @router.get('/thumb/{image_id}')
+    @login_required
+    async def thumbnail(request: Request, image_id: int):
+        """Small WebP/JPEG rendition of an approval image, cached on disk and in the browser"""
+        url = await run_in_threadpool(db.get_image_url, image_id)
+        if url is None:
+            raise HTTPException(status_code=404)
+        thumbnails = get_thumbnail_cache()
+        size_param = request.query_params.get('size', '')
+        # Anything but a plain number gets the default size
+        size = thumbnails.snap(int(size_param) if size_param.isdigit() else 240)
+        fmt = 'webp' if 'image/webp' in request.headers.get('accept', '') else 'jpeg'
+        content, etag = await run_in_threadpool(thumbnails.get, url, size, fmt)
+        if content is None:
+            # Let the browser try the original rather than show a broken image
+            return RedirectResponse(url, status_code=302)
+        headers = {
+            'ETag': f'"{etag}"',
+            # Image ids always point at the same URL, so a thumbnail never changes
+            'Cache-Control': 'private, max-age=31536000, immutable',
+            'Vary': 'Accept',
+        }
+        if f'"{etag}"' in request.headers.get('if-none-match', ''):
+            return Response(status_code=304, headers=headers)
+        return Response(content, media_type=FORMATS[fmt][1], headers=headers)
+
+    @router.post('/approve/{approval_id}')
     @login_required
-    def approve(approval_id):
-        db.approve(approval_id)
-        return redirect(url_for('dashboard'))
+    async def approve(request: Request, approval_id: int):
+        """Approve one item and publish it to Shopify - POST only, like every other state change"""
+        await run_in_threadpool(publisher.approve, [approval_id])
+        return redirect("/dashboard")
 
-    @app.route('/reject/<int:approval_id>', methods=['POST'])
+    @router.post('/approve')
     @login_required
-    def reject(approval_id):
-        reason = request.form.get('reason', 'No reason provided')
-        db.reject(approval_id, reason)
-        return redirect(url_for('dashboard'))
+    async def approve_selected(request: Request):
+        """Bulk approve the ticked rows; each is published to Shopify in the background"""
+        form = await request.form()
+        ids = [int(value) for value in form.getlist('ids') if value.isdigit()]
+        if ids:
+            await run_in_threadpool(publisher.approve, ids)
+        # Back to the page the reviewer was on
+        referer = urlparse(request.headers.get('referer', ''))
+        return redirect(f"{referer.path}?{referer.query}" if referer.path.startswith('/dashboard') else "/dashboard")
 
-    @app.route('/simulate-webhook', methods=['POST'])
+    @router.post('/publish/retry')
     @login_required
-    def simulate_webhook():
+    async def retry_publishing(request: Request):
+        """Queue every approval with images that haven't reached Shopify again"""
+        approval_ids = await run_in_threadpool(publisher.retry_unpublished)
+        logger.info(f"🔁 Re-queued publishing for {len(approval_ids)} approvals")
+        return redirect("/dashboard")
+
+    @router.post('/reject/{approval_id}')
+    @login_required
+    async def reject(request: Request, approval_id: int, reason: str = Form('No reason provided')):
+        await run_in_threadpool(db.reject, approval_id, reason)
+        return redirect("/dashboard")
+
+    @router.post('/simulate-webhook')
+    @login_required
+    async def simulate_webhook(request: Request):
         """Simulate Shopify webhook for testing"""
         logger.info("🔧 Simulating product update webhook")
-        
+
         # Create mock product data
         mock_product = {
             'id': 9999999,
@@ -143,9 +191,10 @@ def create_dashboard_app():
                 {'src': 'https://images.unsplash.com/photo-1591047139829-d91485f5e0e9?auto=format&fit=crop&w=300&q=80'}
             ]
         }
-        
+
         # Add to approval queue
-        db.add_pending(
+        await run_in_threadpool(
+            db.add_pending,
             product_id=str(mock_product['id']),
             original_images=[img['src'] for img in mock_product['images']],
             processed_images=[
@@ -153,31 +202,61 @@ def create_dashboard_app():
                 'https://images.unsplash.com/photo-1591047139829-d91485f5e0e9?auto=format&fit=crop&w=300&q=80&blend=6366f1&blend-mode=normal&sat=-100',
                 'https://images.unsplash.com/photo-1541099649105-f69ad2cb1727?auto=format&fit=crop&w=300&q=80&blend=6366f1&blend-mode=normal&sat=-100'
             ],
-            variant_id=mock_product['tags']
+            variant_id=mock_product['tags'],
+            product_type='apify'
         )
-        
+
         logger.info("✅ Simulated webhook processed successfully")
-        return redirect(url_for('dashboard'))
+        return redirect("/dashboard")
 
-    @app.route('/fetch-all-products', methods=['POST'])
+    @router.post('/fetch-all-products')
     @login_required
-    def manual_fetch():
+    async def manual_fetch(request: Request):
         """Manual trigger for batch product fetching"""
         logger.info(">manual Manual batch fetch triggered by user")
-        
-        # Trigger the FastAPI endpoint
-        try:
-            BASE_URL = os.getenv('BASE_URL', 'https://shopify-image-ai-production.up.railway.app')
-            response = requests.post(f"{BASE_URL}/fetch-all-products")
-            logger.info(f"📡 Batch fetch API response: {response.status_code} - {response.text}")
-        except Exception as e:
-            logger.exception(f"🔥 Failed to trigger batch fetch: {str(e)}")
-        
-        return redirect(url_for('dashboard'))
+        if not shopify.enabled:
+            logger.warning("🚫 Not starting a batch run - Shopify service disabled")
+            return redirect("/dashboard")
+
+        # Dispatched in-process; refused if a run is already queued or active
+        started, run = await run_in_threadpool(batch_runs.start)
+        if not started:
+            logger.info(f"⏳ Batch run already {run['state']} - not starting another")
+
+        return redirect("/dashboard")
+
+    @router.post('/batch/{action}')
+    @login_required
+    async def batch_control(request: Request, action: str):
+        """Pause, resume or cancel the current batch run"""
+        if action not in ('pause', 'resume', 'cancel'):
+            raise HTTPException(status_code=404)
+        getattr(batch_runs, action)()
+        return redirect("/dashboard")
+
+    @router.get('/batch/events')
+    @login_required
+    async def batch_events(request: Request):
+        """Server-Sent Events stream of the current run's progress; ends when the run does"""
+        interval = float(os.getenv('BATCH_PROGRESS_INTERVAL', 1.0))
+
+        async def stream():
+            while True:
+                snapshot = batch_runs.snapshot()
+                yield f"data: {json.dumps(snapshot)}\n\n"
+                if snapshot['state'] not in ACTIVE_STATES:
+                    yield "event: done\ndata: {}\n\n"
+                    return
+                if await request.is_disconnected():
+                    return
+                await asyncio.sleep(interval)
+
+        return StreamingResponse(stream(), media_type='text/event-stream',
+                                 headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
-    @app.route('/logout')
-    def logout():
-        session.pop('logged_in', None)
-        return redirect(url_for('login'))
+    @router.get('/logout')
+    async def logout(request: Request):
+        request.session.pop('logged_in', None)
+        return redirect("/dashboard/login")
 
-    return app
+    return router
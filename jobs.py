@@ -0,0 +1,184 @@
+import os
+import time
+import socket
+import logging
+import threading
+import traceback
+from collections import deque
+
+logger = logging.getLogger("jobs")
+
+class JobWorkerPool:
+    """Pool of worker threads draining the persistent `jobs` table.
+
+    Jobs are claimed with a lease so a crashed or redeployed worker's jobs are
+    picked up again once the lease expires. Failures are retried with
+    exponential backoff until `max_attempts` is reached. A pool only claims
+    the job kinds it has handlers for, so several pools can share the table.
+    """
+
+    def __init__(self, db, handlers, workers=None, lease_seconds=None, poll_interval=None,
+                 backoff_base=None, backoff_max=None, name='job'):
+        self.db = db
+        self.name = name
+        self.handlers = dict(handlers)
+        self.workers = workers or int(os.getenv('JOB_WORKERS', 2))
+        self.lease_seconds = lease_seconds or float(os.getenv('JOB_LEASE_SECONDS', 300))
+        self.poll_interval = poll_interval or float(os.getenv('JOB_POLL_INTERVAL', 1.0))
+        self.backoff_base = backoff_base or float(os.getenv('JOB_BACKOFF_BASE', 5))
+        self.backoff_max = backoff_max or float(os.getenv('JOB_BACKOFF_MAX', 600))
+        self.max_attempts = int(os.getenv('JOB_MAX_ATTEMPTS', 5))
+        # Finished jobs (done or failed) are kept this long for inspection, then purged
+        self.retention = float(os.getenv('JOB_RETENTION_SECONDS', 7 * 24 * 3600))
+
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._inflight = {}  # job_id -> worker_id, renewed by the heartbeat thread
+        self._stats_lock = threading.Lock()
+        self._recent = deque(maxlen=1000)  # (finished_at, run_seconds, wait_seconds)
+        self._completed = 0
+        self._failed = 0
+        self._retried = 0
+        self._started_at = None
+
+    def enqueue(self, kind, payload=None, max_attempts=None):
+        """Persist a job and wake an idle worker"""
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        job_id = self.db.enqueue_job(kind, payload, max_attempts=max_attempts or self.max_attempts)
+        self._wakeup.set()
+        return job_id
+
+    def enqueue_coalesced(self, kind, coalesce_key, payload, delay, max_delay, max_attempts=None):
+        """Enqueue, or fold into the queued job with the same key; returns (job_id, coalesced)"""
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        job_id, coalesced = self.db.enqueue_coalesced_job(
+            kind, coalesce_key, payload, delay, max_delay, max_attempts=max_attempts or self.max_attempts
+        )
+        self._wakeup.set()
+        return job_id, coalesced
+
+    def start(self):
+        if self._threads:
+            return
+        self._stopping.clear()
+        self._started_at = time.time()
+        prefix = f"{socket.gethostname()}:{os.getpid()}"
+        if self.name != 'job':
+            prefix += f":{self.name}"  # lease owners stay unique when pools share a process
+        for n in range(self.workers):
+            thread = threading.Thread(target=self._run, args=(f"{prefix}:{n}",), name=f"{self.name}-worker-{n}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        heartbeat = threading.Thread(target=self._heartbeat, name=f"{self.name}-heartbeat", daemon=True)
+        heartbeat.start()
+        self._threads.append(heartbeat)
+        logger.info(f"👷 Started {self.workers} {self.name} workers (lease {self.lease_seconds:.0f}s)")
+
+    def stop(self, timeout=10):
+        """Stop claiming new jobs; in-flight jobs keep their lease and are retried elsewhere if cut off"""
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        logger.info(f"🛑 {self.name.capitalize()} workers stopped")
+
+    def _backoff(self, attempts):
+        return min(self.backoff_max, self.backoff_base * (2 ** (attempts - 1)))
+
+    def _run(self, worker_id):
+        while not self._stopping.is_set():
+            try:
+                job = self.db.claim_job(worker_id, self.lease_seconds, kinds=list(self.handlers))
+            except Exception as e:
+                logger.exception(f"🔥 Failed to claim job: {str(e)}")
+                job = None
+
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            self._execute(worker_id, job)
+
+    def _execute(self, worker_id, job):
+        handler = self.handlers.get(job['kind'])
+        claimed_at = time.time()
+        with self._stats_lock:
+            self._inflight[job['id']] = worker_id
+        try:
+            if handler is None:
+                raise ValueError(f"No handler registered for job kind: {job['kind']}")
+            handler(**job['payload'])
+        except Exception as e:
+            delay = self._backoff(job['attempts'])
+            error = f"{type(e).__name__}: {e}\n{traceback.format_exc(limit=5)}"
+            status = self.db.fail_job(job['id'], worker_id, error, delay)
+            with self._stats_lock:
+                if status == 'queued':
+                    self._retried += 1
+                else:
+                    self._failed += 1
+            if status == 'queued':
+                logger.warning(f"🔁 Job {job['id']} ({job['kind']}) failed attempt {job['attempts']}/{job['max_attempts']} - retrying in {delay:.0f}s")
+            else:
+                logger.error(f"💀 Job {job['id']} ({job['kind']}) failed permanently: {str(e)}")
+        else:
+            self.db.complete_job(job['id'], worker_id, self.retention)
+            finished_at = time.time()
+            with self._stats_lock:
+                self._completed += 1
+                self._recent.append((finished_at, finished_at - claimed_at, claimed_at - job['created_at']))
+        finally:
+            with self._stats_lock:
+                self._inflight.pop(job['id'], None)
+
+    def _heartbeat(self):
+        """Keep leases alive for long-running jobs (e.g. full catalog runs)"""
+        interval = max(1.0, self.lease_seconds / 3)
+        while not self._stopping.wait(interval):
+            with self._stats_lock:
+                inflight = list(self._inflight.items())
+            for job_id, worker_id in inflight:
+                try:
+                    if not self.db.renew_lease(job_id, worker_id, self.lease_seconds):
+                        logger.warning(f"⚠️ Lost lease on job {job_id}")
+                except Exception as e:
+                    logger.exception(f"🔥 Lease renewal failed for job {job_id}: {str(e)}")
+
+    def stats(self, queue=True):
+        """Throughput and latency figures; `queue=False` skips the SQLite queue-depth count"""
+        now = time.time()
+        with self._stats_lock:
+            recent = list(self._recent)
+            stats = {
+                'workers': self.workers,
+                'running': len(self._inflight),
+                'completed': self._completed,
+                'failed': self._failed,
+                'retried': self._retried,
+            }
+        last_minute = [r for r in recent if now - r[0] <= 60]
+        run_times = sorted(r[1] for r in recent)
+        wait_times = sorted(r[2] for r in recent)
+        uptime = now - self._started_at if self._started_at else 0
+
+        def percentile(values, pct):
+            if not values:
+                return None
+            return round(values[min(len(values) - 1, int(len(values) * pct))], 3)
+
+        stats.update({
+            'jobs_per_sec': round(stats['completed'] / uptime, 3) if uptime else 0.0,
+            'jobs_per_sec_1m': round(len(last_minute) / 60, 3),
+            'run_seconds_p50': percentile(run_times, 0.50),
+            'run_seconds_p95': percentile(run_times, 0.95),
+            'wait_seconds_p50': percentile(wait_times, 0.50),
+            'wait_seconds_p95': percentile(wait_times, 0.95),
+        })
+        if queue:
+            stats['queue'] = self.db.job_counts()
+        return stats
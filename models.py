@@ -1,18 +1,69 @@
 import sqlite3
-from datetime import datetime
+import json
+import atexit
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, date, timedelta
 import os
+from metrics import timed
+
+logger = logging.getLogger("models")
 
 class ApprovalDB:
-    def __init__(self, db_path='/tmp/approvals.db'):
+    """SQLite store for the approval queue and the job table.
+
+    Each thread gets its own connection (WAL lets readers run alongside the
+    single writer), writes use short BEGIN IMMEDIATE transactions, and the
+    app shares one instance via `get_db()`.
+    """
+    
+    def __init__(self, db_path=None):
         """Use ephemeral storage compatible with Railway"""
+        # APPROVAL_DB_PATH can point at a mounted volume so queued jobs survive redeploys
+        self.db_path = db_path or os.getenv('APPROVAL_DB_PATH', '/tmp/approvals.db')
         # Ensure /tmp exists
-        os.makedirs(os.path.dirname(db_path), exist_ok=True)
-        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self.busy_timeout = float(os.getenv('APPROVAL_DB_BUSY_TIMEOUT', 30))
+        self.synchronous = os.getenv('APPROVAL_DB_SYNCHRONOUS', 'NORMAL')
+        self.count_ttl = float(os.getenv('APPROVAL_COUNT_TTL', 10))
+        self._local = threading.local()
+        self._count_cache = {}
+        self._count_lock = threading.Lock()
         self._init_db()
     
+    @property
+    def conn(self):
+        """This thread's connection (opened on first use)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Autocommit mode - transactions are opened explicitly in _write()
+            conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # NORMAL is durable across app crashes in WAL mode; only an OS crash can lose the last commits
+            conn.execute(f'PRAGMA synchronous={self.synchronous}')
+            conn.execute('PRAGMA temp_store=MEMORY')
+            conn.execute('PRAGMA cache_size=-16000')  # ~16MB page cache per connection
+            self._local.conn = conn
+        return conn
+    
+    @contextmanager
+    def _write(self):
+        """Short write transaction that takes the write lock up front"""
+        conn = self.conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        else:
+            conn.execute('COMMIT')
+    
     def _init_db(self):
-        with self.conn:
-            self.conn.execute('''
+        with self._write() as conn:
+            conn.execute('''
                 CREATE TABLE IF NOT EXISTS pending_images (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     product_id TEXT NOT NULL,
@@ -25,35 +76,688 @@ class ApprovalDB:
                     reject_reason TEXT
                 )
             ''')
+            # Queue listing filters on status and sorts by created_at; dedupe looks up product_id + status
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_pending_status_created ON pending_images (status, created_at DESC, id DESC)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_pending_product_status ON pending_images (product_id, status)')
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(pending_images)')}
+            if 'product_type' not in columns:
+                # apify / clothing / standard - older rows stay NULL and only show up unfiltered
+                conn.execute('ALTER TABLE pending_images ADD COLUMN product_type TEXT')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_pending_status_type_created ON pending_images (status, product_type, created_at DESC, id DESC)')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS images (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    approval_id INTEGER NOT NULL REFERENCES pending_images (id),
+                    role TEXT NOT NULL CHECK(role IN ('original', 'processed')),
+                    position INTEGER NOT NULL,
+                    url TEXT NOT NULL,
+                    content_hash TEXT,
+                    width INTEGER,
+                    height INTEGER,
+                    byte_size INTEGER,
+                    UNIQUE (approval_id, role, position)
+                )
+            ''')
+            if conn.execute('PRAGMA user_version').fetchone()[0] < 1:
+                self._migrate_image_lists(conn)
+                conn.execute('PRAGMA user_version = 1')
+            # One row per lowercased tag, so the dashboard's tag search is an index range instead of a LIKE scan
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS approval_tags (
+                    tag TEXT NOT NULL,
+                    approval_id INTEGER NOT NULL REFERENCES pending_images (id),
+                    PRIMARY KEY (tag, approval_id)
+                )
+            ''')
+            if conn.execute('PRAGMA user_version').fetchone()[0] < 2:
+                self._migrate_tags(conn)
+                conn.execute('PRAGMA user_version = 2')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    payload TEXT,
+                    status TEXT CHECK(status IN ('queued', 'running', 'done', 'failed')),
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    max_attempts INTEGER NOT NULL DEFAULT 5,
+                    run_at REAL NOT NULL,
+                    lease_owner TEXT,
+                    lease_until REAL,
+                    last_error TEXT,
+                    created_at REAL NOT NULL,
+                    finished_at REAL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status_run_at ON jobs (status, run_at)')
+            if 'coalesce_key' not in {row[1] for row in conn.execute('PRAGMA table_info(jobs)')}:
+                conn.execute('ALTER TABLE jobs ADD COLUMN coalesce_key TEXT')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_coalesce_key ON jobs (coalesce_key, status)')
+            # Retention purge seeks finished jobs by age
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_finished_at ON jobs (finished_at) WHERE finished_at IS NOT NULL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS webhook_deliveries (
+                    webhook_id TEXT PRIMARY KEY,
+                    product_id TEXT,
+                    received_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_webhook_deliveries_received ON webhook_deliveries (received_at)')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS publications (
+                    idempotency_key TEXT PRIMARY KEY,
+                    approval_id INTEGER NOT NULL REFERENCES pending_images (id),
+                    image_id INTEGER NOT NULL REFERENCES images (id),
+                    product_id TEXT NOT NULL,
+                    status TEXT NOT NULL CHECK(status IN ('pending', 'staged', 'creating', 'published', 'failed')),
+                    source_url TEXT,
+                    media_id TEXT,
+                    last_error TEXT,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_publications_approval ON publications (approval_id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_publications_status ON publications (status)')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    product_id TEXT PRIMARY KEY,
+                    updated_at TEXT,
+                    image_fingerprint TEXT,
+                    synced_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS sync_watermarks (
+                    name TEXT PRIMARY KEY,
+                    watermark TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+    
+    def _migrate_image_lists(self, conn):
+        """Move the legacy comma-joined URL columns into `images` rows"""
+        migrated = 0
+        rows = conn.execute(
+            'SELECT id, original_images, processed_images FROM pending_images '
+            'WHERE original_images IS NOT NULL OR processed_images IS NOT NULL'
+        ).fetchall()
+        for approval_id, originals, processed in rows:
+            # Best effort - a URL that itself contained a comma was already split apart on write
+            images = [url for url in (originals or '').split(',') if url]
+            outputs = [url for url in (processed or '').split(',') if url]
+            self._insert_images(conn, approval_id, images, outputs)
+            migrated += 1
+        conn.execute('UPDATE pending_images SET original_images = NULL, processed_images = NULL')
+        if migrated:
+            logger.info(f"🗂️ Migrated image lists of {migrated} approvals into the images table")
     
-    def add_pending(self, product_id, original_images, processed_images, variant_id=None):
-        with self.conn:
-            self.conn.execute(
-                'INSERT INTO pending_images (product_id, variant_id, original_images, processed_images, status) VALUES (?, ?, ?, ?, ?)',
-                (product_id, variant_id, ','.join(original_images), ','.join(processed_images), 'pending')
+    def _migrate_tags(self, conn):
+        """Index the tags already stored in variant_id"""
+        rows = conn.execute('SELECT id, variant_id FROM pending_images WHERE variant_id IS NOT NULL').fetchall()
+        for approval_id, tags in rows:
+            self._insert_tags(conn, approval_id, tags)
+        if rows:
+            logger.info(f"🏷️ Indexed tags of {len(rows)} approvals")
+    
+    @staticmethod
+    def _split_tags(tags):
+        """Shopify tag string ("a, b") or list -> distinct lowercased tags"""
+        if isinstance(tags, str):
+            tags = tags.split(',')
+        return {tag.strip().lower() for tag in tags or [] if tag and tag.strip()}
+    
+    def _insert_tags(self, conn, approval_id, tags):
+        conn.executemany(
+            'INSERT OR IGNORE INTO approval_tags (tag, approval_id) VALUES (?, ?)',
+            [(tag, approval_id) for tag in self._split_tags(tags)]
+        )
+    
+    @staticmethod
+    def _image_row(image):
+        """(url, content_hash, width, height, byte_size) from a URL or an image dict"""
+        if isinstance(image, str):
+            return image, None, None, None, None
+        return (
+            image.get('url') or image.get('src'),
+            image.get('sha256'),
+            image.get('width'),
+            image.get('height'),
+            image.get('bytes'),
+        )
+    
+    def _insert_images(self, conn, approval_id, original_images, processed_images):
+        rows = []
+        for role, images in (('original', original_images), ('processed', processed_images)):
+            for position, image in enumerate(images):
+                rows.append((approval_id, role, position) + self._image_row(image))
+        conn.executemany(
+            'INSERT INTO images (approval_id, role, position, url, content_hash, width, height, byte_size) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            rows
+        )
+    
+    def add_pending(self, product_id, original_images, processed_images, variant_id=None, product_type=None):
+        """Queue an approval. Images are URLs, or dicts with url/src and optional sha256, width, height, bytes"""
+        with timed('db_insert'), self._write() as conn:
+            cur = conn.execute(
+                'INSERT INTO pending_images (product_id, variant_id, status, product_type) VALUES (?, ?, ?, ?)',
+                (product_id, variant_id, 'pending', product_type)
+            )
+            self._insert_images(conn, cur.lastrowid, original_images, processed_images)
+            self._insert_tags(conn, cur.lastrowid, variant_id)
+            return cur.lastrowid
+    
+    def images_for(self, approval_ids):
+        """{approval_id: {'original': [...], 'processed': [...]}} in position order, one IN query per 500 ids"""
+        result = {approval_id: {'original': [], 'processed': []} for approval_id in approval_ids}
+        ids = list(result)
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            rows = self.conn.execute(
+                f"SELECT id, approval_id, role, url, content_hash, width, height, byte_size FROM images "
+                f"WHERE approval_id IN ({','.join('?' * len(chunk))}) ORDER BY approval_id, role, position",
+                chunk
             )
+            for image_id, approval_id, role, url, content_hash, width, height, byte_size in rows:
+                result[approval_id][role].append({
+                    'id': image_id,
+                    'url': url,
+                    'content_hash': content_hash,
+                    'width': width,
+                    'height': height,
+                    'byte_size': byte_size,
+                })
+        return result
+    
+    def get_image_url(self, image_id):
+        row = self.conn.execute('SELECT url FROM images WHERE id = ?', (image_id,)).fetchone()
+        return row[0] if row else None
+    
+    def _with_images(self, rows):
+        """List rows as (id, product_id, tags, original images, processed images)"""
+        images = self.images_for([row[0] for row in rows])
+        return [row + (images[row[0]]['original'], images[row[0]]['processed']) for row in rows]
     
     def get_pending(self):
         cur = self.conn.cursor()
-        cur.execute("SELECT * FROM pending_images WHERE status='pending' ORDER BY created_at DESC")
-        return cur.fetchall()
+        cur.execute(f"SELECT {self.LIST_COLUMNS} FROM pending_images WHERE status='pending' ORDER BY created_at DESC, id DESC")
+        return self._with_images(cur.fetchall())
+    
+    # Columns the dashboard list renders; images are attached from the images table
+    LIST_COLUMNS = 'id, product_id, variant_id'
+    
+    def _pending_filter(self, product_type=None, tag=None):
+        where, params = ["status = 'pending'"], []
+        if product_type:
+            where.append('product_type = ?')
+            params.append(product_type)
+        if tag:
+            # Tag prefix, as a range over the approval_tags primary key
+            prefix = tag.strip().lower()
+            where.append('id IN (SELECT approval_id FROM approval_tags WHERE tag >= ? AND tag < ?)')
+            params.extend([prefix, prefix + '\U0010ffff'])
+        return where, params
+    
+    def list_pending(self, limit=20, after=None, before=None, product_type=None, tag=None):
+        """One page of the pending queue, newest first, by keyset cursor.
+        
+        `after=<id>` returns the page older than that row, `before=<id>` the page
+        newer than it. Seeks through the (status, created_at, id) index, so the
+        cost doesn't grow with queue depth. Returns (rows, older, newer) where
+        older/newer are the cursors for the adjacent pages, or None at the ends.
+        """
+        where, params = self._pending_filter(product_type, tag)
+        cursor = after if after is not None else before
+        if cursor is not None:
+            op = '<' if after is not None else '>'
+            where.append(f'(created_at, id) {op} (SELECT created_at, id FROM pending_images WHERE id = ?)')
+            params.append(cursor)
+        order = 'ASC' if before is not None and after is None else 'DESC'
+        rows = self.conn.execute(
+            f"SELECT {self.LIST_COLUMNS} FROM pending_images WHERE {' AND '.join(where)} "
+            f"ORDER BY created_at {order}, id {order} LIMIT ?",
+            params + [limit + 1]
+        ).fetchall()
+        more = len(rows) > limit
+        rows = self._with_images(rows[:limit])
+        if order == 'ASC':
+            rows.reverse()
+        if not rows:
+            return rows, None, None
+        older = rows[-1][0] if (more if order == 'DESC' else True) else None
+        newer = rows[0][0] if (more if order == 'ASC' else cursor is not None) else None
+        return rows, older, newer
+    
+    def count_pending(self, product_type=None, tag=None):
+        """Size of the (filtered) pending queue, cached for APPROVAL_COUNT_TTL seconds"""
+        key = (product_type, tag)
+        now = time.monotonic()
+        with self._count_lock:
+            cached = self._count_cache.get(key)
+            if cached and now - cached[0] < self.count_ttl:
+                return cached[1]
+        where, params = self._pending_filter(product_type, tag)
+        count = self.conn.execute(f"SELECT COUNT(*) FROM pending_images WHERE {' AND '.join(where)}", params).fetchone()[0]
+        with self._count_lock:
+            self._count_cache[key] = (now, count)
+        return count
+    
+    def _invalidate_counts(self):
+        # Approve/reject are what a reviewer watches the count for; inserts just age out
+        with self._count_lock:
+            self._count_cache.clear()
     
     def get_pending_by_product_id(self, product_id):
         """Check if product already has pending approval"""
         cur = self.conn.cursor()
-        cur.execute("SELECT id FROM pending_images WHERE product_id = ? AND status = 'pending'", (product_id,))
+        cur.execute("SELECT id FROM pending_images WHERE product_id = ? AND status = 'pending' LIMIT 1", (product_id,))
         return cur.fetchone() is not None
     
     def approve(self, approval_id):
-        with self.conn:
-            self.conn.execute(
-                'UPDATE pending_images SET status="approved", approved_at=? WHERE id=?',
+        with self._write() as conn:
+            conn.execute(
+                "UPDATE pending_images SET status='approved', approved_at=? WHERE id=?",
                 (datetime.now(), approval_id)
             )
+        self._invalidate_counts()
+    
+    def approve_many(self, approval_ids):
+        """Approve whichever of these are still pending, in one transaction; returns the ids that changed"""
+        ids = list(dict.fromkeys(int(approval_id) for approval_id in approval_ids))
+        approved = []
+        now = datetime.now()
+        with self._write() as conn:
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = conn.execute(
+                    f"SELECT id FROM pending_images WHERE status='pending' AND id IN ({placeholders})", chunk
+                ).fetchall()
+                conn.execute(
+                    f"UPDATE pending_images SET status='approved', approved_at=? WHERE status='pending' AND id IN ({placeholders})",
+                    [now] + chunk
+                )
+                approved.extend(row[0] for row in rows)
+        self._invalidate_counts()
+        return approved
+    
+    def get_approval(self, approval_id):
+        """(product_id, status) of an approval, or None"""
+        return self.conn.execute('SELECT product_id, status FROM pending_images WHERE id = ?', (approval_id,)).fetchone()
     
     def reject(self, approval_id, reason):
-        with self.conn:
-            self.conn.execute(
-                'UPDATE pending_images SET status="rejected", reject_reason=? WHERE id=?',
+        with self._write() as conn:
+            conn.execute(
+                "UPDATE pending_images SET status='rejected', reject_reason=? WHERE id=?",
                 (reason, approval_id)
             )
+        self._invalidate_counts()
+    
+    # ===== Job queue =====
+    
+    def enqueue_job(self, kind, payload=None, max_attempts=5, delay=0):
+        """Persist a job so it survives restarts; returns the job id"""
+        now = time.time()
+        with self._write() as conn:
+            cur = conn.execute(
+                'INSERT INTO jobs (kind, payload, status, max_attempts, run_at, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (kind, json.dumps(payload or {}), 'queued', max_attempts, now + delay, now)
+            )
+            return cur.lastrowid
+    
+    def enqueue_coalesced_job(self, kind, coalesce_key, payload, delay, max_delay, max_attempts=5):
+        """Debounced enqueue: fold into a still-queued job with the same key if there is one.
+        
+        The queued job takes the newest payload and its run_at moves to now + delay,
+        but never past created_at + max_delay. Returns (job_id, coalesced).
+        """
+        now = time.time()
+        with self._write() as conn:
+            row = conn.execute(
+                "SELECT id, created_at FROM jobs WHERE coalesce_key = ? AND status = 'queued' LIMIT 1",
+                (coalesce_key,)
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    'UPDATE jobs SET payload=?, run_at=? WHERE id=?',
+                    (json.dumps(payload or {}), min(now + delay, row[1] + max_delay), row[0])
+                )
+                return row[0], True
+            cur = conn.execute(
+                'INSERT INTO jobs (kind, payload, status, max_attempts, run_at, created_at, coalesce_key) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (kind, json.dumps(payload or {}), 'queued', max_attempts, now + delay, now, coalesce_key)
+            )
+            return cur.lastrowid, False
+    
+    def record_webhook(self, webhook_id, product_id, retention):
+        """False if this delivery id was already seen (Shopify retries); forgets ids after `retention` seconds"""
+        now = time.time()
+        with self._write() as conn:
+            conn.execute('DELETE FROM webhook_deliveries WHERE received_at < ?', (now - retention,))
+            cur = conn.execute(
+                'INSERT OR IGNORE INTO webhook_deliveries (webhook_id, product_id, received_at) VALUES (?, ?, ?)',
+                (webhook_id, str(product_id), now)
+            )
+            return cur.rowcount == 1
+    
+    def forget_webhook(self, webhook_id):
+        """Drop a recorded delivery id so Shopify's retry of it is accepted"""
+        with self._write() as conn:
+            conn.execute('DELETE FROM webhook_deliveries WHERE webhook_id = ?', (webhook_id,))
+    
+    def claim_job(self, worker_id, lease_seconds, kinds=None):
+        """Lease the next runnable job (queued, or running with an expired lease), optionally only of `kinds`"""
+        now = time.time()
+        where = "((status = 'queued' AND run_at <= ?) OR (status = 'running' AND lease_until < ?))"
+        params = [now, now]
+        if kinds is not None:
+            where += f" AND kind IN ({','.join('?' * len(kinds))})"
+            params.extend(kinds)
+        # Cheap read first so idle workers polling don't take the write lock
+        if not self.conn.execute(f"SELECT 1 FROM jobs WHERE {where} LIMIT 1", params).fetchone():
+            return None
+        with self._write() as conn:
+            # A worker that died holding the lease still spent that attempt - don't hand out more than max_attempts
+            exhausted = conn.execute(
+                "UPDATE jobs SET status='failed', last_error=COALESCE(last_error, 'lease expired'), finished_at=?, "
+                "lease_owner=NULL, lease_until=NULL "
+                "WHERE status='running' AND lease_until < ? AND attempts >= max_attempts",
+                (now, now)
+            ).rowcount
+            if exhausted:
+                logger.warning(f"💀 Failed {exhausted} job(s) whose lease expired on their last attempt")
+            row = conn.execute(
+                f"SELECT id, kind, payload, attempts, max_attempts, created_at FROM jobs WHERE {where} ORDER BY run_at LIMIT 1",
+                params
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status='running', attempts=attempts+1, lease_owner=?, lease_until=? WHERE id=?",
+                (worker_id, now + lease_seconds, row[0])
+            )
+        return {
+            'id': row[0],
+            'kind': row[1],
+            'payload': json.loads(row[2] or '{}'),
+            'attempts': row[3] + 1,
+            'max_attempts': row[4],
+            'created_at': row[5],
+        }
+    
+    def renew_lease(self, job_id, worker_id, lease_seconds):
+        """Extend a lease held by worker_id; False if it was lost to another worker"""
+        with self._write() as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET lease_until=? WHERE id=? AND lease_owner=? AND status='running'",
+                (time.time() + lease_seconds, job_id, worker_id)
+            )
+            return cur.rowcount == 1
+    
+    def complete_job(self, job_id, worker_id, retention=None):
+        """Mark a job done; also forgets jobs that finished (done or failed) more than `retention` seconds ago"""
+        now = time.time()
+        with self._write() as conn:
+            conn.execute(
+                "UPDATE jobs SET status='done', finished_at=?, lease_until=NULL WHERE id=? AND lease_owner=?",
+                (now, job_id, worker_id)
+            )
+            if retention is not None:
+                conn.execute('DELETE FROM jobs WHERE finished_at < ?', (now - retention,))
+    
+    def fail_job(self, job_id, worker_id, error, retry_delay):
+        """Requeue with backoff, or mark failed once attempts are exhausted. Returns the new status"""
+        now = time.time()
+        with self._write() as conn:
+            row = conn.execute(
+                'SELECT attempts, max_attempts FROM jobs WHERE id=? AND lease_owner=?',
+                (job_id, worker_id)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[0] >= row[1]:
+                status = 'failed'
+                conn.execute(
+                    "UPDATE jobs SET status='failed', last_error=?, finished_at=?, lease_until=NULL WHERE id=?",
+                    (error, now, job_id)
+                )
+            else:
+                status = 'queued'
+                conn.execute(
+                    "UPDATE jobs SET status='queued', last_error=?, run_at=?, lease_owner=NULL, lease_until=NULL WHERE id=?",
+                    (error, now + retry_delay, job_id)
+                )
+            return status
+    
+    def job_counts(self):
+        """Number of jobs per status (queue depth)"""
+        rows = self.conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        return {status: count for status, count in rows}
+
+    # ===== Publishing =====
+    
+    def plan_publications(self, approval_id, product_id, items):
+        """Record [(idempotency_key, image_id)] to publish (existing keys are kept as they are).
+        
+        Returns the rows for those keys, in the order given, as dicts with the
+        image URL joined in.
+        """
+        now = time.time()
+        keys = [key for key, _ in items]
+        with self._write() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO publications (idempotency_key, approval_id, image_id, product_id, status, updated_at) "
+                "VALUES (?, ?, ?, ?, 'pending', ?)",
+                [(key, approval_id, image_id, str(product_id), now) for key, image_id in items]
+            )
+            rows = []
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows.extend(conn.execute(
+                    f"SELECT p.idempotency_key, p.image_id, i.url, p.status, p.source_url, p.media_id, p.last_error "
+                    f"FROM publications p JOIN images i ON i.id = p.image_id "
+                    f"WHERE p.idempotency_key IN ({','.join('?' * len(chunk))})",
+                    chunk
+                ).fetchall())
+        columns = ('idempotency_key', 'image_id', 'url', 'status', 'source_url', 'media_id', 'last_error')
+        by_key = {row[0]: dict(zip(columns, row)) for row in rows}
+        return [by_key[key] for key in keys if key in by_key]
+    
+    def update_publications(self, rows):
+        """Persist status/source_url/media_id/last_error of publication row dicts in one transaction"""
+        now = time.time()
+        with self._write() as conn:
+            conn.executemany(
+                'UPDATE publications SET status=?, source_url=?, media_id=?, last_error=?, updated_at=? WHERE idempotency_key=?',
+                [(row['status'], row['source_url'], row['media_id'], row['last_error'], now, row['idempotency_key']) for row in rows]
+            )
+    
+    def unpublished_approvals(self):
+        """Approval ids with images that haven't made it to Shopify yet"""
+        rows = self.conn.execute("SELECT DISTINCT approval_id FROM publications WHERE status != 'published'").fetchall()
+        return [row[0] for row in rows]
+    
+    def publication_counts(self):
+        """Number of images per publish status"""
+        rows = self.conn.execute('SELECT status, COUNT(*) FROM publications GROUP BY status').fetchall()
+        return {status: count for status, count in rows}
+
+    # ===== Catalog sync state =====
+    
+    def get_sync_state(self, product_id):
+        """(updated_at, image_fingerprint) last recorded for a product, or None"""
+        return self.conn.execute(
+            'SELECT updated_at, image_fingerprint FROM sync_state WHERE product_id = ?', (str(product_id),)
+        ).fetchone()
+    
+    def record_sync(self, product_id, updated_at, image_fingerprint):
+        with self._write() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO sync_state (product_id, updated_at, image_fingerprint, synced_at) VALUES (?, ?, ?, ?)',
+                (str(product_id), updated_at, image_fingerprint, time.time())
+            )
+    
+    def get_watermark(self, name):
+        row = self.conn.execute('SELECT watermark FROM sync_watermarks WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+    
+    def set_watermark(self, name, watermark):
+        with self._write() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO sync_watermarks (name, watermark, updated_at) VALUES (?, ?, ?)',
+                (name, watermark, time.time())
+            )
+
+_db = None
+_db_lock = threading.Lock()
+
+def get_db():
+    """The process-wide ApprovalDB shared by the API, workers and dashboard"""
+    global _db
+    with _db_lock:
+        if _db is None:
+            _db = ApprovalDB()
+        return _db
+
+class CostLedger:
+    """Append-only ledger of Replicate spend.
+
+    `record()` only appends to an in-memory queue and bumps today's running
+    total; a writer thread commits queued rows in batches. Today's total is
+    re-read from the table after every flush, so several processes sharing
+    the file converge on the same figure.
+    """
+    
+    def __init__(self, db_path=None, flush_interval=None, batch_size=500):
+        db_path = db_path or os.getenv('COST_LEDGER_PATH', '/tmp/costs.db')
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.flush_interval = flush_interval or float(os.getenv('COST_LEDGER_FLUSH_INTERVAL', 0.5))
+        self.batch_size = batch_size
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self.lock = threading.RLock()
+        # Serialises flushes; held across the SQLite write so `lock` never is
+        self._flush_lock = threading.Lock()
+        self._pending = []
+        self._wakeup = threading.Event()
+        self._init_db()
+        self._day = date.today().isoformat()
+        self._flushed_today = self._query_today()
+        self._pending_today = 0.0
+        self._writer = threading.Thread(target=self._run_writer, name="cost-ledger", daemon=True)
+        self._writer.start()
+        atexit.register(self.flush)
+    
+    def _init_db(self):
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS cost_ledger (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    ts REAL NOT NULL,
+                    day TEXT NOT NULL,
+                    model TEXT,
+                    product_id TEXT,
+                    amount REAL NOT NULL,
+                    cached INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_cost_ledger_day_model ON cost_ledger (day, model)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_cost_ledger_product ON cost_ledger (product_id, day)')
+    
+    def _query_today(self):
+        with self.lock:
+            return self.conn.execute(
+                'SELECT COALESCE(SUM(amount), 0) FROM cost_ledger WHERE day=?', (self._day,)
+            ).fetchone()[0]
+    
+    def _roll_over(self):
+        today = date.today().isoformat()
+        if today != self._day:
+            self._day = today
+            self._flushed_today = self._query_today()
+            self._pending_today = 0.0
+    
+    def record(self, amount, model=None, product_id=None, cached=False):
+        """Append a charge (cache hits are recorded at $0 with cached=True)"""
+        now = time.time()
+        with self.lock:
+            self._roll_over()
+            self._pending.append((now, self._day, model, product_id, amount, int(cached)))
+            self._pending_today += amount
+            if len(self._pending) >= self.batch_size:
+                self._wakeup.set()
+    
+    def today_total(self):
+        """Today's spend across every worker, including rows not yet committed"""
+        with self.lock:
+            self._roll_over()
+            return self._flushed_today + self._pending_today
+    
+    def flush(self):
+        with self._flush_lock:
+            # record()/today_total() only wait for these swaps, never for the write itself
+            with self.lock:
+                rows, self._pending = self._pending, []
+                day = self._day
+            if rows:
+                try:
+                    with self.conn:
+                        self.conn.executemany(
+                            'INSERT INTO cost_ledger (ts, day, model, product_id, amount, cached) VALUES (?, ?, ?, ?, ?, ?)',
+                            rows
+                        )
+                except Exception:
+                    # Keep them (still counted in _pending_today) for the next flush
+                    with self.lock:
+                        self._pending = rows + self._pending
+                    raise
+            flushed_today = self.conn.execute(
+                'SELECT COALESCE(SUM(amount), 0) FROM cost_ledger WHERE day=?', (day,)
+            ).fetchone()[0]
+            with self.lock:
+                if day != self._day:
+                    # Rolled over meanwhile - _roll_over() already re-read the new day
+                    return
+                self._flushed_today = flushed_today
+                if self._pending:
+                    self._pending_today -= sum(row[4] for row in rows if row[1] == day)
+                else:
+                    self._pending_today = 0.0
+    
+    def _run_writer(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logging.getLogger("costs").exception("🔥 Failed to flush cost ledger")
+    
+    def _group(self, column, where, params, order='SUM(amount) DESC'):
+        self.flush()
+        with self._flush_lock:
+            rows = self.conn.execute(
+                f'SELECT {column}, SUM(amount), COUNT(*), SUM(cached) FROM cost_ledger {where} GROUP BY {column} ORDER BY {order}',
+                params
+            ).fetchall()
+        return [{column: key, 'cost': round(cost, 6), 'runs': runs, 'cached_runs': cached}
+                for key, cost, runs, cached in rows]
+    
+    def costs_by_model(self, day=None):
+        return self._group('model', 'WHERE day=?', (day or date.today().isoformat(),))
+    
+    def costs_by_product(self, day=None, limit=100):
+        return self._group('product_id', 'WHERE day=?', (day or date.today().isoformat(),))[:limit]
+    
+    def costs_by_day(self, days=30):
+        since = (date.today() - timedelta(days=days - 1)).isoformat()
+        return self._group('day', 'WHERE day>=?', (since,), order='day')
+
+_cost_ledger = None
+_cost_ledger_lock = threading.Lock()
+
+def get_cost_ledger():
+    """Process-wide ledger shared by every ReplicateService and worker"""
+    global _cost_ledger
+    with _cost_ledger_lock:
+        if _cost_ledger is None:
+            _cost_ledger = CostLedger()
+        return _cost_ledger
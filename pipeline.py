@@ -0,0 +1,430 @@
+import os
+import time
+import queue
+import hashlib
+import logging
+import threading
+from datetime import datetime, timezone
+from processing.general import add_badges_batch
+
+logger = logging.getLogger("pipeline")
+
+CLOTHING_KEYWORDS = [
+    'shirt', 'dress', 'pants', 'jacket', 'hoodie', 'sweater',
+    'top', 'bottom', 'jeans', 'blouse', 'skirt', 'shorts'
+]
+
+# End-of-stream marker passed between stages
+_DONE = object()
+
+def classify_product(product):
+    """Return 'apify', 'clothing' or 'standard' for a Shopify product dict"""
+    tags = product.get('tags', '')
+    title = product.get('title') or 'Untitled Product'
+    if 'Supplier:apify' in str(tags):
+        return 'apify'
+    if any(keyword in title.lower() for keyword in CLOTHING_KEYWORDS):
+        return 'clothing'
+    return 'standard'
+
+# sync_watermarks row for the product listing
+WATERMARK = 'products'
+
+def image_fingerprint(images):
+    """Stable hash of a product's image set (order, ids and versioned src URLs)"""
+    digest = hashlib.sha256()
+    for image in images or []:
+        # Shopify bumps the ?v= of src whenever the file behind an image is replaced
+        digest.update(f"{image.get('id')}:{image.get('src')}\n".encode())
+    return digest.hexdigest()
+
+class RunControl:
+    """Pause/cancel switches a BatchPipeline checks between products"""
+
+    def __init__(self):
+        self._resumed = threading.Event()
+        self._resumed.set()
+        self.cancelled = threading.Event()
+
+    @property
+    def paused(self):
+        return not self._resumed.is_set()
+
+    def pause(self):
+        self._resumed.clear()
+
+    def resume(self):
+        self._resumed.set()
+
+    def cancel(self):
+        self.cancelled.set()
+        self._resumed.set()  # wake anything parked on a pause so it can stop
+
+    def checkpoint(self):
+        """Block while paused; False once the run is cancelled"""
+        self._resumed.wait()
+        return not self.cancelled.is_set()
+
+class BatchPipeline:
+    """Full-catalog run as overlapping stages connected by bounded queues.
+
+    stream products + classify -> fetch images (N threads, rate-limited)
+    -> process (N threads) -> single DB writer
+
+    Shopify throttling is handled by the service's shared rate limiter, so
+    concurrency only has to be bounded, not paced.
+
+    Runs are incremental unless `full` is set: only products updated since
+    the last completed run's watermark are listed, and products whose image
+    fingerprint matches the recorded sync state are skipped.
+    """
+
+    def __init__(self, shopify, db, mode=None, full=None, control=None, fetch_workers=None, process_workers=None, queue_size=None):
+        self.shopify = shopify
+        self.db = db
+        self.control = control or RunControl()
+        # 'rest' pages products.json; 'bulk' streams a GraphQL bulk export
+        self.mode = mode or os.getenv('BATCH_INGEST_MODE', 'rest')
+        self.full = full if full is not None else os.getenv('BATCH_INCREMENTAL', '1') == '0'
+        # Re-list a little before the previous run started, to cover clock skew with Shopify
+        self.watermark_overlap = float(os.getenv('SYNC_WATERMARK_OVERLAP', 300))
+        self.fetch_workers = fetch_workers or int(os.getenv('BATCH_FETCH_WORKERS', 4))
+        self.process_workers = process_workers or int(os.getenv('BATCH_PROCESS_WORKERS', 4))
+        self.queue_size = queue_size or int(os.getenv('BATCH_QUEUE_SIZE', 50))
+        self._lock = threading.Lock()
+        self.counts = {}
+        self.started_at = None
+        self.total = None  # products the listing will yield, when Shopify can say up front
+        self.queues = {}
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + amount
+
+    def run(self):
+        """Run the whole catalog through the pipeline; returns a summary dict"""
+        started = self.started_at = time.time()
+        self.counts = {'seen': 0, 'skipped': 0, 'unchanged': 0, 'no_images': 0, 'errors': 0, 'cancelled': 0,
+                       'processed': 0, 'apify': 0, 'clothing': 0, 'standard': 0}
+        since = None if self.full else self.db.get_watermark(WATERMARK)
+        self.hold_watermark = None  # oldest updated_at of a product skipped as pending
+        if self.mode != 'bulk':
+            self.total = self.shopify.count_products(updated_at_min=since)
+        # Anything edited from here on is picked up by the next run
+        next_watermark = datetime.fromtimestamp(started - self.watermark_overlap, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+        fetch_q = queue.Queue(self.queue_size)
+        process_q = queue.Queue(self.queue_size)
+        write_q = queue.Queue(self.queue_size)
+        self.queues = {'fetch': fetch_q, 'process': process_q, 'write': write_q}
+
+        threads = [
+            self._spawn_stage('fetch', self._fetch, fetch_q, process_q, self.fetch_workers),
+            self._spawn_stage('process', self._process, process_q, write_q, self.process_workers),
+            # Already-processed products are still written when a run is cancelled
+            self._spawn_stage('write', self._write, write_q, None, 1, cancellable=False),
+        ]
+
+        # Listing + classification runs on this thread and feeds the first stage
+        logger.info(f"🕒 Listing products updated since {since}" if since else "🕒 Listing the full catalog")
+        if self.mode == 'bulk':
+            products = self.shopify.iter_bulk_products(updated_at_min=since, control=self.control)
+        else:
+            products = self.shopify.iter_products(updated_at_min=since, strict=True)
+        try:
+            for product in products:
+                if not self.control.checkpoint():
+                    logger.warning("🛑 Batch run cancelled - draining in-flight products")
+                    break
+                self._count('seen')
+                item = self._classify(product)
+                if item is not None:
+                    fetch_q.put(item)
+        finally:
+            fetch_q.put(_DONE)
+            for thread in threads:
+                thread.join()
+
+        # Only reached when the listing completed. Products that errored were never
+        # recorded, so keep the old watermark to list them again (the rest skip by fingerprint)
+        if not self.counts['errors'] and not self.control.cancelled.is_set():
+            # Products skipped as pending weren't synced either - hold the watermark
+            # at the oldest of them so they are listed again once reviewed
+            if self.hold_watermark is not None:
+                next_watermark = min(next_watermark, self.hold_watermark)
+            self.db.set_watermark(WATERMARK, next_watermark)
+
+        if not self.counts['seen']:
+            logger.warning("❌ No products found in Shopify store")
+
+        elapsed = time.time() - started
+        summary = dict(self.counts)
+        summary['elapsed'] = round(elapsed, 2)
+        summary['products_per_sec'] = round(summary['seen'] / elapsed, 2) if elapsed else 0.0
+        summary['since'] = since
+
+        logger.info("🎉 Batch processing complete!")
+        logger.info(f"✅ Total processed: {summary['processed']}/{summary['seen']} "
+                    f"(skipped {summary['skipped']}, unchanged {summary['unchanged']}, "
+                    f"no images {summary['no_images']}, errors {summary['errors']})")
+        logger.info(f"🔍 Apify products: {summary['apify']}")
+        logger.info(f"👗 Clothing products: {summary['clothing']}")
+        logger.info(f"📦 Standard products: {summary['standard']}")
+        logger.info(f"⚡ {summary['products_per_sec']} products/sec over {summary['elapsed']}s")
+        return summary
+
+    def progress(self):
+        """Live counts, throughput and ETA of this run"""
+        with self._lock:
+            counts = dict(self.counts)
+        elapsed = time.time() - self.started_at if self.started_at else 0.0
+        # Products that have left the pipeline, one way or another
+        done = sum(counts.get(key, 0) for key in ('processed', 'skipped', 'unchanged', 'no_images', 'errors', 'cancelled'))
+        rate = done / elapsed if elapsed else 0.0
+        eta = max(0.0, (self.total - done) / rate) if self.total is not None and rate else None
+        return {
+            'counts': counts,
+            'done': done,
+            'total': self.total,
+            'elapsed': round(elapsed, 1),
+            'products_per_sec': round(rate, 2),
+            'eta_seconds': round(eta) if eta is not None else None,
+        }
+
+    def queue_depths(self):
+        """Items waiting in front of each stage"""
+        return {name: q.qsize() for name, q in self.queues.items()}
+
+    def _spawn_stage(self, name, fn, inbox, outbox, workers, cancellable=True):
+        """Start `workers` threads for a stage; a supervisor forwards _DONE once all have drained"""
+        def work():
+            while True:
+                item = inbox.get()
+                if item is _DONE:
+                    inbox.put(_DONE)  # let sibling workers see it too
+                    return
+                if cancellable and not self.control.checkpoint():
+                    self._count('cancelled')
+                    continue
+                try:
+                    result = fn(item)
+                except Exception as e:
+                    self._count('errors')
+                    logger.exception(f"💥 {name} stage failed for product {item.get('product_id')}: {str(e)}")
+                    continue
+                if result is not None and outbox is not None:
+                    outbox.put(result)
+
+        def supervise():
+            workers_threads = [threading.Thread(target=work, name=f"batch-{name}-{n}", daemon=True)
+                               for n in range(workers)]
+            for thread in workers_threads:
+                thread.start()
+            for thread in workers_threads:
+                thread.join()
+            if outbox is not None:
+                outbox.put(_DONE)
+
+        supervisor = threading.Thread(target=supervise, name=f"batch-{name}", daemon=True)
+        supervisor.start()
+        return supervisor
+
+    def _classify(self, product):
+        product_id = product['id']
+        title = product.get('title', 'Untitled Product')
+
+        # Skip if already processed recently
+        if self.db.get_pending_by_product_id(str(product_id)):
+            self._count('skipped')
+            self._hold(product.get('updated_at'))
+            logger.info(f"⏭️ Skipping already pending product: {title} (ID: {product_id})")
+            return None
+
+        item = {
+            'product_id': product_id,
+            'title': title,
+            'tags': product.get('tags', ''),
+            'kind': classify_product(product),
+            'updated_at': product.get('updated_at'),
+            # Present when the listing projection included images - saves a call per product
+            'images': product.get('images'),
+        }
+        if item['images'] is not None and self._unchanged(item):
+            return None
+        logger.info(f"🔍 Queued: {title} (ID: {product_id}) - {item['kind']}")
+        return item
+
+    def _hold(self, updated_at):
+        """Keep the next watermark at or before a product this run didn't sync"""
+        try:
+            held = datetime.fromisoformat(updated_at.replace('Z', '+00:00')).astimezone(timezone.utc)
+            held = held.strftime('%Y-%m-%dT%H:%M:%SZ')
+        except (AttributeError, ValueError):
+            # No usable timestamp - don't move the watermark at all
+            held = self.db.get_watermark(WATERMARK) or '1970-01-01T00:00:00Z'
+        if self.hold_watermark is None or held < self.hold_watermark:
+            self.hold_watermark = held
+
+    def _unchanged(self, item):
+        """Skip (and count) a product whose image set matches its recorded sync state"""
+        item['fingerprint'] = image_fingerprint(item['images'])
+        if self.full:
+            return False
+        state = self.db.get_sync_state(item['product_id'])
+        if state is None or state[1] != item['fingerprint']:
+            return False
+        self._count('unchanged')
+        return True
+
+    def _fetch(self, item):
+        if item['images'] is None:
+            item['images'] = self.shopify.get_product_images(item['product_id'])
+            if self._unchanged(item):
+                return None
+        if not item['images']:
+            self._count('no_images')
+            logger.warning(f"🖼️ No images found for product: {item['title']}")
+            # Remember the empty set so the product is only revisited once it gets images
+            self.db.record_sync(item['product_id'], item['updated_at'], item['fingerprint'])
+            return None
+        return item
+
+    def _process(self, item):
+        images = item['images']
+        if item['kind'] == 'standard':
+            # Add UK flag + fast delivery badge (CPU only - runs on the image process pool)
+            item['processed_images'] = add_badges_batch([img['src'] for img in images[:5]])
+        else:
+            # In real implementation: split multi-angle images (apify) or generate
+            # lifestyle + swatch collage (clothing) - paid Replicate calls stay out of bulk runs
+            item['processed_images'] = [img['src'] for img in images[:5]]
+        return item
+
+    def _write(self, item):
+        self.db.add_pending(
+            product_id=str(item['product_id']),
+            original_images=item['images'],
+            processed_images=item['processed_images'],
+            variant_id=str(item['tags']),  # Store tags for display
+            product_type=item['kind']
+        )
+        self.db.record_sync(item['product_id'], item['updated_at'], item['fingerprint'])
+        self._count('processed')
+        self._count(item['kind'])
+        logger.info(f"✅ Added to approval queue: {item['title']}")
+
+# Run states during which another full run may not start
+ACTIVE_STATES = ('queued', 'running', 'paused', 'cancelling')
+
+class BatchRunManager:
+    """Owns the single full-catalog run: start, pause/resume/cancel and progress.
+
+    Runs are dispatched in-process through the job queue under one coalesce
+    key, so a second start while a run is queued or active is refused
+    rather than stacking another full walk of the store.
+    """
+
+    def __init__(self, pipeline_factory, job_pool):
+        self.pipeline_factory = pipeline_factory
+        self.job_pool = job_pool
+        self._lock = threading.Lock()
+        self._run = None
+
+    def _new_run(self, mode, full, job_id=None):
+        return {'id': job_id, 'state': 'queued', 'mode': mode, 'full': bool(full), 'control': RunControl(),
+                'pipeline': None, 'summary': None, 'error': None, 'queued_at': time.time(), 'finished_at': None}
+
+    def _state(self):
+        run = self._run
+        if run is None:
+            return 'idle'
+        if run['state'] == 'running' and run['control'].cancelled.is_set():
+            return 'cancelling'
+        if run['state'] in ('queued', 'running') and run['control'].paused:
+            return 'paused'
+        return run['state']
+
+    def start(self, mode=None, full=False):
+        """Queue a full run; returns (started, snapshot). Refused while one is queued or active"""
+        with self._lock:
+            if self._state() in ACTIVE_STATES:
+                return False, self._snapshot()
+            # A full run is long and not idempotent enough to blindly repeat - retry once at most
+            job_id, _ = self.job_pool.enqueue_coalesced(
+                'process_all_products', 'batch-run', {'mode': mode, 'full': full}, 0, 0, max_attempts=2
+            )
+            self._run = self._new_run(mode, full, job_id)
+            logger.info(f"🚀 Queued batch run (job {job_id})")
+            return True, self._snapshot()
+
+    def run(self, mode=None, full=False):
+        """Job handler body: execute the queued run (or a recovered one after a restart)"""
+        with self._lock:
+            if self._state() in ('running', 'paused', 'cancelling') and self._run['pipeline'] is not None:
+                logger.warning("⏭️ A batch run is already in progress - not starting another")
+                return None
+            if self._run is None or self._run['state'] != 'queued':
+                self._run = self._new_run(mode, full)
+            run = self._run
+            if run['control'].cancelled.is_set():
+                run.update(state='cancelled', finished_at=time.time())
+                return None
+            run['pipeline'] = self.pipeline_factory(mode=mode, full=full or None, control=run['control'])
+            run['state'] = 'running'
+            run['started_at'] = time.time()
+
+        try:
+            summary = run['pipeline'].run()
+        except Exception as e:
+            with self._lock:
+                run.update(state='failed', error=str(e), finished_at=time.time())
+            raise
+        with self._lock:
+            run.update(state='cancelled' if run['control'].cancelled.is_set() else 'completed',
+                       summary=summary, finished_at=time.time())
+        return summary
+
+    def pause(self):
+        return self._control('pause')
+
+    def resume(self):
+        return self._control('resume')
+
+    def cancel(self):
+        return self._control('cancel')
+
+    def _control(self, action):
+        with self._lock:
+            if self._state() not in ACTIVE_STATES:
+                return False
+            getattr(self._run['control'], action)()
+            logger.info(f"⏯️ Batch run {action} requested")
+            return True
+
+    def snapshot(self):
+        with self._lock:
+            return self._snapshot()
+
+    def queue_depths(self):
+        """Per-stage queue depths of the active run ({} when idle)"""
+        with self._lock:
+            run = self._run
+            if self._state() not in ACTIVE_STATES or run['pipeline'] is None:
+                return {}
+            return run['pipeline'].queue_depths()
+
+    def _snapshot(self):
+        run = self._run
+        snapshot = {'state': self._state()}
+        if run is None:
+            return snapshot
+        snapshot.update({
+            'job_id': run['id'],
+            'mode': run['mode'] or os.getenv('BATCH_INGEST_MODE', 'rest'),
+            'full': run['full'],
+            'error': run['error'],
+            'finished_at': run['finished_at'],
+        })
+        if run['pipeline'] is not None:
+            snapshot.update(run['pipeline'].progress())
+        return snapshot
@@ -1,31 +1,35 @@
-from services.replicate import ReplicateService
+from services.replicate import ReplicateService, prediction_executor
 
 def generate_missing_images(product_type, base_image, count_needed):
     """Generate missing images ONLY after approval"""
     replicate = ReplicateService()
-    new_images = []
+    requests = []
     
     for i in range(count_needed):
         if "clothing" in product_type.lower():
             # Generate lifestyle image ($0.008 per image)
-            img = replicate.run_model(
+            requests.append((
                 "stability-ai/sdxl:39ed52f2a78e934b3ba6e2a89f5b1c712de7dfea535525255b1aa35c5565e08b",
                 {
                     "prompt": f"Professional lifestyle photo of model wearing {product_type}, studio lighting",
                     "image": base_image
                 },
-                cost_per_run=0.008
-            )
+                0.008,
+                i  # distinct cache entry per generated image
+            ))
         else:
             # Generate new angle ($0.004 per image)
-            img = replicate.run_model(
+            requests.append((
                 "lllyasviel/controlnet:1a0c51af1e8c3a8e5d6b3d7d6c9e8b7a6f5d4c3b2a1",
                 {
                     "image": base_image,
                     "prompt": "product photo from new angle, white background"
                 },
-                cost_per_run=0.004
-            )
-        new_images.append(img)
+                0.004,
+                i
+            ))
+    
+    # All predictions are launched up front and awaited together
+    new_images = prediction_executor.run_all(replicate, requests)
     
     return new_images
@@ -1,23 +1,82 @@
 from services.replicate import ReplicateService
-import requests
 from PIL import Image
 from io import BytesIO
-import os
+import time
+import logging
+from services.image_cache import image_cache
+from services.output_store import get_output_store
+from processing.executor import image_executor
+from processing.sizing import open_image, target_size, sized_image_url, log_decode_stats
+from processing.dedupe import image_signature, get_perceptual_index
+
+logger = logging.getLogger("processing")
+
+def composite_splits(content, masks, size=None):
+    """Process-pool task: cut one JPEG per SAM mask out of the composite image.
+
+    `masks` are mask image bytes (None for ones that couldn't be fetched).
+    Returns (list of JPEG bytes or None per mask, decode/encode stats) -
+    None wherever there is no usable mask, so a blank cut-out is never
+    produced.
+    """
+    img, stats = open_image(content, size)
+    results = []
+    encode_seconds = 0.0
+    
+    for i, mask_content in enumerate(masks):
+        if mask_content is None:
+            results.append(None)
+            continue
+        try:
+            mask_img = Image.open(BytesIO(mask_content)).convert('L')
+            if mask_img.size != img.size:
+                mask_img = mask_img.resize(img.size, Image.NEAREST)
+            if mask_img.getbbox() is None:
+                # Empty mask - nothing to cut out
+                results.append(None)
+                continue
+            
+            # Keep the masked region, white elsewhere
+            result = Image.composite(img, Image.new('RGB', img.size, (255, 255, 255)), mask_img)
+            
+            # Save to buffer
+            buffer = BytesIO()
+            started = time.perf_counter()
+            result.save(buffer, format="JPEG", quality=95)
+            encode_seconds += time.perf_counter() - started
+            results.append(buffer.getvalue())
+            
+        except Exception as e:
+            logger.warning(f"⚠️ Failed to process mask {i}: {str(e)}")
+            results.append(None)
+    
+    stats['encode_ms'] = round(encode_seconds * 1000, 1)
+    return results, stats
 
 def split_apify_image(image_url):
     """Split composite image into multiple angles using SAM"""
     replicate = ReplicateService()
+    size = target_size()
+    # SAM and the local composite must see the same (CDN-scaled) image
+    source_url = sized_image_url(image_url, size)
     try:
-        # Download the image first
-        response = requests.get(image_url, timeout=30)
-        if response.status_code != 200:
+        # Download the image first (revalidated against the local cache)
+        content = image_cache.fetch(source_url, timeout=30)
+        if content is None:
             logger.error(f"❌ Failed to download image: {image_url}")
             return [image_url]
         
+        # Supplier composites are shared across listings - reuse the splits of a near-duplicate
+        index = get_perceptual_index()
+        signature = image_executor.run(image_signature, content)
+        reused = index.find('apify_split', signature)
+        if reused:
+            return reused
+        
         # Run SAM segmentation
         masks = replicate.run_model(
             "adirik/sam:38e0d1c17d68945b8f94d24e34d0b202b6294d020a9f4b6c2b0a7d6e0e0e0e0",
-            {"image": image_url},
+            {"image": source_url},
             cost_per_run=0.002
         )
         
@@ -25,37 +84,22 @@ def split_apify_image(image_url):
             logger.warning("⚠️ SAM returned no masks - returning original image")
             return [image_url]
         
-        # Process each mask to extract individual angles
+        # Composite each mask in the image process pool
         split_images = []
-        img = Image.open(BytesIO(response.content))
-        
-        for i, mask in enumerate(masks[:5]):  # Max 5 angles
-            try:
-                # Create mask image
-                mask_img = Image.new('L', img.size, 0)
-                # Apply mask (simplified - real implementation would use actual mask data)
-                mask_img = mask_img.convert('RGB')
-                
-                # Apply to original image
-                result = Image.composite(img, Image.new('RGB', img.size, (255, 255, 255)), mask_img)
-                
-                # Save to buffer
-                buffer = BytesIO()
-                result.save(buffer, format="JPEG", quality=95)
-                buffer.seek(0)
-                
-                # Upload to temporary storage (in real app: upload to CDN)
-                split_images.append(f"{image_url}?split={i}")
-                
-            except Exception as e:
-                logger.warning(f"⚠️ Failed to process mask {i}: {str(e)}")
-                continue
+        mask_contents = [image_cache.fetch(mask, timeout=30) if isinstance(mask, str) else None
+                         for mask in masks[:5]]  # Max 5 angles
+        results, stats = image_executor.run(composite_splits, content, mask_contents, size)
+        log_decode_stats(image_url, stats)
+        for result in results:
+            if result is not None:
+                split_images.append(get_output_store().put(result))
         
         if not split_images:
             logger.warning("⚠️ No valid splits created - returning original image")
             return [image_url]
         
         logger.info(f"✅ Successfully split image into {len(split_images)} angles")
+        index.add('apify_split', signature, split_images, source_url=image_url)
         return split_images
         
     except Exception as e:
@@ -0,0 +1,87 @@
+from PIL import Image
+from io import BytesIO
+import os
+import time
+import logging
+import threading
+from processing.sizing import open_image
+
+logger = logging.getLogger("processing")
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'static')
+
+# (asset, size, corner) - UK flag bottom-right, delivery badge top-right
+DEFAULT_BADGES = [
+    ('uk_flag.png', (50, 50), 'bottom-right'),
+    ('fast_delivery.png', (120, 40), 'top-right'),
+]
+
+class BadgeRenderer:
+    """Composites badge overlays onto product images.
+
+    Each overlay is loaded, resized and split into RGB + alpha mask once per
+    (asset, size) and reused for every image. Pasting with the mask touches
+    only the badge rectangles, so the product image never takes an
+    RGB -> RGBA -> RGB round trip.
+    """
+
+    def __init__(self, badges=None, padding=10, quality=None, static_dir=STATIC_DIR):
+        self.badges = badges or DEFAULT_BADGES
+        self.padding = padding
+        self.quality = quality or int(os.getenv('BADGE_JPEG_QUALITY', 95))
+        self.static_dir = static_dir
+        self._overlays = {}
+        self._lock = threading.Lock()
+
+    def _overlay(self, asset, size):
+        """(rgb, mask) for an asset at a size, or None if the asset is unusable"""
+        key = (asset, size)
+        if key not in self._overlays:
+            with self._lock:
+                if key not in self._overlays:
+                    try:
+                        overlay = Image.open(os.path.join(self.static_dir, asset)).convert("RGBA").resize(size)
+                        self._overlays[key] = (overlay.convert("RGB"), overlay.getchannel("A"))
+                    except Exception as e:
+                        logger.warning(f"⚠️ Failed to load badge {asset}: {str(e)}")
+                        self._overlays[key] = None
+        return self._overlays[key]
+
+    def _position(self, img, size, corner):
+        x = img.width - size[0] - self.padding if corner.endswith('right') else self.padding
+        y = img.height - size[1] - self.padding if corner.startswith('bottom') else self.padding
+        return (x, y)
+
+    def apply(self, img):
+        """Paste every badge onto `img` in place; returns the (RGB) image"""
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        for asset, size, corner in self.badges:
+            overlay = self._overlay(asset, size)
+            if overlay is None:
+                continue
+            rgb, mask = overlay
+            img.paste(rgb, self._position(img, size, corner), mask)
+        return img
+
+    def encode(self, img):
+        buffer = BytesIO()
+        img.save(buffer, format="JPEG", quality=self.quality)
+        return buffer.getvalue()
+
+    def render(self, content, size=None):
+        """Badge one encoded image (decoded at reduced scale if `size`); returns JPEG bytes"""
+        img, _ = open_image(content, size)
+        return self.encode(self.apply(img))
+
+# Shared renderer so overlays are loaded once per process
+badge_renderer = BadgeRenderer()
+
+def badge_image(content, size=None):
+    """Process-pool task: encoded image in, (badged JPEG, decode/encode stats) out"""
+    img, stats = open_image(content, size)
+    img = badge_renderer.apply(img)
+    started = time.perf_counter()
+    jpeg = badge_renderer.encode(img)
+    stats['encode_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    return jpeg, stats
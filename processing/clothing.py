@@ -1,37 +1,48 @@
-from services.replicate import ReplicateService
-from PIL import Image
-import requests
-from io import BytesIO
-import numpy as np
+from services.replicate import ReplicateService, prediction_executor
+from services.output_store import get_output_store
+import logging
+
+logger = logging.getLogger("processing")
+
+def first_output(output):
+    """SDXL returns a list of image URLs (one per requested output) - keep the first"""
+    if isinstance(output, (list, tuple)):
+        output = output[0] if output else None
+    if not output:
+        raise ValueError("SDXL returned no image")
+    return str(output)
 
 def generate_clothing_gallery(main_image, swatch_images):
     """Create lifestyle + swatch collage for clothing products"""
     replicate = ReplicateService()
     
     try:
-        # Generate lifestyle image using original image as reference
-        lifestyle_image = replicate.run_model(
-            "stability-ai/sdxl:39ed52f2a78e934b3ba6e2a89f5b1c712de7dfea535525255b1aa35c5565e08b",
-            {
-                "prompt": "Professional lifestyle photo of model wearing this clothing item, studio lighting, high quality, commercial product photography",
-                "image": main_image
-            },
-            cost_per_run=0.008
-        )
-        
-        # Generate swatch grid
-        swatch_grid = replicate.run_model(
-            "stability-ai/sdxl:39ed52f2a78e934b3ba6e2a89f5b1c712de7dfea535525255b1aa35c5565e08b",
-            {
-                "prompt": "Minimalist grid layout of clothing color swatches on white background, professional product photography",
-                "image": main_image
-            },
-            cost_per_run=0.005
-        )
+        # Lifestyle image and swatch grid don't depend on each other - run them concurrently
+        lifestyle_image, swatch_grid = prediction_executor.run_all(replicate, [
+            (
+                "stability-ai/sdxl:39ed52f2a78e934b3ba6e2a89f5b1c712de7dfea535525255b1aa35c5565e08b",
+                {
+                    "prompt": "Professional lifestyle photo of model wearing this clothing item, studio lighting, high quality, commercial product photography",
+                    "image": main_image
+                },
+                0.008
+            ),
+            (
+                "stability-ai/sdxl:39ed52f2a78e934b3ba6e2a89f5b1c712de7dfea535525255b1aa35c5565e08b",
+                {
+                    "prompt": "Minimalist grid layout of clothing color swatches on white background, professional product photography",
+                    "image": main_image
+                },
+                0.005
+            ),
+        ])
         
         # Create final collage (simplified - real implementation would use PIL to combine)
         logger.info("✅ Generated lifestyle image and swatch grid")
-        return [lifestyle_image, swatch_grid]
+        # Replicate delivery URLs expire - keep our own copy
+        output_store = get_output_store()
+        outputs = [first_output(lifestyle_image), first_output(swatch_grid)]
+        return [output_store.put_url(url) or url for url in outputs]
         
     except Exception as e:
         logger.exception(f"🔥 Clothing gallery generation failed: {str(e)}")
@@ -0,0 +1,157 @@
+from PIL import Image
+from io import BytesIO
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger("processing")
+
+def image_signature(content, hash_size=8):
+    """(64-bit difference hash, mean RGB) of an encoded image (process-pool safe).
+
+    JPEG `draft()` decodes at reduced scale since only a 9x8 thumbnail is
+    needed. Each hash bit says whether a pixel is brighter than its
+    right-hand neighbour; the hash is greyscale, so the mean colour tells
+    colour variants of the same shot apart.
+    """
+    img = Image.open(BytesIO(content))
+    img.draft('RGB', (hash_size * 8, hash_size * 8))
+    small = img.convert('RGB').resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = list(small.convert('L').getdata())
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    colors = list(small.getdata())
+    mean = tuple(sum(channel) // len(colors) for channel in zip(*colors))
+    return value, mean
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+class BKTree:
+    """Burkhard-Keller tree over 64-bit hashes for radius queries in Hamming space"""
+
+    def __init__(self):
+        self.root = None  # [hash, [entry ids], {distance: child}]
+        self.size = 0
+
+    def add(self, value, entry_id):
+        self.size += 1
+        if self.root is None:
+            self.root = [value, [entry_id], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(entry_id)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [entry_id], {}]
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        """[(distance, entry id)] for every stored hash within max_distance, closest first"""
+        matches = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= max_distance:
+                matches.extend((distance, entry_id) for entry_id in node[1])
+            # Triangle inequality: only children within max_distance of `distance` can match
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        return sorted(matches)
+
+class PerceptualIndex:
+    """Local index from perceptual hashes of source images to their processed outputs.
+
+    Entries persist in SQLite (PERCEPTUAL_INDEX_PATH) and are loaded into one
+    in-memory BK-tree per kind of processing. A source within
+    PERCEPTUAL_MAX_DISTANCE bits and PERCEPTUAL_MAX_COLOR_DELTA (per RGB
+    channel of the mean colour) of an indexed one reuses its outputs.
+    """
+
+    def __init__(self, db_path=None, max_distance=None, max_color_delta=None):
+        db_path = db_path or os.getenv('PERCEPTUAL_INDEX_PATH', '/tmp/perceptual_index.db')
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.max_distance = max_distance if max_distance is not None else int(os.getenv('PERCEPTUAL_MAX_DISTANCE', 8))
+        self.max_color_delta = max_color_delta if max_color_delta is not None else int(os.getenv('PERCEPTUAL_MAX_COLOR_DELTA', 16))
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self.lock = threading.RLock()
+        self.trees = {}
+        self.counters = {'hits': 0, 'misses': 0}
+        self._init_db()
+
+    def _init_db(self):
+        with self.lock, self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS phashes (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    hash INTEGER NOT NULL,
+                    color TEXT NOT NULL,
+                    source_url TEXT,
+                    outputs TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            ''')
+            for entry_id, kind, value in self.conn.execute('SELECT id, kind, hash FROM phashes'):
+                self._tree(kind).add(value & 0xFFFFFFFFFFFFFFFF, entry_id)
+
+    def _tree(self, kind):
+        if kind not in self.trees:
+            self.trees[kind] = BKTree()
+        return self.trees[kind]
+
+    def find(self, kind, signature):
+        """Outputs recorded for the nearest near-duplicate of `signature`, or None"""
+        value, color = signature
+        with self.lock:
+            for distance, entry_id in self._tree(kind).search(value, self.max_distance):
+                row = self.conn.execute('SELECT outputs, source_url, color FROM phashes WHERE id=?', (entry_id,)).fetchone()
+                if max(abs(a - b) for a, b in zip(color, json.loads(row[2]))) <= self.max_color_delta:
+                    self.counters['hits'] += 1
+                    break
+            else:
+                self.counters['misses'] += 1
+                return None
+        logger.info(f"🪞 Near-duplicate of {row[1]} (distance {distance}) - reusing its {kind} outputs")
+        return json.loads(row[0])
+
+    def add(self, kind, signature, outputs, source_url=None):
+        value, color = signature
+        with self.lock, self.conn:
+            # SQLite integers are signed 64-bit
+            signed = value - (1 << 64) if value >= (1 << 63) else value
+            cur = self.conn.execute(
+                'INSERT INTO phashes (kind, hash, color, source_url, outputs, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (kind, signed, json.dumps(color), source_url, json.dumps(outputs), time.time())
+            )
+            self._tree(kind).add(value, cur.lastrowid)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['entries'] = {kind: tree.size for kind, tree in self.trees.items()}
+        return stats
+
+_perceptual_index = None
+_perceptual_index_lock = threading.Lock()
+
+def get_perceptual_index():
+    global _perceptual_index
+    with _perceptual_index_lock:
+        if _perceptual_index is None:
+            _perceptual_index = PerceptualIndex()
+        return _perceptual_index
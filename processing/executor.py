@@ -0,0 +1,112 @@
+import os
+import sys
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger("processing")
+
+def _init_worker(memory_limit_mb, max_image_pixels):
+    """Runs once in each worker process: cap its address space and decode size"""
+    if memory_limit_mb:
+        try:
+            import resource
+            limit = memory_limit_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (ImportError, ValueError, OSError) as e:
+            logging.getLogger("processing").warning(f"⚠️ Could not apply worker memory cap: {str(e)}")
+    if max_image_pixels:
+        from PIL import Image
+        Image.MAX_IMAGE_PIXELS = max_image_pixels
+
+class ImageExecutor:
+    """Process pool for Pillow decode/composite/encode work.
+
+    Tasks are module-level functions that take encoded image bytes and
+    return encoded bytes, so only compressed data crosses the process
+    boundary. Workers are recycled after IMAGE_MAX_TASKS_PER_CHILD tasks
+    and each one is capped at IMAGE_WORKER_MEMORY_MB of address space.
+    IMAGE_WORKERS=0 runs tasks inline.
+    """
+
+    def __init__(self, workers=None, max_tasks_per_child=None, memory_limit_mb=None, max_image_pixels=None):
+        self.workers = workers if workers is not None else int(os.getenv('IMAGE_WORKERS', os.cpu_count() or 1))
+        self.max_tasks_per_child = max_tasks_per_child or int(os.getenv('IMAGE_MAX_TASKS_PER_CHILD', 200))
+        self.memory_limit_mb = memory_limit_mb if memory_limit_mb is not None else int(os.getenv('IMAGE_WORKER_MEMORY_MB', 1024))
+        self.max_image_pixels = max_image_pixels or int(os.getenv('IMAGE_MAX_PIXELS', 60_000_000))
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                kwargs = {
+                    'max_workers': self.workers,
+                    'mp_context': multiprocessing.get_context('spawn'),
+                    'initializer': _init_worker,
+                    'initargs': (self.memory_limit_mb, self.max_image_pixels),
+                }
+                # 3.11 deadlocks replacing the only worker while tasks are queued, so a
+                # single-worker pool there runs without recycling (the memory cap still applies)
+                if sys.version_info >= (3, 12) or (sys.version_info >= (3, 11) and self.workers > 1):
+                    kwargs['max_tasks_per_child'] = self.max_tasks_per_child
+                self._pool = ProcessPoolExecutor(**kwargs)
+                logger.info(f"🧵 Started image process pool ({self.workers} workers)")
+            return self._pool
+
+    def _reset_if_broken(self):
+        """Replace a pool broken by a crashed (e.g. over-memory) worker"""
+        with self._lock:
+            pool = self._pool
+            if pool is None or not getattr(pool, '_broken', False):
+                return
+            self._pool = None
+        logger.warning("⚠️ Image worker crashed - restarting process pool")
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, fn, *args):
+        """Run fn(*args) in a worker; returns a Future"""
+        if self.workers <= 0:
+            future = Future()
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        try:
+            return self._get_pool().submit(fn, *args)
+        except BrokenProcessPool:
+            self._reset_if_broken()
+            return self._get_pool().submit(fn, *args)
+
+    def run(self, fn, *args, timeout=None):
+        """Submit and wait; a worker crash surfaces as BrokenProcessPool"""
+        try:
+            return self.submit(fn, *args).result(timeout)
+        except BrokenProcessPool:
+            self._reset_if_broken()
+            raise
+
+    def map(self, fn, items, timeout=None):
+        """Run fn over items in parallel; failed items come back as None"""
+        futures = [self.submit(fn, item) for item in items]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result(timeout))
+            except Exception as e:
+                logger.warning(f"⚠️ Image task failed: {type(e).__name__}: {str(e)}")
+                results.append(None)
+        self._reset_if_broken()
+        return results
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+# Shared executor - created lazily on first submit
+image_executor = ImageExecutor()
@@ -1,52 +1,50 @@
-from PIL import Image
-import requests
-from io import BytesIO
-import os
+import logging
+from functools import partial
+from services.image_cache import image_cache
+from services.output_store import get_output_store
+from processing.badges import badge_image
+from processing.executor import image_executor
+from processing.sizing import target_size, sized_image_url, log_decode_stats
+
+logger = logging.getLogger("processing")
 
 def add_badges(image_url):
     """Add UK flag + fast delivery badge to standard products"""
-    try:
-        # Download image
-        response = requests.get(image_url, timeout=15)
-        if response.status_code != 200:
+    return add_badges_batch([image_url])[0]
+
+def add_badges_batch(image_urls):
+    """Add UK flag + fast delivery badge to several images in one call"""
+    size = target_size()
+    output_store = get_output_store()
+    contents = []
+    for image_url in image_urls:
+        # Download image (revalidated against the local cache), CDN-scaled when a target size is set
+        content = image_cache.fetch(sized_image_url(image_url, size), timeout=15)
+        if content is None:
             logger.error(f"❌ Failed to download image: {image_url}")
-            return image_url
-        
-        img = Image.open(BytesIO(response.content)).convert("RGBA")
-        
-        # Add UK flag (bottom-right)
-        try:
-            flag_path = os.path.join(os.path.dirname(__file__), '../static/uk_flag.png')
-            flag = Image.open(flag_path).convert("RGBA")
-            flag = flag.resize((50, 50))
-            
-            # Position: bottom-right with 10px padding
-            position = (img.width - flag.width - 10, img.height - flag.height - 10)
-            img.paste(flag, position, flag)
-        except Exception as e:
-            logger.warning(f"⚠️ Failed to add UK flag: {str(e)}")
-        
-        # Add delivery badge (top-right)
-        try:
-            badge_path = os.path.join(os.path.dirname(__file__), '../static/fast_delivery.png')
-            badge = Image.open(badge_path).convert("RGBA")
-            badge = badge.resize((120, 40))
-            
-            # Position: top-right with 10px padding
-            position = (img.width - badge.width - 10, 10)
-            img.paste(badge, position, badge)
-        except Exception as e:
-            logger.warning(f"⚠️ Failed to add delivery badge: {str(e)}")
-        
-        # Save to buffer
-        buffer = BytesIO()
-        img.convert("RGB").save(buffer, format="JPEG", quality=95)
-        buffer.seek(0)
-        
-        # In real app: upload to CDN and return URL
-        logger.info("✅ Added UK flag and delivery badge")
-        return f"{image_url}?processed=true"
-        
+        contents.append(content)
+    
+    try:
+        # Decode/composite/encode runs across the image process pool
+        rendered = image_executor.map(partial(badge_image, size=size), [c for c in contents if c is not None])
     except Exception as e:
         logger.exception(f"🔥 Badge addition failed: {str(e)}")
-        return image_url  # Return original on failure
+        return list(image_urls)  # Return originals on failure
+    
+    results = []
+    rendered = iter(rendered)
+    for image_url, content in zip(image_urls, contents):
+        result = next(rendered) if content is not None else None
+        if result is None:
+            results.append(image_url)  # Return original on failure
+            continue
+        jpeg, stats = result
+        log_decode_stats(image_url, stats)
+        try:
+            results.append(output_store.put(jpeg))
+        except OSError as e:
+            logger.error(f"❌ Failed to store badged image for {image_url}: {str(e)}")
+            results.append(image_url)
+    
+    logger.info(f"✅ Added UK flag and delivery badge to {sum(r != u for r, u in zip(results, image_urls))}/{len(image_urls)} images")
+    return results
@@ -0,0 +1,94 @@
+from PIL import Image
+from io import BytesIO
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+import os
+import math
+import time
+import logging
+from metrics import STAGE_SECONDS
+
+logger = logging.getLogger("processing")
+
+def target_size():
+    """Longest edge we ever emit (IMAGE_TARGET_SIZE); 0 means keep originals"""
+    return int(os.getenv('IMAGE_TARGET_SIZE', 0))
+
+def is_shopify_cdn(url):
+    parsed = urlparse(url)
+    return parsed.netloc.endswith('cdn.shopify.com') or parsed.path.startswith('/cdn/shop/')
+
+def sized_image_url(url, size=None):
+    """Ask the Shopify CDN for a pre-scaled variant instead of the original.
+
+    IMAGE_CDN_SIZE_STYLE=params (default) adds `width=`/`height=`;
+    `suffix` inserts the legacy `_1024x1024` before the file extension.
+    Non-Shopify URLs are returned unchanged.
+    """
+    size = size if size is not None else target_size()
+    if not size or not is_shopify_cdn(url):
+        return url
+
+    parsed = urlparse(url)
+    if os.getenv('IMAGE_CDN_SIZE_STYLE', 'params') == 'suffix':
+        root, ext = os.path.splitext(parsed.path)
+        if ext and not root.endswith(f"_{size}x{size}"):
+            parsed = parsed._replace(path=f"{root}_{size}x{size}{ext}")
+        return urlunparse(parsed)
+
+    query = [(k, v) for k, v in parse_qsl(parsed.query) if k not in ('width', 'height')]
+    query += [('width', str(size)), ('height', str(size))]
+    return urlunparse(parsed._replace(query=urlencode(query)))
+
+def open_image(content, size=None):
+    """Decode `content`, at reduced scale when a target size is set.
+
+    JPEG `draft()` decodes straight to the smallest 1/2, 1/4 or 1/8 scale that
+    still covers the target, then `thumbnail()` (which uses `reduce()`)
+    finishes the resize. Returns (image, stats) with per-image measurements.
+    """
+    started = time.perf_counter()
+    img = Image.open(BytesIO(content))
+    source_size = img.size
+    if size:
+        # Request the box the thumbnail will actually fill, so wide images can drop further
+        scale = min(1.0, size / max(source_size))
+        img.draft('RGB', (math.ceil(source_size[0] * scale), math.ceil(source_size[1] * scale)))
+        draft_size = img.size
+        img.load()
+        if max(img.size) > size:
+            img.thumbnail((size, size))
+    else:
+        draft_size = img.size
+        img.load()
+
+    stats = {
+        'bytes_in': len(content),
+        'source_size': source_size,
+        'decoded_size': draft_size,
+        'output_size': img.size,
+        'decode_ms': round((time.perf_counter() - started) * 1000, 1),
+    }
+    try:
+        import resource
+        # ru_maxrss is KB on Linux
+        stats['worker_maxrss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    except ImportError:
+        pass
+    return img, stats
+
+def log_decode_stats(url, stats):
+    """One line per image: wire bytes, decoded vs source pixels, decode time.
+
+    Also records the worker's decode/encode times in the stage histograms
+    (pool workers are separate processes, so they can't record them there).
+    """
+    STAGE_SECONDS.labels('decode').observe(stats['decode_ms'] / 1000)
+    if 'encode_ms' in stats:
+        STAGE_SECONDS.labels('encode').observe(stats['encode_ms'] / 1000)
+    source = stats['source_size'][0] * stats['source_size'][1]
+    decoded = stats['decoded_size'][0] * stats['decoded_size'][1]
+    logger.info(
+        f"📐 {url}: {stats['bytes_in'] / 1024:.0f}KB on the wire, decoded "
+        f"{stats['decoded_size'][0]}x{stats['decoded_size'][1]} of {stats['source_size'][0]}x{stats['source_size'][1]} "
+        f"({decoded / source:.0%} of pixels) in {stats['decode_ms']}ms"
+    )
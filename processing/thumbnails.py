@@ -0,0 +1,148 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import threading
+from io import BytesIO
+from services.image_cache import image_cache
+from services.output_store import get_output_store
+from processing.executor import image_executor
+from processing.sizing import open_image, sized_image_url
+
+logger = logging.getLogger("processing")
+
+# Sizes the dashboard asks for; anything else is snapped to the nearest so URLs can't fan out the cache
+THUMBNAIL_SIZES = (120, 240, 480)
+
+FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+}
+
+def make_thumbnail(content, size, fmt):
+    """Process-pool task: encoded image in, thumbnail bytes (WebP or JPEG) out"""
+    img, _ = open_image(content, size)
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    buffer = BytesIO()
+    img.save(buffer, format=FORMATS[fmt][0], quality=80)
+    return buffer.getvalue()
+
+class ThumbnailCache:
+    """Dashboard thumbnails, generated on first request and kept on disk.
+
+    Keyed by source URL, size and format. Approval image URLs never change,
+    so a thumbnail's ETag (its content hash) is stable and it can be served
+    as immutable. Total bytes stay under THUMBNAIL_CACHE_MAX_BYTES by LRU
+    eviction.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.cache_dir = cache_dir or os.getenv('THUMBNAIL_CACHE_DIR', '/tmp/thumbnails')
+        self.max_bytes = max_bytes or int(os.getenv('THUMBNAIL_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(self.cache_dir, 'index.db'), check_same_thread=False, timeout=30)
+        self.lock = threading.RLock()
+        self.counters = {'hits': 0, 'generated': 0, 'errors': 0, 'evictions': 0}
+        with self.lock, self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS thumbnails (
+                    key TEXT PRIMARY KEY,
+                    etag TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            ''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_thumbnails_last_access ON thumbnails (last_access)')
+
+    @staticmethod
+    def snap(size):
+        return min(THUMBNAIL_SIZES, key=lambda allowed: abs(allowed - size))
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, url, size, fmt):
+        """(thumbnail bytes, etag) for an image URL, or (None, None) if the source can't be loaded"""
+        key = hashlib.sha256(f"{url}|{size}|{fmt}".encode()).hexdigest()
+        with self.lock:
+            row = self.conn.execute('SELECT etag FROM thumbnails WHERE key=?', (key,)).fetchone()
+        if row:
+            try:
+                with open(self._path(key), 'rb') as f:
+                    content = f.read()
+                with self.lock, self.conn:
+                    self.conn.execute('UPDATE thumbnails SET last_access=? WHERE key=?', (time.time(), key))
+                    self.counters['hits'] += 1
+                return content, row[0]
+            except OSError:
+                pass
+
+        # Our own outputs are read straight off the store; let the Shopify CDN downscale the rest
+        source = get_output_store().read(url) or image_cache.fetch(sized_image_url(url, size * 2))
+        if source is None:
+            with self.lock:
+                self.counters['errors'] += 1
+            return None, None
+        try:
+            content = image_executor.run(make_thumbnail, source, size, fmt)
+        except Exception as e:
+            with self.lock:
+                self.counters['errors'] += 1
+            logger.warning(f"⚠️ Thumbnail failed for {url}: {str(e)}")
+            return None, None
+
+        etag = hashlib.sha256(content).hexdigest()[:32]
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO thumbnails (key, etag, size, last_access) VALUES (?, ?, ?, ?)',
+                (key, etag, len(content), time.time())
+            )
+            self.counters['generated'] += 1
+        self._evict()
+        return content, etag
+
+    def _evict(self):
+        with self.lock:
+            total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM thumbnails').fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            victims = []
+            for key, size in self.conn.execute('SELECT key, size FROM thumbnails ORDER BY last_access'):
+                if total <= self.max_bytes:
+                    break
+                victims.append(key)
+                total -= size
+            with self.conn:
+                self.conn.executemany('DELETE FROM thumbnails WHERE key=?', [(key,) for key in victims])
+            self.counters['evictions'] += len(victims)
+        for key in victims:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['bytes_cached'] = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM thumbnails').fetchone()[0]
+        stats['max_bytes'] = self.max_bytes
+        return stats
+
+_thumbnail_cache = None
+_thumbnail_cache_lock = threading.Lock()
+
+def get_thumbnail_cache():
+    global _thumbnail_cache
+    with _thumbnail_cache_lock:
+        if _thumbnail_cache is None:
+            _thumbnail_cache = ThumbnailCache()
+        return _thumbnail_cache
@@ -0,0 +1,214 @@
+import os
+import re
+import hashlib
+import logging
+import threading
+from jobs import JobWorkerPool
+from metrics import timed, MEDIA_PUBLISHED
+from services.output_store import get_output_store, CONTENT_TYPES
+
+logger = logging.getLogger("publisher")
+
+# Marker carried in each published image's alt text - how a retry recognises
+# media whose create call went out but whose reply never came back
+REF_PATTERN = re.compile(r'\[ref:([0-9a-f]{12})\]')
+
+class PublishError(Exception):
+    """Some of an approval's images didn't reach Shopify (the job is retried)"""
+
+class Publisher:
+    """Writes approved images back to their Shopify product.
+
+    Each approval becomes a `publish_approval` job on a dedicated pool of
+    PUBLISH_WORKERS threads, so at most that many products upload at once,
+    image processing keeps its own workers, and a product that fails is
+    retried with backoff without holding up the rest. Every processed image
+    has a `publications` row keyed by an idempotency key (product + image
+    content) recording how far it got - staged, sent to productCreateMedia,
+    published - so a retry only redoes what is missing and never adds the
+    same image to a product twice.
+    """
+
+    def __init__(self, shopify, db, store=None, workers=None, alt_text=None):
+        self.shopify = shopify
+        self.db = db
+        self.store = store or get_output_store()
+        self.alt_text = alt_text if alt_text is not None else os.getenv('PUBLISH_ALT_TEXT', 'Product image')
+        self.pool = JobWorkerPool(db, handlers={'publish_approval': self.publish},
+                                  workers=workers or int(os.getenv('PUBLISH_WORKERS', 4)), name='publish')
+        self._lock = threading.Lock()
+        self.counters = {'approved': 0, 'published': 0, 'recovered': 0, 'failed': 0, 'skipped': 0}
+
+    def _count(self, key, amount=1):
+        if amount:
+            with self._lock:
+                self.counters[key] += amount
+            MEDIA_PUBLISHED.labels(key).inc(amount)
+
+    def start(self):
+        self.pool.start()
+
+    def stop(self):
+        self.pool.stop()
+
+    # ===== Entry points =====
+
+    def approve(self, approval_ids):
+        """Approve still-pending approvals and queue them for publishing; returns the ids approved"""
+        approved = self.db.approve_many(approval_ids)
+        for approval_id in approved:
+            self.submit(approval_id)
+        with self._lock:
+            self.counters['approved'] += len(approved)
+        if approved:
+            logger.info(f"👍 Approved {len(approved)} items - publishing to Shopify")
+        return approved
+
+    def submit(self, approval_id):
+        # Keyed per approval, so a double click or a retry-all doesn't queue it twice
+        return self.pool.enqueue_coalesced('publish_approval', f"publish:{approval_id}",
+                                           {'approval_id': approval_id}, 0, 0)
+
+    def retry_unpublished(self):
+        """Queue every approval with images still missing from Shopify (e.g. after jobs gave up)"""
+        approval_ids = self.db.unpublished_approvals()
+        for approval_id in approval_ids:
+            self.submit(approval_id)
+        return approval_ids
+
+    # ===== Job =====
+
+    def idempotency_key(self, product_id, image):
+        """Same product + same image content -> same key, however often it is approved or retried"""
+        identity = self.store.key_for(image['url']) or image.get('content_hash') or image['url']
+        return hashlib.sha256(f"{product_id}:{identity}".encode()).hexdigest()
+
+    def alt(self, row):
+        return f"{self.alt_text} [ref:{row['idempotency_key'][:12]}]".strip()
+
+    def publish(self, approval_id):
+        """Job handler: get an approval's processed images onto its product"""
+        if not self.shopify.enabled:
+            raise PublishError("Shopify credentials are not configured")
+        approval = self.db.get_approval(approval_id)
+        if approval is None or approval[1] != 'approved':
+            logger.info(f"⏭️ Approval {approval_id} is no longer approved - not publishing")
+            return
+        product_id = approval[0]
+        images = self.db.images_for([approval_id])[approval_id]
+        # A processing fallback can hand back the original, which is already on the product
+        originals = {image['url'] for image in images['original']}
+        items = [(self.idempotency_key(product_id, image), image['id'])
+                 for image in images['processed'] if image['url'] not in originals]
+        self._count('skipped', len(images['processed']) - len(items))
+        rows = self.db.plan_publications(approval_id, product_id, items)
+        todo = [row for row in rows if row['status'] != 'published']
+        if not todo:
+            return
+
+        with timed('shopify_publish'):
+            self._recover(product_id, todo)
+            self._stage(todo)
+            self._create(product_id, todo)
+
+        unfinished = [row for row in todo if row['status'] != 'published']
+        if unfinished:
+            raise PublishError(f"{len(unfinished)}/{len(rows)} images for product {product_id} not published: "
+                               f"{unfinished[0]['last_error'] or 'not created'}")
+        logger.info(f"🚀 Published {len(todo)} images to product {product_id} (approval {approval_id})")
+
+    def _recover(self, product_id, todo):
+        """Resolve images whose create call was sent but never answered"""
+        uncertain = [row for row in todo if row['status'] == 'creating']
+        if not uncertain:
+            return
+        existing = {}
+        for media in self.shopify.product_media(product_id):
+            match = REF_PATTERN.search(media.get('alt') or '')
+            if match:
+                existing[match.group(1)] = media['id']
+        for row in uncertain:
+            media_id = existing.get(row['idempotency_key'][:12])
+            if media_id:
+                row.update(status='published', media_id=media_id, last_error=None)
+                self._count('recovered')
+            else:
+                row['status'] = 'staged'  # never landed - send it again
+        self.db.update_publications(uncertain)
+
+    def _stage(self, todo):
+        """Upload our own images to staged targets; other URLs Shopify fetches itself"""
+        pending = [row for row in todo if row['status'] in ('pending', 'failed')]
+        if not pending:
+            return
+        local = []
+        for row in pending:
+            key = self.store.key_for(row['url'])
+            if key is None:
+                row.update(status='staged', source_url=row['url'], last_error=None)
+                continue
+            content = self.store.read(row['url'])
+            if content is None:
+                row.update(status='failed', last_error=f"Output {key} missing from the store")
+                continue
+            local.append((row, key, content))
+
+        if local:
+            try:
+                targets = self.shopify.staged_uploads_create([
+                    {'filename': key, 'mime_type': CONTENT_TYPES[key.rsplit('.', 1)[1]], 'size': len(content)}
+                    for _, key, content in local
+                ])
+            except Exception as e:
+                for row, _, _ in local:
+                    row.update(status='failed', last_error=f"Staging failed: {e}")
+                targets = []
+            for (row, key, content), target in zip(local, targets):
+                try:
+                    self.shopify.upload_staged(target, content, key, CONTENT_TYPES[key.rsplit('.', 1)[1]])
+                except Exception as e:
+                    row.update(status='failed', last_error=f"Upload failed: {e}")
+                else:
+                    row.update(status='staged', source_url=target['resourceUrl'], last_error=None)
+        self.db.update_publications(pending)
+        self._count('failed', sum(1 for row in pending if row['status'] == 'failed'))
+
+    def _create(self, product_id, todo):
+        """One productCreateMedia call for every staged image of the product"""
+        ready = [row for row in todo if row['status'] == 'staged']
+        if not ready:
+            return
+        # Persisted first: if the reply is lost, the next attempt checks the product before resending
+        for row in ready:
+            row['status'] = 'creating'
+        self.db.update_publications(ready)
+
+        media, errors = self.shopify.product_create_media(
+            product_id, [{'originalSource': row['source_url'], 'alt': self.alt(row)} for row in ready])
+        created = {}
+        for item in media:
+            match = REF_PATTERN.search(item.get('alt') or '')
+            if match:
+                created[match.group(1)] = item['id']
+
+        for index, row in enumerate(ready):
+            media_id = created.get(row['idempotency_key'][:12])
+            if media_id:
+                row.update(status='published', media_id=media_id, last_error=None)
+            elif index in errors:
+                # Rejected source (e.g. an expired staged upload) - stage it again next time
+                row.update(status='failed', source_url=None, last_error='; '.join(map(str, errors[index])))
+            else:
+                # Held back by another image's error - the staged upload is still good
+                row.update(status='staged', last_error='; '.join(map(str, errors.get(None) or ['Not created'])))
+        self.db.update_publications(ready)
+        published = sum(1 for row in ready if row['status'] == 'published')
+        self._count('published', published)
+        self._count('failed', len(ready) - published)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats['images'] = self.db.publication_counts()
+        stats['workers'] = self.pool.workers
+        return stats
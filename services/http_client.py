@@ -0,0 +1,82 @@
+import os
+import logging
+import importlib.util
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger("http")
+
+class HttpClient:
+    """One pooled requests.Session shared by every outbound HTTP call.
+
+    Keep-alive pools are kept per host (Shopify Admin API, Shopify CDN, image
+    hosts), so repeat calls skip the TCP + TLS handshake. Pool sizes and the
+    default timeout come from the environment.
+    """
+
+    def __init__(self, pool_connections=None, pool_maxsize=None, timeout=None, retries=None):
+        self.pool_connections = pool_connections or int(os.getenv('HTTP_POOL_HOSTS', 10))
+        self.pool_maxsize = pool_maxsize or int(os.getenv('HTTP_POOL_MAXSIZE', 20))
+        self.timeout = timeout or float(os.getenv('HTTP_TIMEOUT', 30))
+        retries = retries if retries is not None else int(os.getenv('HTTP_CONNECT_RETRIES', 2))
+
+        # Only retry connection setup here - status-based retries (429 etc.) belong to the callers
+        self.adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            max_retries=Retry(total=retries, connect=retries, read=0, status=0, backoff_factor=0.2,
+                              allowed_methods=None, raise_on_status=False),
+        )
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        self._lock = threading.Lock()
+        self._requests = 0
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        with self._lock:
+            self._requests += 1
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        """Connection reuse per host: requests sent vs connections opened"""
+        hosts = {}
+        pools = self.adapter.poolmanager.pools
+        with pools.lock:
+            pool_list = list(pools._container.values())
+        for pool in pool_list:
+            host = hosts.setdefault(pool.host, {'requests': 0, 'connections': 0})
+            host['requests'] += pool.num_requests
+            host['connections'] += pool.num_connections
+        total_requests = sum(h['requests'] for h in hosts.values())
+        total_connections = sum(h['connections'] for h in hosts.values())
+        for host in hosts.values():
+            host['reuse_ratio'] = round(1 - host['connections'] / host['requests'], 3) if host['requests'] else 0.0
+        return {
+            'requests': self._requests,
+            'connections_opened': total_connections,
+            'reuse_ratio': round(1 - total_connections / total_requests, 3) if total_requests else 0.0,
+            'hosts': hosts,
+        }
+
+def replicate_transport():
+    """Pooled httpx transport for the Replicate client, with HTTP/2 when `h2` is installed"""
+    import httpx
+    http2 = importlib.util.find_spec('h2') is not None
+    limits = httpx.Limits(
+        max_connections=int(os.getenv('HTTP_POOL_MAXSIZE', 20)),
+        max_keepalive_connections=int(os.getenv('HTTP_POOL_MAXSIZE', 20)),
+    )
+    return httpx.HTTPTransport(http2=http2, limits=limits, retries=int(os.getenv('HTTP_CONNECT_RETRIES', 2)))
+
+# Process-wide client - import this rather than calling requests.get directly
+http_client = HttpClient()
@@ -0,0 +1,173 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import threading
+from services.http_client import http_client
+from metrics import timed, IMAGE_CACHE_REQUESTS, IMAGE_DOWNLOAD_BYTES
+
+logger = logging.getLogger("image_cache")
+
+class ImageCache:
+    """On-disk cache for downloaded source images.
+
+    Blobs are stored once per SHA-256 of their content; a URL index records
+    which blob each URL last resolved to along with its ETag/Last-Modified, so
+    a repeat fetch is a conditional GET and an unchanged image costs a 304.
+    Total blob bytes are held under `max_bytes` by evicting least recently
+    used blobs.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.cache_dir = cache_dir or os.getenv('IMAGE_CACHE_DIR', '/tmp/image_cache')
+        self.max_bytes = max_bytes or int(os.getenv('IMAGE_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(self.cache_dir, 'index.db'), check_same_thread=False, timeout=30)
+        self.lock = threading.RLock()
+        self.counters = {'hits': 0, 'misses': 0, 'errors': 0, 'evictions': 0,
+                         'bytes_downloaded': 0, 'bytes_saved': 0}
+        self._init_db()
+
+    def _init_db(self):
+        with self.lock, self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS blobs (
+                    sha256 TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            ''')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS urls (
+                    url TEXT PRIMARY KEY,
+                    sha256 TEXT NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT
+                )
+            ''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_blobs_last_access ON blobs (last_access)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_urls_sha256 ON urls (sha256)')
+
+    def _blob_path(self, sha256):
+        return os.path.join(self.cache_dir, sha256[:2], sha256)
+
+    def _count(self, key, amount=1):
+        if key in ('hits', 'misses', 'errors'):
+            IMAGE_CACHE_REQUESTS.labels(key).inc()
+        elif key == 'bytes_downloaded':
+            IMAGE_DOWNLOAD_BYTES.inc(amount)
+        with self.lock:
+            self.counters[key] += amount
+
+    def _lookup(self, url):
+        with self.lock:
+            row = self.conn.execute('SELECT sha256, etag, last_modified FROM urls WHERE url=?', (url,)).fetchone()
+        if row and os.path.exists(self._blob_path(row[0])):
+            return row
+        return None
+
+    def fetch(self, url, timeout=30, headers=None):
+        """Return the image bytes for `url` (None if it could not be downloaded)"""
+        cached = self._lookup(url)
+        request_headers = dict(headers or {})
+        if cached:
+            if cached[1]:
+                request_headers['If-None-Match'] = cached[1]
+            if cached[2]:
+                request_headers['If-Modified-Since'] = cached[2]
+
+        try:
+            with timed('image_download'):
+                response = http_client.get(url, timeout=timeout, headers=request_headers)
+        except Exception as e:
+            self._count('errors')
+            logger.warning(f"⚠️ Image download failed for {url}: {str(e)}")
+            return None
+
+        if response.status_code == 304 and cached:
+            content = self._read(cached[0])
+            if content is not None:
+                self._count('hits')
+                self._count('bytes_saved', len(content))
+                return content
+            # Blob vanished between lookup and read - fall back to a full download
+            response = http_client.get(url, timeout=timeout, headers=headers)
+
+        if response.status_code != 200:
+            self._count('errors')
+            logger.error(f"❌ Failed to download image ({response.status_code}): {url}")
+            return None
+
+        content = response.content
+        self._count('misses')
+        self._count('bytes_downloaded', len(content))
+        self._store(url, content, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return content
+
+    def _read(self, sha256):
+        try:
+            with open(self._blob_path(sha256), 'rb') as f:
+                content = f.read()
+        except OSError:
+            return None
+        with self.lock, self.conn:
+            self.conn.execute('UPDATE blobs SET last_access=? WHERE sha256=?', (time.time(), sha256))
+        return content
+
+    def _store(self, url, content, etag, last_modified):
+        sha256 = hashlib.sha256(content).hexdigest()
+        path = self._blob_path(sha256)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT INTO blobs (sha256, size, last_access) VALUES (?, ?, ?) '
+                'ON CONFLICT(sha256) DO UPDATE SET last_access=excluded.last_access',
+                (sha256, len(content), time.time())
+            )
+            self.conn.execute(
+                'INSERT OR REPLACE INTO urls (url, sha256, etag, last_modified) VALUES (?, ?, ?, ?)',
+                (url, sha256, etag, last_modified)
+            )
+        self._evict()
+
+    def _evict(self):
+        """Drop least recently used blobs (and the URLs pointing at them) until under budget"""
+        with self.lock:
+            total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            victims = []
+            for sha256, size in self.conn.execute('SELECT sha256, size FROM blobs ORDER BY last_access'):
+                if total <= self.max_bytes:
+                    break
+                victims.append(sha256)
+                total -= size
+            with self.conn:
+                for sha256 in victims:
+                    self.conn.execute('DELETE FROM blobs WHERE sha256=?', (sha256,))
+                    self.conn.execute('DELETE FROM urls WHERE sha256=?', (sha256,))
+            self.counters['evictions'] += len(victims)
+        for sha256 in victims:
+            try:
+                os.remove(self._blob_path(sha256))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['bytes_cached'] = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        stats['max_bytes'] = self.max_bytes
+        return stats
+
+# Process-wide cache shared by every image download
+image_cache = ImageCache()
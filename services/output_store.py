@@ -0,0 +1,200 @@
+import os
+import re
+import hashlib
+import logging
+import tempfile
+import threading
+from urllib.parse import urlparse
+from services.http_client import http_client
+
+logger = logging.getLogger("output_store")
+
+# Keys are <sha256 of the content>.<ext>
+KEY_PATTERN = re.compile(r'^[0-9a-f]{64}\.(jpg|png|webp)$')
+
+CONTENT_TYPES = {
+    'jpg': 'image/jpeg',
+    'png': 'image/png',
+    'webp': 'image/webp',
+}
+
+# Route the app serves store keys under
+URL_PREFIX = '/outputs/'
+
+class OutputStore:
+    """Where processed images are persisted and how they are addressed.
+
+    `put()` stores bytes (or an iterable of byte chunks) and returns the
+    public URL; `put_url()` streams a remote output (e.g. a Replicate
+    delivery URL, which expires) into the store. Backends implement `_write`
+    and `open`; ones with a local `path()` are served by the app's /outputs
+    route.
+    """
+
+    def __init__(self, base_url=None):
+        self.base_url = (base_url if base_url is not None else os.getenv(
+            'OUTPUT_BASE_URL', os.getenv('BASE_URL', 'https://shopify-image-ai-production.up.railway.app'))).rstrip('/')
+        self.lock = threading.Lock()
+        self.counters = {'writes': 0, 'deduplicated': 0, 'bytes_written': 0, 'errors': 0}
+
+    def _count(self, key, amount=1):
+        with self.lock:
+            self.counters[key] += amount
+
+    def url(self, key):
+        return f"{self.base_url}{URL_PREFIX}{key}"
+
+    def key_for(self, url):
+        """Store key behind one of our URLs, or None for anything else"""
+        parsed = urlparse(url or '')
+        if not parsed.path.startswith(URL_PREFIX):
+            return None
+        if parsed.netloc and parsed.netloc != urlparse(self.base_url).netloc:
+            return None
+        key = parsed.path[len(URL_PREFIX):]
+        return key if KEY_PATTERN.match(key) else None
+
+    def put(self, data, ext='jpg'):
+        """Store `data` (bytes or an iterable of byte chunks) once per content hash; returns its URL"""
+        if ext not in CONTENT_TYPES:
+            raise ValueError(f"Unsupported output type: {ext}")
+        chunks = [data] if isinstance(data, (bytes, bytearray, memoryview)) else data
+        key = self._write(chunks, ext)
+        return self.url(key)
+
+    def put_url(self, url, timeout=60):
+        """Stream a remote image into the store; returns our URL, or None if it couldn't be fetched"""
+        try:
+            with http_client.get(url, stream=True, timeout=timeout) as response:
+                if response.status_code != 200:
+                    self._count('errors')
+                    logger.error(f"❌ Failed to fetch output ({response.status_code}): {url}")
+                    return None
+                content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+                ext = next((e for e, t in CONTENT_TYPES.items() if t == content_type), None)
+                if ext is None:
+                    suffix = os.path.splitext(urlparse(url).path)[1].lstrip('.').lower()
+                    ext = 'jpg' if suffix == 'jpeg' else suffix if suffix in CONTENT_TYPES else 'jpg'
+                return self.put(response.iter_content(64 * 1024), ext)
+        except Exception as e:
+            self._count('errors')
+            logger.warning(f"⚠️ Failed to store output {url}: {str(e)}")
+            return None
+
+    def read(self, url):
+        """Bytes behind one of our URLs (None for other URLs or missing keys)"""
+        key = self.key_for(url)
+        if key is None:
+            return None
+        try:
+            with self.open(key) as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+class LocalOutputStore(OutputStore):
+    """Content-addressed files under OUTPUT_STORE_DIR, sharded by hash prefix.
+
+    Writes stream into a temp file in the store (hashing as they go) and are
+    renamed into place, so readers never see a partial file and identical
+    outputs are kept once.
+    """
+
+    def __init__(self, root=None, base_url=None):
+        super().__init__(base_url)
+        self.root = root or os.getenv('OUTPUT_STORE_DIR', '/tmp/outputs')
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, key):
+        if not KEY_PATTERN.match(key):
+            raise ValueError(f"Invalid output key: {key}")
+        return os.path.join(self.root, key[:2], key)
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+    def _write(self, chunks, ext):
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.partial')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            key = f"{digest.hexdigest()}.{ext}"
+            path = self.path(key)
+            if os.path.exists(path):
+                os.remove(tmp_path)
+                self._count('deduplicated')
+                return key
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._count('writes')
+        self._count('bytes_written', size)
+        return key
+
+def parse_byte_range(header, size):
+    """(start, end) inclusive for a single `bytes=` Range header.
+
+    Returns None if the range can't be satisfied (416), or () for headers
+    that should be ignored - malformed or multi-range - so the whole file is
+    served instead, as RFC 9110 allows.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return ()
+    first, _, last = header[len('bytes='):].strip().partition('-')
+    try:
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        elif last:
+            # Suffix range: the final N bytes
+            start, end = max(0, size - int(last)), size - 1
+        else:
+            return ()
+    except ValueError:
+        return ()
+    if start >= size or start > end:
+        return None
+    return start, end
+
+def iter_file_range(path, start, end, chunk_size=64 * 1024):
+    """Yield bytes start..end (inclusive) of a file in chunks"""
+    remaining = end - start + 1
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+# OUTPUT_STORE_BACKEND -> store class
+BACKENDS = {
+    'local': LocalOutputStore,
+}
+
+_output_store = None
+_output_store_lock = threading.Lock()
+
+def get_output_store():
+    global _output_store
+    with _output_store_lock:
+        if _output_store is None:
+            backend = os.getenv('OUTPUT_STORE_BACKEND', 'local')
+            if backend not in BACKENDS:
+                raise ValueError(f"Unknown OUTPUT_STORE_BACKEND {backend!r} (choose from {', '.join(BACKENDS)})")
+            _output_store = BACKENDS[backend]()
+            logger.info(f"🗄️ Processed images go to the {backend} output store")
+        return _output_store
@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from services.image_cache import image_cache
+from metrics import PREDICTION_CACHE_REQUESTS
+
+logger = logging.getLogger("replicate")
+
+class _Flight:
+    """One in-progress prediction that identical concurrent requests wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.output = None
+        self.error = None
+
+class PredictionCache:
+    """Persistent, single-flight cache of Replicate outputs.
+
+    Keys are the model version plus a canonical hash of the input, with image
+    URLs replaced by the SHA-256 of the image content, so the same picture
+    behind a new URL still hits and a changed picture behind the same URL
+    misses. Entries expire after PREDICTION_CACHE_TTL seconds (Replicate's
+    output URLs are only served for about an hour, hence the default) and
+    the store is held under PREDICTION_CACHE_MAX_BYTES by LRU eviction.
+    """
+
+    def __init__(self, db_path=None, ttl=None, max_bytes=None):
+        db_path = db_path or os.getenv('PREDICTION_CACHE_PATH', '/tmp/predictions.db')
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.ttl = ttl or float(os.getenv('PREDICTION_CACHE_TTL', 3600))
+        self.max_bytes = max_bytes or int(os.getenv('PREDICTION_CACHE_MAX_BYTES', 50 * 1024 * 1024))
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self.lock = threading.RLock()
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self.counters = {'hits': 0, 'coalesced': 0, 'misses': 0, 'evictions': 0}
+        self._init_db()
+
+    def _init_db(self):
+        with self.lock, self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS predictions (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    output TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            ''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_predictions_last_access ON predictions (last_access)')
+
+    def _canonical(self, value):
+        """Input with image URLs swapped for content hashes; None if an image can't be fetched"""
+        if isinstance(value, dict):
+            items = {}
+            for k, v in value.items():
+                items[k] = self._canonical(v)
+                if items[k] is None and v is not None:
+                    return None
+            return items
+        if isinstance(value, (list, tuple)):
+            items = [self._canonical(v) for v in value]
+            if any(i is None and v is not None for i, v in zip(items, value)):
+                return None
+            return items
+        if isinstance(value, str) and value.startswith(('http://', 'https://')):
+            content = image_cache.fetch(value)
+            if content is None:
+                return None
+            return {'sha256': hashlib.sha256(content).hexdigest()}
+        return value
+
+    def key(self, model, input_data):
+        """Cache key for a prediction, or None if the input can't be fingerprinted"""
+        canonical = self._canonical(input_data)
+        if canonical is None:
+            return None
+        payload = json.dumps({'model': model, 'input': canonical}, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key):
+        """(True, output) on a fresh hit, else (False, None)"""
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute('SELECT output, created_at FROM predictions WHERE key=?', (key,)).fetchone()
+            if row is None:
+                return False, None
+            if now - row[1] > self.ttl:
+                self.conn.execute('DELETE FROM predictions WHERE key=?', (key,))
+                return False, None
+            self.conn.execute('UPDATE predictions SET last_access=? WHERE key=?', (now, key))
+        return True, json.loads(row[0])
+
+    def put(self, key, model, output):
+        try:
+            encoded = json.dumps(output)
+        except (TypeError, ValueError):
+            logger.warning(f"⚠️ Not caching non-JSON output from {model}")
+            return
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO predictions (key, model, output, size, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?)',
+                (key, model, encoded, len(encoded), now, now)
+            )
+        self._evict()
+
+    def _evict(self):
+        with self.lock:
+            total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM predictions').fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            victims = []
+            for key, size in self.conn.execute('SELECT key, size FROM predictions ORDER BY last_access'):
+                if total <= self.max_bytes:
+                    break
+                victims.append(key)
+                total -= size
+            with self.conn:
+                self.conn.executemany('DELETE FROM predictions WHERE key=?', [(key,) for key in victims])
+            self.counters['evictions'] += len(victims)
+
+    def get_or_run(self, key, model, run):
+        """Return (output, cached). Concurrent callers with the same key share one `run()`"""
+        hit, output = self.get(key)
+        if hit:
+            with self.lock:
+                self.counters['hits'] += 1
+            PREDICTION_CACHE_REQUESTS.labels('hits').inc()
+            return output, True
+
+        with self._inflight_lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            with self.lock:
+                self.counters['coalesced'] += 1
+            PREDICTION_CACHE_REQUESTS.labels('coalesced').inc()
+            return flight.output, True
+
+        try:
+            flight.output = run()
+            self.put(key, model, flight.output)
+            with self.lock:
+                self.counters['misses'] += 1
+            PREDICTION_CACHE_REQUESTS.labels('misses').inc()
+            return flight.output, False
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(key, None)
+            flight.done.set()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['entries'] = self.conn.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+        return stats
@@ -1,22 +1,197 @@
 import replicate
 import os
+import logging
+import time
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from utils import track_cost
+from models import get_cost_ledger
+from services.http_client import replicate_transport
+from services.prediction_cache import PredictionCache
+from metrics import timed
 
 load_dotenv()
+logger = logging.getLogger("replicate")
+
+_client = None
+_client_lock = threading.Lock()
+_cache = None
+
+def get_client():
+    """Process-wide Replicate client so every service instance shares one connection pool"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = replicate.Client(api_token=os.getenv('REPLICATE_API_TOKEN'), transport=replicate_transport())
+        return _client
+
+def get_prediction_cache():
+    """Process-wide prediction cache (shared so single-flight spans service instances)"""
+    global _cache
+    with _client_lock:
+        if _cache is None:
+            _cache = PredictionCache()
+        return _cache
+
+class BudgetTracker:
+    """Daily spend check with reservations on top of the shared cost ledger.
+
+    A prediction reserves its cost before launch and either commits it on
+    success or releases it on failure, so parallel predictions can never
+    jointly overshoot DAILY_BUDGET. Committed spend lives in the ledger, so
+    it survives restarts and is shared by every service instance.
+    """
+
+    def __init__(self, limit, ledger=None):
+        self.limit = limit
+        self.ledger = ledger or get_cost_ledger()
+        self.reserved = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def spent(self):
+        return self.ledger.today_total()
+
+    def reserve(self, amount):
+        with self._lock:
+            if self.spent + self.reserved + amount > self.limit:
+                raise Exception(f"Daily budget exceeded (${self.limit})")
+            self.reserved += amount
+
+    def commit(self, amount, model=None):
+        with self._lock:
+            self.reserved = max(0.0, self.reserved - amount)
+            track_cost(amount, model=model)  # Persist cost tracking
+
+    def release(self, amount):
+        with self._lock:
+            self.reserved = max(0.0, self.reserved - amount)
+
+_budget = None
+
+def get_budget():
+    global _budget
+    with _client_lock:
+        if _budget is None:
+            _budget = BudgetTracker(float(os.getenv('DAILY_BUDGET', 5.00)))
+        return _budget
+
+# Cap on simultaneous in-flight predictions per model
+_model_slots = {}
+_model_slots_lock = threading.Lock()
+
+def model_slot(model_name):
+    """The model's concurrency semaphore - created under a lock so every caller shares one"""
+    with _model_slots_lock:
+        slot = _model_slots.get(model_name)
+        if slot is None:
+            slot = _model_slots[model_name] = threading.BoundedSemaphore(
+                int(os.getenv('REPLICATE_MAX_CONCURRENCY_PER_MODEL', 4)))
+        return slot
 
 class ReplicateService:
-    def __init__(self):
-        self.client = replicate.Client(api_token=os.getenv('REPLICATE_API_TOKEN'))
-        self.daily_cost = 0.0
-        self.budget = float(os.getenv('DAILY_BUDGET', 5.00))
+    def __init__(self, client=None, cache=None, budget=None):
+        self.client = client or get_client()
+        self.cache = cache or get_prediction_cache()
+        self.spend = budget or get_budget()
+        self.budget = self.spend.limit
+        self.poll_interval = float(os.getenv('REPLICATE_POLL_INTERVAL', 0.5))
+        self.timeout = float(os.getenv('REPLICATE_PREDICTION_TIMEOUT', 600))
+    
+    @property
+    def daily_cost(self):
+        return self.spend.spent
+    
+    def create_prediction(self, model_name, input_data):
+        """Start a prediction and return its handle without waiting for it"""
+        ref, _, version = model_name.partition(':')
+        if version:
+            return self.client.predictions.create(version=version, input=input_data)
+        return self.client.models.predictions.create(model=ref, input=input_data)
+    
+    def wait_for(self, prediction):
+        """Poll a created prediction until it settles; cancels it after REPLICATE_PREDICTION_TIMEOUT"""
+        deadline = time.monotonic() + self.timeout
+        while prediction.status not in ('succeeded', 'failed', 'canceled'):
+            if time.monotonic() > deadline:
+                status = prediction.status
+                prediction.cancel()
+                raise TimeoutError(f"Prediction {prediction.id} still {status} after {self.timeout:g}s - canceled")
+            time.sleep(self.poll_interval)
+            prediction.reload()
+        if prediction.status != 'succeeded':
+            raise Exception(f"Prediction {prediction.id} {prediction.status}: {prediction.error}")
+        return prediction.output
     
-    def run_model(self, model_name, input_data, cost_per_run=0.001):
-        """Run model with budget protection"""
-        if self.daily_cost + cost_per_run > self.budget:
-            raise Exception(f"Daily budget exceeded (${self.budget})")
+    def run_model(self, model_name, input_data, cost_per_run=0.001, variant=None):
+        """Run model with budget protection; identical inputs are served from the prediction cache.
+
+        `variant` distinguishes deliberate repeats of the same input (e.g. the
+        Nth generated image) in the cache key without being sent to the model.
+        """
+        def predict():
+            # Budget is reserved once a slot is held, so queued predictions don't tie it up
+            with model_slot(model_name):
+                self.spend.reserve(cost_per_run)
+                try:
+                    with timed('predict'):
+                        output = self.wait_for(self.create_prediction(model_name, input_data))
+                except Exception:
+                    self.spend.release(cost_per_run)
+                    raise
+                self.spend.commit(cost_per_run, model=model_name)
+            return output
+        
+        key = self.cache.key(model_name, input_data if variant is None else {'input': input_data, 'variant': variant})
+        if key is None:
+            return predict()
         
-        output = self.client.run(model_name, input=input_data)
-        self.daily_cost += cost_per_run
-        track_cost(cost_per_run)  # Persist cost tracking
+        output, cached = self.cache.get_or_run(key, model_name, predict)
+        if cached:
+            track_cost(0.0, model=model_name, cached=True)  # Cache hits cost nothing
         return output
+
+class PredictionExecutor:
+    """Fan independent predictions out concurrently.
+
+    Every prediction is created on Replicate as soon as it is submitted
+    (subject to the per-model cap) and then polled, so a product's wall-clock
+    time tracks its slowest prediction rather than the sum. Each one waits on
+    a pool thread rather than an event loop, because the processing path
+    calling it is synchronous throughout. Budget reservation, caching and
+    single-flight all happen inside ReplicateService.run_model.
+    """
+
+    def __init__(self, max_workers=None):
+        self.pool = ThreadPoolExecutor(
+            max_workers=max_workers or int(os.getenv('REPLICATE_MAX_WORKERS', 8)),
+            thread_name_prefix="replicate"
+        )
+
+    def submit(self, service, model_name, input_data, cost_per_run=0.001, variant=None):
+        # Carry the caller's context (product attribution) onto the pool thread
+        ctx = contextvars.copy_context()
+        return self.pool.submit(ctx.run, service.run_model, model_name, input_data, cost_per_run, variant)
+
+    def run_all(self, service, requests):
+        """Run (model_name, input_data, cost_per_run[, variant]) requests concurrently.
+
+        Returns outputs in request order; if any failed, the first error is
+        raised after all have settled (failed ones have released their budget).
+        """
+        futures = [self.submit(service, *request) for request in requests]
+        results, first_error = [], None
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.warning(f"⚠️ Prediction failed: {str(e)}")
+                first_error = first_error or e
+                results.append(None)
+        if first_error is not None:
+            raise first_error
+        return results
+
+prediction_executor = PredictionExecutor()
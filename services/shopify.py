@@ -1,12 +1,220 @@
 import requests
 import os
+import json
+import time
 import logging
+import threading
 from dotenv import load_dotenv
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlencode, parse_qs
+from services.http_client import http_client
+from metrics import timed
 
 load_dotenv()
 logger = logging.getLogger("shopify")
 
+# Projection used for catalog walks - everything the pipeline reads, nothing more
+PRODUCT_FIELDS = 'id,title,tags,images,updated_at'
+
+# Bulk export of products + images; nested images come back as separate
+# JSONL lines carrying `__parentId`, always after their parent product
+BULK_PRODUCTS_QUERY = """
+{
+  products {
+    edges {
+      node {
+        id
+        legacyResourceId
+        title
+        tags
+        updatedAt
+        images {
+          edges {
+            node {
+              id
+              url
+              width
+              height
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+BULK_RUN_MUTATION = """
+mutation bulkRun($query: String!) {
+  bulkOperationRunQuery(query: $query) {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
+}
+"""
+
+BULK_STATUS_QUERY = """
+{
+  currentBulkOperation {
+    id status errorCode objectCount url partialDataUrl
+  }
+}
+"""
+
+BULK_CANCEL_MUTATION = """
+mutation bulkCancel($id: ID!) {
+  bulkOperationCancel(id: $id) {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
+}
+"""
+
+# Staged upload targets for product images, in input order
+STAGED_UPLOADS_MUTATION = """
+mutation stagedUploads($input: [StagedUploadInput!]!) {
+  stagedUploadsCreate(input: $input) {
+    stagedTargets { url resourceUrl parameters { name value } }
+    userErrors { field message }
+  }
+}
+"""
+
+PRODUCT_CREATE_MEDIA_MUTATION = """
+mutation createMedia($productId: ID!, $media: [CreateMediaInput!]!) {
+  productCreateMedia(productId: $productId, media: $media) {
+    media { id alt status }
+    mediaUserErrors { field message code }
+  }
+}
+"""
+
+PRODUCT_MEDIA_QUERY = """
+query productMedia($id: ID!) {
+  product(id: $id) {
+    media(first: 250) { nodes { id alt } }
+  }
+}
+"""
+
+class BulkOperationError(Exception):
+    """A bulk operation could not be started or did not complete"""
+
+class ListingError(Exception):
+    """A strict product listing stopped before its last page"""
+
+class MediaPublishError(Exception):
+    """Shopify refused a staged upload or media request"""
+
+class ShopifyRateLimiter:
+    """Shared leaky-bucket limiter for the Shopify REST Admin API.
+
+    The local bucket drains at `leak_rate` calls/sec and is re-synced from the
+    `X-Shopify-Shop-Api-Call-Limit` header on every response, so bursts use the
+    full bucket instead of a fixed sleep. A 429 `Retry-After` pauses all callers.
+    """
+
+    def __init__(self, capacity=None, leak_rate=None, headroom=None):
+        self.capacity = capacity or int(os.getenv('SHOPIFY_BUCKET_SIZE', 40))
+        self.leak_rate = leak_rate or float(os.getenv('SHOPIFY_LEAK_RATE', 2.0))
+        self.headroom = headroom if headroom is not None else int(os.getenv('SHOPIFY_BUCKET_HEADROOM', 2))
+        self.level = 0.0
+        self.blocked_until = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _leak(self, now):
+        self.level = max(0.0, self.level - (now - self._updated) * self.leak_rate)
+        self._updated = now
+
+    def acquire(self):
+        """Block until a call fits in the bucket, then reserve it"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._leak(now)
+                limit = max(1, self.capacity - self.headroom)
+                if now >= self.blocked_until and self.level + 1 <= limit:
+                    self.level += 1
+                    return
+                wait = max(self.blocked_until - now, (self.level + 1 - limit) / self.leak_rate)
+            time.sleep(min(max(wait, 0.01), 5.0))
+
+    def observe(self, response):
+        """Sync the bucket with the server's view of it"""
+        with self._lock:
+            now = time.monotonic()
+            self._leak(now)
+            call_limit = response.headers.get('X-Shopify-Shop-Api-Call-Limit')
+            if call_limit and '/' in call_limit:
+                try:
+                    used, capacity = (int(part) for part in call_limit.split('/', 1))
+                    self.capacity = capacity
+                    self.level = float(used)
+                except ValueError:
+                    pass
+            if response.status_code == 429:
+                try:
+                    retry_after = float(response.headers.get('Retry-After', 2.0))
+                except ValueError:
+                    retry_after = 2.0
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+                self.level = float(self.capacity)
+
+    def headroom_remaining(self):
+        with self._lock:
+            self._leak(time.monotonic())
+            return self.capacity - self.level
+
+class ShopifyGraphQLLimiter:
+    """Shared calculated-cost bucket for the GraphQL Admin API.
+
+    Each query reserves its expected cost before it is sent; the bucket
+    refills at `restore_rate` points/sec and is re-synced from
+    `extensions.cost.throttleStatus` on every response, so a THROTTLED reply
+    makes every caller wait exactly as long as the store needs.
+    """
+
+    def __init__(self, maximum=None, restore_rate=None, default_cost=None):
+        self.maximum = maximum or float(os.getenv('SHOPIFY_GRAPHQL_MAX_COST', 1000))
+        self.restore_rate = restore_rate or float(os.getenv('SHOPIFY_GRAPHQL_RESTORE_RATE', 50))
+        self.default_cost = default_cost or float(os.getenv('SHOPIFY_GRAPHQL_DEFAULT_COST', 10))
+        self.available = self.maximum
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _restore(self, now):
+        self.available = min(self.maximum, self.available + (now - self._updated) * self.restore_rate)
+        self._updated = now
+
+    def acquire(self, cost=None):
+        """Block until `cost` points are available, then reserve them"""
+        cost = min(cost or self.default_cost, self.maximum)
+        while True:
+            with self._lock:
+                self._restore(time.monotonic())
+                if self.available >= cost:
+                    self.available -= cost
+                    return
+                wait = (cost - self.available) / self.restore_rate
+            time.sleep(min(max(wait, 0.01), 5.0))
+
+    def observe(self, cost):
+        """Sync with the `extensions.cost` block of a response"""
+        status = (cost or {}).get('throttleStatus')
+        if not status:
+            return
+        with self._lock:
+            self._updated = time.monotonic()
+            self.maximum = float(status.get('maximumAvailable', self.maximum))
+            self.restore_rate = float(status.get('restoreRate', self.restore_rate))
+            self.available = float(status.get('currentlyAvailable', self.available))
+
+    def points_available(self):
+        with self._lock:
+            self._restore(time.monotonic())
+            return self.available
+
+
 class ShopifyService:
     def __init__(self):
         # Get credentials with stripping
@@ -41,6 +249,22 @@ class ShopifyService:
                 logger.info(f"Store URL: {self.store_url}")
         
         self.base_url = f"https://{self.api_key}:{self.password}@{self.store_url}/admin/api/2023-10" if self.enabled else ""
+        self.rate_limiter = ShopifyRateLimiter()
+        self.graphql_limiter = ShopifyGraphQLLimiter()
+        self.max_retries = int(os.getenv('SHOPIFY_MAX_RETRIES', 3))
+    
+    def _get(self, url, timeout):
+        """Rate-limited GET that honours 429 Retry-After"""
+        for attempt in range(self.max_retries + 1):
+            with timed('shopify_rate_limit_wait'):
+                self.rate_limiter.acquire()
+            with timed('shopify_fetch'):
+                response = http_client.get(url, timeout=timeout)
+            self.rate_limiter.observe(response)
+            if response.status_code != 429 or attempt == self.max_retries:
+                return response
+            logger.warning(f"⏳ Shopify rate limit hit - backing off (attempt {attempt + 1}/{self.max_retries})")
+        return response
     
     def get_product_images(self, product_id):
         """Fetch all images for a product"""
@@ -51,7 +275,7 @@ class ShopifyService:
         try:
             url = f"{self.base_url}/products/{product_id}/images.json"
             logger.info(f"📡 Fetching images from: {url.split('@')[1]}")  # Hide credentials
-            response = requests.get(url, timeout=15)
+            response = self._get(url, timeout=15)
             
             if response.status_code == 200:
                 images = response.json().get('images', [])
@@ -72,7 +296,7 @@ class ShopifyService:
         try:
             url = f"{self.base_url}/shop.json"
             logger.info(f"🔍 Testing connection to: {url.split('@')[1]}")
-            response = requests.get(url, timeout=10)
+            response = self._get(url, timeout=10)
             
             if response.status_code == 200:
                 shop_data = response.json()['shop']
@@ -86,44 +310,297 @@ class ShopifyService:
             logger.exception(f"🔥 Connection test failed: {str(e)}")
             return False
     
-    def get_all_products(self, limit=250):
-        """Fetch all products from Shopify with pagination"""
+    def iter_products(self, limit=250, fields=PRODUCT_FIELDS, updated_at_min=None, strict=False):
+        """Lazily yield every product, one page at a time, following Link headers.
+
+        `fields` is passed through as a projection so only what the pipeline
+        needs is transferred; pass None for full product objects.
+        `updated_at_min` limits the listing to products changed since then.
+        With `strict`, a listing that can't be completed raises ListingError
+        instead of just ending early.
+        """
         if not self.enabled:
-            return []
+            return
         
-        all_products = []
+        params = {'limit': limit}
+        if fields:
+            params['fields'] = fields
+        if updated_at_min:
+            params['updated_at_min'] = updated_at_min
         page_info = None
+        total = 0
         
         try:
-            # Fetch up to 1000 products (4 pages of 250)
-            for _ in range(4):
-                url = f"{self.base_url}/products.json?limit={limit}"
+            while True:
+                # page_info cursors carry the filters; only limit/fields may accompany them
+                query = {k: v for k, v in params.items() if k in ('limit', 'fields')} if page_info else params
                 if page_info:
-                    url += f"&page_info={page_info}"
+                    query['page_info'] = page_info
+                url = f"{self.base_url}/products.json?{urlencode(query)}"
                 
                 logger.info(f"📡 Fetching products from: {url.split('@')[1]}")
-                response = requests.get(url, timeout=30)
+                response = self._get(url, timeout=30)
                 
-                if response.status_code == 200:
-                    data = response.json()
-                    products = data.get('products', [])
-                    all_products.extend(products)
-                    
-                    # Check for pagination
-                    if 'Link' in response.headers:
-                        links = requests.utils.parse_header_links(response.headers['Link'])
-                        next_link = next((link for link in links if link.get('rel') == 'next'), None)
-                        if next_link:
-                            page_info = next_link['url'].split('page_info=')[1].split('&')[0]
-                            continue
-                    break
-                else:
+                if response.status_code != 200:
                     logger.error(f"❌ Failed to fetch products (Status {response.status_code})")
+                    if strict:
+                        raise ListingError(f"Product listing failed (Status {response.status_code})")
+                    return
+                
+                products = response.json().get('products', [])
+                total += len(products)
+                yield from products
+                
+                page_info = self._next_page_info(response)
+                if not page_info:
                     break
-                    
-            logger.info(f"✅ Retrieved {len(all_products)} total products from Shopify")
-            return all_products
             
+            logger.info(f"✅ Retrieved {total} total products from Shopify")
+        
+        except ListingError:
+            raise
         except Exception as e:
             logger.exception(f"🔥 Error fetching all products: {str(e)}")
-            return []
+            if strict:
+                raise ListingError(str(e)) from e
+    
+    @staticmethod
+    def _next_page_info(response):
+        """Extract the page_info cursor of the rel="next" Link, if any"""
+        if 'Link' not in response.headers:
+            return None
+        links = requests.utils.parse_header_links(response.headers['Link'])
+        next_link = next((link for link in links if link.get('rel') == 'next'), None)
+        if not next_link:
+            return None
+        return parse_qs(urlparse(next_link['url']).query).get('page_info', [None])[0]
+    
+    def count_products(self, updated_at_min=None):
+        """Number of products (updated since `updated_at_min`), or None if Shopify can't say"""
+        if not self.enabled:
+            return None
+        params = {'updated_at_min': updated_at_min} if updated_at_min else {}
+        try:
+            response = self._get(f"{self.base_url}/products/count.json?{urlencode(params)}", timeout=10)
+            if response.status_code == 200:
+                return response.json().get('count')
+            logger.warning(f"⚠️ Product count failed (Status {response.status_code})")
+        except Exception as e:
+            logger.warning(f"⚠️ Product count failed: {str(e)}")
+        return None
+    
+    def get_all_products(self, limit=250, fields=None):
+        """Fetch all products from Shopify with pagination"""
+        return list(self.iter_products(limit=limit, fields=fields))
+    
+    # ===== GraphQL Bulk Operations =====
+    
+    def graphql(self, query, variables=None, timeout=30, cost=None):
+        """POST a GraphQL Admin API query and return its `data`.
+        
+        Waits for `cost` points in the shared cost bucket first and retries
+        THROTTLED replies up to SHOPIFY_MAX_RETRIES times.
+        """
+        url = f"{self.base_url}/graphql.json"
+        for attempt in range(self.max_retries + 1):
+            with timed('shopify_rate_limit_wait'):
+                self.graphql_limiter.acquire(cost)
+            with timed('shopify_graphql'):
+                response = http_client.post(
+                    url,
+                    json={'query': query, 'variables': variables or {}},
+                    headers={'X-Shopify-Access-Token': self.password},
+                    timeout=timeout
+                )
+            if response.status_code == 429 and attempt < self.max_retries:
+                logger.warning(f"⏳ Shopify GraphQL rate limit hit - backing off (attempt {attempt + 1}/{self.max_retries})")
+                time.sleep(float(response.headers.get('Retry-After', 2.0)))
+                continue
+            if response.status_code != 200:
+                raise BulkOperationError(f"GraphQL request failed (Status {response.status_code}): {response.text[:200]}")
+            body = response.json()
+            self.graphql_limiter.observe((body.get('extensions') or {}).get('cost'))
+            errors = body.get('errors')
+            throttled = errors and all((error.get('extensions') or {}).get('code') == 'THROTTLED' for error in errors)
+            if throttled and attempt < self.max_retries:
+                logger.warning(f"⏳ Shopify GraphQL query throttled - waiting for cost points (attempt {attempt + 1}/{self.max_retries})")
+                continue
+            if errors:
+                raise BulkOperationError(f"GraphQL errors: {errors}")
+            return body.get('data', {})
+    
+    def start_bulk_products_query(self, updated_at_min=None):
+        """Kick off a bulkOperationRunQuery over products + images; returns the operation id"""
+        query = BULK_PRODUCTS_QUERY
+        if updated_at_min:
+            # Same search syntax as the admin product list
+            query = query.replace('products {', f'products(query: "updated_at:>=\'{updated_at_min}\'") {{', 1)
+        data = self.graphql(BULK_RUN_MUTATION, {'query': query})
+        result = data.get('bulkOperationRunQuery') or {}
+        if result.get('userErrors'):
+            raise BulkOperationError(f"Bulk operation rejected: {result['userErrors']}")
+        operation = result.get('bulkOperation') or {}
+        logger.info(f"📦 Started bulk operation {operation.get('id')} ({operation.get('status')})")
+        return operation.get('id')
+    
+    def cancel_bulk_operation(self, operation_id):
+        """Best-effort bulkOperationCancel - only one bulk query may run per store at a time"""
+        try:
+            result = self.graphql(BULK_CANCEL_MUTATION, {'id': operation_id}).get('bulkOperationCancel') or {}
+            if result.get('userErrors'):
+                logger.warning(f"⚠️ Could not cancel bulk operation {operation_id}: {result['userErrors']}")
+            else:
+                logger.info(f"🛑 Cancelled bulk operation {operation_id}")
+        except Exception as e:
+            logger.warning(f"⚠️ Could not cancel bulk operation {operation_id}: {str(e)}")
+    
+    def wait_for_bulk_operation(self, poll_interval=None, timeout=None, control=None):
+        """Poll currentBulkOperation until it finishes; returns the JSONL result URL (None if empty).
+        
+        With a RunControl, a cancelled run stops polling between polls, cancels
+        the operation and returns None.
+        """
+        poll_interval = poll_interval if poll_interval is not None else float(os.getenv('SHOPIFY_BULK_POLL_INTERVAL', 5))
+        timeout = timeout if timeout is not None else float(os.getenv('SHOPIFY_BULK_TIMEOUT', 3600))
+        deadline = time.monotonic() + timeout
+        
+        while True:
+            if control is not None and control.cancelled.is_set():
+                operation = self.graphql(BULK_STATUS_QUERY).get('currentBulkOperation') or {}
+                if operation.get('status') in ('CREATED', 'RUNNING'):
+                    self.cancel_bulk_operation(operation['id'])
+                return None
+            operation = self.graphql(BULK_STATUS_QUERY).get('currentBulkOperation') or {}
+            status = operation.get('status')
+            
+            if status == 'COMPLETED':
+                logger.info(f"✅ Bulk operation complete: {operation.get('objectCount')} objects")
+                return operation.get('url')
+            if status in ('FAILED', 'CANCELED', 'EXPIRED'):
+                raise BulkOperationError(f"Bulk operation {status}: {operation.get('errorCode')}")
+            if time.monotonic() >= deadline:
+                raise BulkOperationError(f"Bulk operation still {status} after {timeout:.0f}s")
+            
+            logger.info(f"⏳ Bulk operation {status} ({operation.get('objectCount')} objects so far)")
+            if control is not None:
+                control.cancelled.wait(poll_interval)  # wakes straight away on cancel
+            else:
+                time.sleep(poll_interval)
+    
+    def iter_bulk_jsonl(self, url, timeout=60):
+        """Stream a bulk result file line by line - never held in memory"""
+        with http_client.get(url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
+    
+    def iter_bulk_products(self, updated_at_min=None, control=None):
+        """Yield REST-shaped product dicts from a bulk export of products + images.
+        
+        `control` is the run's RunControl; cancelling it stops the wait for the export.
+        """
+        if not self.enabled:
+            return
+        
+        self.start_bulk_products_query(updated_at_min)
+        url = self.wait_for_bulk_operation(control=control)
+        if control is not None and control.cancelled.is_set():
+            logger.warning("🛑 Bulk export abandoned - run cancelled")
+            return
+        if not url:
+            logger.warning("❌ Bulk operation returned no data")
+            return
+        
+        current = None
+        total = 0
+        for record in self.iter_bulk_jsonl(url):
+            parent_id = record.get('__parentId')
+            if parent_id is None:
+                if current is not None:
+                    total += 1
+                    yield current
+                current = {
+                    'id': int(record.get('legacyResourceId') or record['id'].rsplit('/', 1)[-1]),
+                    'gid': record['id'],
+                    'title': record.get('title'),
+                    'tags': ', '.join(record.get('tags') or []),
+                    'updated_at': record.get('updatedAt'),
+                    'images': [],
+                }
+            elif current is not None and parent_id == current['gid']:
+                current['images'].append({
+                    'id': int(record['id'].rsplit('/', 1)[-1]),
+                    'src': record.get('url'),
+                    'width': record.get('width'),
+                    'height': record.get('height'),
+                })
+            else:
+                logger.warning(f"⚠️ Orphan bulk record {record.get('id')} (parent {parent_id})")
+        
+        if current is not None:
+            total += 1
+            yield current
+        logger.info(f"✅ Streamed {total} products from bulk export")
+    
+    # ===== Media publishing =====
+    
+    @staticmethod
+    def product_gid(product_id):
+        product_id = str(product_id)
+        return product_id if product_id.startswith('gid://') else f"gid://shopify/Product/{product_id}"
+    
+    def staged_uploads_create(self, files):
+        """Staged upload targets for [{'filename', 'mime_type', 'size'}], in the same order"""
+        data = self.graphql(STAGED_UPLOADS_MUTATION, {'input': [
+            {
+                'resource': 'IMAGE',
+                'filename': f['filename'],
+                'mimeType': f['mime_type'],
+                'fileSize': str(f['size']),
+                'httpMethod': 'POST',
+            }
+            for f in files
+        ]})
+        result = data.get('stagedUploadsCreate') or {}
+        if result.get('userErrors'):
+            raise MediaPublishError(f"Staged upload rejected: {result['userErrors']}")
+        targets = result.get('stagedTargets') or []
+        if len(targets) != len(files):
+            raise MediaPublishError(f"Asked for {len(files)} staged targets, got {len(targets)}")
+        return targets
+    
+    def upload_staged(self, target, content, filename, mime_type, timeout=60):
+        """POST a file to a staged upload target (its form parameters first, the file last)"""
+        fields = [(p['name'], (None, p['value'])) for p in target.get('parameters') or []]
+        fields.append(('file', (filename, content, mime_type)))
+        with timed('shopify_staged_upload'):
+            response = http_client.post(target['url'], files=fields, timeout=timeout)
+        if response.status_code not in (200, 201, 204):
+            raise MediaPublishError(f"Staged upload failed (Status {response.status_code}): {response.text[:200]}")
+    
+    def product_create_media(self, product_id, media):
+        """Attach [{'originalSource', 'alt'}] images to a product.
+        
+        Returns (created media dicts, {input index or None: [messages]}).
+        """
+        data = self.graphql(PRODUCT_CREATE_MEDIA_MUTATION, {
+            'productId': self.product_gid(product_id),
+            'media': [dict(item, mediaContentType='IMAGE') for item in media],
+        })
+        result = data.get('productCreateMedia') or {}
+        errors = {}
+        for error in result.get('mediaUserErrors') or []:
+            field = error.get('field') or []
+            # field is e.g. ["media", "2", "originalSource"]
+            index = int(field[1]) if len(field) > 1 and str(field[1]).isdigit() else None
+            errors.setdefault(index, []).append(error.get('message'))
+        return result.get('media') or [], errors
+    
+    def product_media(self, product_id):
+        """[{'id', 'alt'}] of a product's media (first 250)"""
+        data = self.graphql(PRODUCT_MEDIA_QUERY, {'id': self.product_gid(product_id)})
+        product = data.get('product')
+        if product is None:
+            raise MediaPublishError(f"Product {product_id} not found")
+        return (product.get('media') or {}).get('nodes') or []
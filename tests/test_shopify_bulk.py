@@ -0,0 +1,65 @@
+"""Bulk export path against the local Shopify stand-in.
+
+    python -m unittest discover -s tests
+"""
+import os
+import sys
+import time
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('SHOPIFY_BULK_POLL_INTERVAL', '0.05')
+
+from benchmarks.fakes import FakeShopify
+from services.shopify import ShopifyService
+from pipeline import RunControl
+
+class BulkProductsTest(unittest.TestCase):
+    def start_store(self, **options):
+        fake = FakeShopify(products=25, images_per_product=3, image_size=64, **options).start()
+        self.addCleanup(fake.stop)
+        return fake, fake.attach(ShopifyService())
+
+    def test_reassembles_products_with_their_images(self):
+        fake, shopify = self.start_store(bulk_delay=0.1)
+        products = list(shopify.iter_bulk_products())
+
+        self.assertEqual([p['id'] for p in products], [p['id'] for p in fake.products])
+        for product, expected in zip(products, fake.products):
+            self.assertEqual(product['title'], expected['title'])
+            self.assertEqual(product['tags'], ', '.join(tag.strip() for tag in expected['tags'].split(',')))
+            self.assertEqual(product['updated_at'], expected['updated_at'])
+            self.assertEqual([(i['id'], i['src'], i['width']) for i in product['images']],
+                             [(i['id'], i['src'], i['width']) for i in expected['images']])
+        # Streamed from one JSONL download after polling the operation
+        self.assertEqual(fake.stats()['bulk_run'], 1)
+        self.assertEqual(fake.stats()['bulk_download'], 1)
+        self.assertGreaterEqual(fake.stats()['bulk_status'], 2)
+
+    def test_updated_at_min_limits_the_export(self):
+        fake, shopify = self.start_store(bulk_delay=0.0)
+        since = fake.products[20]['updated_at']
+        products = list(shopify.iter_bulk_products(updated_at_min=since))
+        self.assertEqual([p['id'] for p in products], [p['id'] for p in fake.products[20:]])
+
+    def test_product_without_images_is_kept(self):
+        fake, shopify = self.start_store(bulk_delay=0.0)
+        fake.products[-1]['images'] = []
+        products = list(shopify.iter_bulk_products())
+        self.assertEqual(len(products), 25)
+        self.assertEqual(products[-1]['images'], [])
+        self.assertEqual(len(products[-2]['images']), 3)
+
+    def test_cancel_stops_polling(self):
+        fake, shopify = self.start_store(bulk_delay=60)
+        control = RunControl()
+        threading.Timer(0.2, control.cancel).start()
+        started = time.monotonic()
+        products = list(shopify.iter_bulk_products(control=control))
+        self.assertEqual(products, [])
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(fake.bulk_operations[-1]['status'], 'CANCELED')
+
+if __name__ == '__main__':
+    unittest.main()
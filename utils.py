@@ -1,21 +1,27 @@
-import json
 import os
-from datetime import date
+from contextlib import contextmanager
+from contextvars import ContextVar
+from models import get_cost_ledger
+from metrics import REPLICATE_COST, REPLICATE_PREDICTIONS
 
-def track_cost(amount):
-    """Persistent daily cost tracking"""
-    today = str(date.today())
-    cost_file = "daily_costs.json"
-    
-    costs = {}
-    if os.path.exists(cost_file):
-        with open(cost_file) as f:
-            costs = json.load(f)
-    
-    costs[today] = costs.get(today, 0) + amount
-    
-    with open(cost_file, 'w') as f:
-        json.dump(costs, f)
+# Product whose processing is currently running - attributed on every charge
+_current_product = ContextVar('current_product', default=None)
+
+@contextmanager
+def attribute_costs(product_id):
+    """Attribute Replicate spend inside this block to `product_id`"""
+    token = _current_product.set(str(product_id) if product_id is not None else None)
+    try:
+        yield
+    finally:
+        _current_product.reset(token)
+
+def track_cost(amount, model=None, product_id=None, cached=False):
+    """Persistent cost tracking via the append-only cost ledger"""
+    model_label = model or 'unknown'
+    REPLICATE_COST.labels(model_label).inc(amount)
+    REPLICATE_PREDICTIONS.labels(model_label, 'true' if cached else 'false').inc()
+    get_cost_ledger().record(amount, model=model, product_id=product_id or _current_product.get(), cached=cached)
 
 def combine_images(main_img, swatch_grid):
     """Create clothing collage (simplified)"""
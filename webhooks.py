@@ -0,0 +1,82 @@
+import os
+import logging
+import threading
+from pipeline import image_fingerprint
+
+logger = logging.getLogger("webhooks")
+
+class WebhookCoalescer:
+    """Collapses bursts of products/update webhooks into one job per product.
+
+    Deliveries are deduped by X-Shopify-Webhook-Id, events whose image set
+    matches the product's recorded sync state are dropped, and the rest are
+    folded into a still-queued job for the same product whose start is pushed
+    back by WEBHOOK_DEBOUNCE_SECONDS (capped at WEBHOOK_MAX_DELAY_SECONDS
+    after the first event). The job carries the latest payload's images, so
+    processing doesn't have to fetch them again.
+    """
+
+    def __init__(self, db, job_pool, window=None, max_delay=None, retention=None):
+        self.db = db
+        self.job_pool = job_pool
+        self.window = window if window is not None else float(os.getenv('WEBHOOK_DEBOUNCE_SECONDS', 10))
+        self.max_delay = max_delay if max_delay is not None else float(os.getenv('WEBHOOK_MAX_DELAY_SECONDS', 60))
+        # Shopify retries failed deliveries for up to 48 hours
+        self.retention = retention if retention is not None else float(os.getenv('WEBHOOK_ID_RETENTION_SECONDS', 48 * 3600))
+        self._lock = threading.Lock()
+        self.counters = {'received': 0, 'duplicates': 0, 'unchanged': 0, 'coalesced': 0, 'enqueued': 0}
+
+    def _count(self, key):
+        with self._lock:
+            self.counters[key] += 1
+
+    def submit(self, payload, webhook_id=None):
+        """Handle one products/update payload; returns a status dict for the webhook response.
+
+        Blocks on SQLite writes - call it off the event loop.
+        """
+        product_id = payload['id']
+        self._count('received')
+
+        if webhook_id and not self.db.record_webhook(webhook_id, product_id, self.retention):
+            self._count('duplicates')
+            logger.info(f"♻️ Duplicate webhook {webhook_id} for product {product_id}")
+            return {"status": "duplicate", "product_id": product_id}
+
+        try:
+            images = payload.get('images')
+            if images is not None:
+                state = self.db.get_sync_state(product_id)
+                if state is not None and state[1] == image_fingerprint(images):
+                    self._count('unchanged')
+                    logger.info(f"⏭️ Images unchanged for product {product_id} - ignoring update")
+                    return {"status": "unchanged", "product_id": product_id}
+
+            job_id, coalesced = self.job_pool.enqueue_coalesced(
+                'process_product',
+                f"product:{product_id}",
+                {
+                    'product_id': product_id,
+                    'tags': payload.get('tags', []),
+                    'images': images,
+                    'updated_at': payload.get('updated_at'),
+                },
+                self.window,
+                self.max_delay,
+            )
+            self._count('coalesced' if coalesced else 'enqueued')
+            if coalesced:
+                logger.info(f"🧲 Coalesced update for product {product_id} into job {job_id}")
+            return {"status": "coalesced" if coalesced else "processing_started", "product_id": product_id, "job_id": job_id}
+        except Exception:
+            # The event never made it into the queue - let Shopify's redelivery through
+            if webhook_id:
+                self.db.forget_webhook(webhook_id)
+            raise
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        # Webhook events per job actually run
+        stats['coalescing_ratio'] = round(stats['received'] / stats['enqueued'], 2) if stats['enqueued'] else None
+        return stats